@@ -0,0 +1,189 @@
+import argparse
+import glob
+import os
+import sys
+
+# Classification methods which are combined with one type of distance.
+DISTANCE_METHODS = ['dist_topo', 'dist_approx', 'dist_topo_approx', 'assign', 'dist_overlap']
+
+# All types of distance.
+DISTANCE_TYPES = ['dist_edc', 'dist_edv', 'dist_hdv', 'dist_ednp']
+
+
+# Subcommand 'text': only align entities with textual labels. Only the modules of textual label alignment are loaded.
+def run_text(args):
+    import evaluate_performance
+    import instrumentation
+    import text_label_match
+    instrumentation.reset_report()
+    with instrumentation.stage('read_entities'):
+        entity_set1 = read_map(shapefile_list(args.map1))
+        entity_set2 = read_map(shapefile_list(args.map2))
+    ground_truth_label = evaluate_performance.select_ground_truth_labels(entity_set1, entity_set2, args.ground_truth)
+    text_label_match.textual_label_alignment(entity_set1, entity_set2, args.text_method, ground_truth_label)
+    instrumentation.write_report(args.report)
+
+
+# Subcommand 'align': compute the similarity store of two maps.
+def run_align(args):
+    import execute_align
+    execute_align.execute_alignment(shapefile_list(args.map1), shapefile_list(args.map2), args.ground_truth,
+                                    args.text_method, report_file=args.report, profile_stage=args.profile_stage,
+                                    inn_candidates=args.inn_candidates, lazy_hdv=args.lazy_hdv,
+                                    transform_method=args.transform, cache_dir=args.cache_dir)
+
+
+# Subcommand 'classify': classify the entity pairs of a similarity store with one method.
+def run_classify(args):
+    import classify_align
+    classify_align.alignment_classification(args.store, args.method, args.text_result, args.ground_truth,
+                                            args.distance, report_file=args.report, n_jobs=args.n_jobs)
+
+
+# Subcommand 'sweep': classify the entity pairs of a similarity store with several methods and types of distance. Each
+# method which uses one type of distance is run with every type of distance given.
+def run_sweep(args):
+    import classify_align
+    import instrumentation
+    instrumentation.reset_report()
+    for method_name in args.methods:
+        distance_types = args.distances if method_name in DISTANCE_METHODS else [None]
+        for distance_type in distance_types:
+            print('%s\t%s' % (method_name, distance_type or ''))
+            with instrumentation.stage('classification_' + method_name + ('_' + distance_type if distance_type else '')):
+                classify_align.classify_entity_pairs(args.store, method_name, args.text_result, args.ground_truth,
+                                                     distance_type, args.n_jobs)
+    instrumentation.write_report(args.report, merge=True)
+
+
+# Subcommand 'series': align each two consecutive maps of a series of maps, such as the maps of one area in different
+# years. The files of each map pair are written in its own directory in the output directory.
+def run_series(args):
+    import execute_align
+    if len(args.ground_truth) != len(args.maps) - 1:
+        raise ValueError('One ground truth is needed for each two consecutive maps.')
+
+    output_dir = os.path.abspath(args.output)
+    working_dir = os.getcwd()
+    for i in range(len(args.maps) - 1):
+        map1 = shapefile_list([os.path.abspath(path) for path in args.maps[i]])
+        map2 = shapefile_list([os.path.abspath(path) for path in args.maps[i + 1]])
+        pair_dir = os.path.join(output_dir, map_name(args.maps[i]) + '_' + map_name(args.maps[i + 1]))
+        if not os.path.exists(pair_dir):
+            os.makedirs(pair_dir)
+        print(os.path.basename(pair_dir))
+        os.chdir(pair_dir)
+        try:
+            execute_align.execute_alignment(map1, map2, os.path.abspath(os.path.join(working_dir, args.ground_truth[i])),
+                                            args.text_method, transform_method=args.transform,
+                                            cache_dir=os.path.abspath(os.path.join(working_dir, args.cache_dir))
+                                            if args.cache_dir else None)
+        finally:
+            os.chdir(working_dir)
+
+
+# The ShapeFiles of one map. A map is given by its ShapeFiles or by the directories containing them.
+def shapefile_list(paths):
+    shapefiles = []
+    for path in paths:
+        if os.path.isdir(path):
+            shapefiles.extend(sorted(glob.glob(os.path.join(path, '*.shp'))))
+        else:
+            shapefiles.append(path)
+
+    return shapefiles
+
+
+# Read the entity sets of one map from its ShapeFiles. Empty ShapeFiles are skipped.
+def read_map(shapefiles):
+    import geopandas as gpd
+    entity_sets = [gpd.read_file(shapefile) for shapefile in shapefiles]
+
+    return [entity_set for entity_set in entity_sets if not entity_set.empty]
+
+
+# The name of a map in the series, which is the name of its first file or directory.
+def map_name(paths):
+    return os.path.splitext(os.path.basename(os.path.normpath(paths[0])))[0]
+
+
+# Add the arguments of two maps, the ground truth and the textual label method.
+def add_map_arguments(parser):
+    parser.add_argument('--map1', nargs='+', required=True, help='ShapeFiles or directory of the first map')
+    parser.add_argument('--map2', nargs='+', required=True, help='ShapeFiles or directory of the second map')
+    parser.add_argument('--ground-truth', required=True)
+    parser.add_argument('--text-method', default='simple_str_case_punc')
+    parser.add_argument('--report', default='run_report.json')
+
+
+# Add the arguments of classification of a similarity store.
+def add_store_arguments(parser):
+    parser.add_argument('--store', default='similarity_store')
+    parser.add_argument('--text-result', required=True, help='file of alignments found with textual labels')
+    parser.add_argument('--ground-truth', required=True)
+    parser.add_argument('--report', default='run_report.json')
+    parser.add_argument('--n-jobs', type=int, default=1, help='number of processes used by the method assign')
+
+
+# Build the parser of all subcommands.
+def build_parser():
+    parser = argparse.ArgumentParser(description='Align geographic entities from historical maps.')
+    subparsers = parser.add_subparsers(dest='command')
+
+    text_parser = subparsers.add_parser('text', help='align entities with textual labels only')
+    add_map_arguments(text_parser)
+    text_parser.set_defaults(function=run_text)
+
+    align_parser = subparsers.add_parser('align', help='compute the similarity store of two maps')
+    add_map_arguments(align_parser)
+    align_parser.add_argument('--transform', choices=['affine', 'rubber_sheet'], default='affine')
+    align_parser.add_argument('--inn-candidates', choices=['all', 'delaunay'], default='all')
+    align_parser.add_argument('--lazy-hdv', action='store_true')
+    align_parser.add_argument('--cache-dir')
+    align_parser.add_argument('--profile-stage')
+    align_parser.set_defaults(function=run_align)
+
+    classify_parser = subparsers.add_parser('classify', help='classify entity pairs with one method')
+    add_store_arguments(classify_parser)
+    classify_parser.add_argument('--method', required=True)
+    classify_parser.add_argument('--distance', choices=DISTANCE_TYPES)
+    classify_parser.set_defaults(function=run_classify)
+
+    sweep_parser = subparsers.add_parser('sweep', help='classify entity pairs with several methods and distances')
+    add_store_arguments(sweep_parser)
+    sweep_parser.add_argument('--methods', nargs='+', default=['dist', 'approx', 'topo', 'dist_approx', 'dist_topo',
+                                                               'approx_topo', 'dist_topo_approx'])
+    sweep_parser.add_argument('--distances', nargs='+', choices=DISTANCE_TYPES, default=['dist_hdv'])
+    sweep_parser.set_defaults(function=run_sweep)
+
+    series_parser = subparsers.add_parser('series', help='align each two consecutive maps of a series')
+    series_parser.add_argument('--maps', nargs='+', action='append', required=True,
+                               help='ShapeFiles or directory of one map, repeated for each map in order')
+    series_parser.add_argument('--ground-truth', nargs='+', required=True,
+                               help='ground truth of each two consecutive maps in order')
+    series_parser.add_argument('--text-method', default='simple_str_case_punc')
+    series_parser.add_argument('--transform', choices=['affine', 'rubber_sheet'], default='affine')
+    series_parser.add_argument('--cache-dir')
+    series_parser.add_argument('--output', default='series')
+    series_parser.set_defaults(function=run_series)
+
+    return parser
+
+
+# Run one subcommand. Stage modules are imported in the function of each subcommand, so that a subcommand only loads
+# the modules it needs. 'classify' and 'sweep' only read the similarity store and do not import geopandas or arcpy.
+def main(argv=None):
+    parser = build_parser()
+    args = parser.parse_args(argv)
+    if args.command is None:
+        parser.print_help()
+        return 1
+    if args.command == 'classify' and args.method in DISTANCE_METHODS and args.distance is None:
+        parser.error('the method ' + args.method + ' needs the type of distance given with --distance')
+    args.function(args)
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
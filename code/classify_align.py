@@ -0,0 +1,91 @@
+import pandas as pd
+import classsification
+import entity_ids
+import evaluate_performance
+import instrumentation
+import similarity_store
+
+
+# With the similarity store containing the computed similarity scores, this function makes alignment classification. The
+# stages of classification are added to the report in report_file, which is usually the report of the alignment run.
+# n_jobs is the number of processes used by the method 'assign'.
+def alignment_classification(df_similarity_path, method_name, text_result_file, ground_truth, distance_method=None,
+                             report_file='run_report.json', n_jobs=1):
+    instrumentation.reset_report()
+    with instrumentation.stage('classification_' + method_name):
+        classify_entity_pairs(df_similarity_path, method_name, text_result_file, ground_truth, distance_method, n_jobs)
+    instrumentation.write_report(report_file, merge=True)
+
+
+# Classify the entity pairs stored in the similarity store with one classification method and evaluate the result.
+def classify_entity_pairs(df_similarity_path, method_name, text_result_file, ground_truth, distance_method, n_jobs=1):
+    # Read only the columns of similarity used by the classification method.
+    with instrumentation.stage('read_similarity'):
+        similarity = similarity_store.read_store(df_similarity_path, similarity_columns(method_name, distance_method))
+    df_similarity = similarity['similarity']
+    df_matched = read_text_matches(text_result_file, similarity['sou_ids'], similarity['tar_ids'])
+
+    # The method 'dist' is evaluated with all four types of distance. Other methods are evaluated once. Codes in the
+    # result are converted back to FeaIDs when the result is written.
+    for distance_type in classification_distance_types(method_name, distance_method):
+        df_result = classification_result(df_similarity, method_name, df_matched, distance_type,
+                                          similarity['sou_inns'], similarity['tar_inns'], n_jobs)
+        df_result = entity_ids.decode_matches(df_result, similarity['sou_ids'], similarity['tar_ids'])
+        result_file = evaluate_performance.write_result_file(df_result, method_name, text_result_file)
+        evaluate_performance.eval_perf(result_file, ground_truth)
+
+
+# Read the alignments found with textual labels and convert their FeaIDs to codes.
+def read_text_matches(text_result_file, sou_ids, tar_ids):
+    df_text_matched = pd.read_csv(text_result_file, header=None, sep='\t')
+
+    return entity_ids.encode_matches(df_text_matched, sou_ids, tar_ids)
+
+
+# Corresponding columns of similarity will be chosen according to the name of used classification method.
+def select_similarity_columns(df_similarity, method_name, distance_method):
+    return df_similarity[similarity_columns(method_name, distance_method)]
+
+
+# The names of columns of similarity used by a classification method.
+def similarity_columns(method_name, distance_method):
+    method_dict = {'topo': [], 'dist': ['dist_edc', 'dist_edv', 'dist_hdv', 'dist_ednp', 'angle'],
+                       'approx': ['atr_within'], 'dist_topo': [distance_method, 'angle'], 'dist_approx': [distance_method, 'angle', 'atr_within'],
+                       'approx_topo': ['atr_within'],
+                       'dist_topo_approx': [distance_method, 'angle', 'atr_within'],
+                       'assign': [distance_method, 'angle', 'atr_within'], 'overlap': ['overlap_fraction'],
+                       'dist_overlap': [distance_method, 'angle', 'overlap_fraction']}
+    selected_columns = sum([['sou_id'], ['tar_id'], ['sou_type'], method_dict[method_name]], [])
+
+    return selected_columns
+
+
+# The types of distance used by a classification method.
+def classification_distance_types(method_name, distance_method):
+    if method_name == 'dist':
+        return ['dist_edc', 'dist_edv', 'dist_ednp', 'dist_hdv']
+    return [distance_method]
+
+
+# Different names of classification method will call the corresponding classification function and obtain the result.
+# df_matched contains the codes of alignments found with textual labels, and sou_inns and tar_inns are the INNs of
+# entities stored as compressed sparse rows. The connected components of the method 'assign' are solved on n_jobs
+# processes.
+def classification_result(df_similarity, method_name, df_matched, distance_type, sou_inns, tar_inns, n_jobs=1):
+    if method_name == 'topo':
+        return getattr(classsification, method_name)(df_similarity, df_matched, sou_inns, tar_inns)
+
+    if method_name in ['dist', 'dist_approx', 'dist_overlap']:
+        return getattr(classsification, method_name)(df_similarity, distance_type)
+
+    if method_name in ['approx', 'overlap']:
+        return getattr(classsification, method_name)(df_similarity)
+
+    if method_name == 'approx_topo':
+        return getattr(classsification, method_name)(df_similarity, df_matched, sou_inns, tar_inns)
+
+    if method_name in ['dist_topo', 'dist_topo_approx']:
+        return getattr(classsification, method_name)(df_similarity, df_matched, distance_type, sou_inns, tar_inns)
+
+    if method_name == 'assign':
+        return getattr(classsification, method_name)(df_similarity, distance_type, n_jobs)
@@ -1,17 +1,29 @@
+import numpy as np
 import pandas as pd
+import instrumentation
+from entity_ids import LINE_TYPES
+
+# Connected components are assigned in parallel when there are more components than this number.
+PARALLEL_COMPONENTS = 1000
+
+# Entity pairs whose overlap fraction is lower than this number are not aligned by the methods 'overlap' and
+# 'dist_overlap'.
+OVERLAP_THRESHOLD = 0.8
 
 # df_all_matching is used to store all the found alignments in a iteration in the method 'topo'.
 df_all_matching = pd.DataFrame(columns=('sou_id', 'tar_id'))
 
 
-# This function is to implement method of 'topo' iteratively.
-def topo(df_similarity, df_matched):
+# This function is to implement method of 'topo' iteratively. sou_inns and tar_inns are the INNs of entities of two
+# maps stored as compressed sparse rows (offsets, codes of INNs).
+def topo(df_similarity, df_matched, sou_inns, tar_inns):
     global df_all_matching
 
     df_matched.columns = ['sou_id', 'tar_id']
 
     # Find new matching pairs in one run
-    df_new_matching = one_run(df_similarity, df_matched)
+    df_new_matching = one_run(df_similarity, df_matched, sou_inns, tar_inns)
+    instrumentation.count('classification_iterations')
 
     # If there are no new matching pairs found, the result will be evaluated and the method will be done. If there are
     # new matching pairs found, continue to iterate the program.
@@ -19,31 +31,31 @@ def topo(df_similarity, df_matched):
         print('done')
     else:
         df_all_matching = df_all_matching.append(df_new_matching, ignore_index=True)
-        topo(df_similarity, df_all_matching)
+        topo(df_similarity, df_all_matching, sou_inns, tar_inns)
 
     return df_all_matching
 
 
 # The method of "topo" align entities is implemented in a iterative manner. Each run will find new alignments.
-def one_run(df_similarity, df_matched):
+def one_run(df_similarity, df_matched, sou_inns, tar_inns):
     df_new_matching = pd.DataFrame(columns=('sou_id', 'tar_id'))
 
     # If all the INNs of two entities have been matched, they will be matching pair.
     for sou_id, group in df_similarity.groupby(['sou_id']):
         for index, row in group.iterrows():
             sou_id = row['sou_id']
-            sou_inns = row['topo_sou_inns']
+            sou_entity_inns = entity_inns(sou_inns, sou_id)
             tar_id = row['tar_id']
-            tar_inns = row['topo_tar_inns']
+            tar_entity_inns = entity_inns(tar_inns, tar_id)
 
-            sum_inns = len(sou_inns) + len(tar_inns)  # the total number of INNs of two entities.
+            sum_inns = len(sou_entity_inns) + len(tar_entity_inns)  # the total number of INNs of two entities.
 
             # Generate all the possible matching pairs with all the INNs
             possilbe_match_list = []
-            for m in range(len(sou_inns)):
-                current_sou_inn = sou_inns[m]
-                for n in range(len(tar_inns)):
-                    current_tar_inn = tar_inns[n]
+            for m in range(len(sou_entity_inns)):
+                current_sou_inn = sou_entity_inns[m]
+                for n in range(len(tar_entity_inns)):
+                    current_tar_inn = tar_entity_inns[n]
                     possilbe_match_list.append((current_sou_inn, current_tar_inn))
 
             # Find already matched pairs.
@@ -70,7 +82,7 @@ def dist(df_similarity, distance_type):
     # these two entity will be matched.
     for sou_id, group in df_similarity_sorted.groupby(['sou_id1']):
         # For entities of polyline geometry, the angle between entity pairs will also be checked.
-        if sou_id.count('line'):
+        if group.iloc[0]['sou_type'] in LINE_TYPES:
             df_shortest = group[(group[distance_type] == group.iloc[0][distance_type]) & (group['angle'] < 45)][['sou_id1', 'tar_id']]
             df_shortest.columns = ['sou_id', 'tar_id']
             if len(df_shortest) == 1:
@@ -118,7 +130,7 @@ def best_dist(df_similarity, distance_method):
     # We will keep all entities which has the shortest distance with source entity.
     for sou_id, group in df_similarity_sorted.groupby(['sou_id1']):
         # For entities of polyline geometry, the angle between entity pairs will be checked.
-        if sou_id.count('line'):
+        if group.iloc[0]['sou_type'] in LINE_TYPES:
             df_shortest = group[(group[distance_method] == group.iloc[0][distance_method]) & (group['angle'] < 45)]
             df_shortest = df_shortest.rename(columns={'sou_id1': 'sou_id'})
             if df_shortest.empty:
@@ -148,15 +160,42 @@ def dist_approx(df_similarity, distance_method):
     return df_result
 
 
+# This function is to classify entity pairs with the method of 'overlap'. It is the method 'approx' with the exact
+# overlap fraction of entities instead of the approximate topological relation: the target entity covering the largest
+# fraction of the source entity, or covered by it, is matched if this fraction is not lower than OVERLAP_THRESHOLD.
+# Only entity pairs of overlaid maps have an overlap fraction.
+def overlap(df_similarity):
+    df_overlap = df_similarity[df_similarity['overlap_fraction'] >= OVERLAP_THRESHOLD]
+    df_overlap = df_overlap.sort_values(['sou_id', 'overlap_fraction'], ascending=[True, False], kind='mergesort')
+    df_result = df_overlap.drop_duplicates('sou_id')[['sou_id', 'tar_id']].reset_index(drop=True)
+
+    return df_result
+
+
+# This function is to classify entity pairs with the method of 'dist_overlap'. As in 'dist_approx', the result of the
+# distance-based method is refined, here with the overlap fraction.
+def dist_overlap(df_similarity, distance_method):
+    df_result = pd.DataFrame(columns=('sou_id', 'tar_id'))
+
+    df_dist_result = best_dist(df_similarity, distance_method)
+    df_dist_overlap = df_dist_result[df_dist_result['overlap_fraction'] >= OVERLAP_THRESHOLD]
+    for sou_id, group in df_dist_overlap.groupby(['sou_id']):
+        if len(group) == 1:
+            df_result = df_result.append(group[['sou_id', 'tar_id']], ignore_index=True)
+
+    return df_result
+
+
 # This function is to classify entity pairs with the method of 'dist_topo'.
-def dist_topo(df_similarity, text_result_file, distance_method):
+def dist_topo(df_similarity, df_matched, distance_method, sou_inns, tar_inns):
     df_result = pd.DataFrame(columns=('sou_id', 'tar_id'))
 
     df_dist_result = best_dist(df_similarity, distance_method)
 
     # First check whether there is at least one alignment in the possible entity pairs of INNs of source and target
     # entities. Then, refine the result of distance-based method with 'topo'.
-    df_dist_result['topo'] = df_dist_result.apply(refine_topo, args=(text_result_file,), axis=1)
+    matched_set = set([tuple(value) for value in df_matched.values])
+    df_dist_result['topo'] = df_dist_result.apply(refine_topo, args=(matched_set, sou_inns, tar_inns), axis=1)
     df_dist_topo = df_dist_result[df_dist_result['topo'] == True]
     for sou_id, group in df_dist_topo.groupby(['sou_id']):
         if len(group) == 1:
@@ -166,14 +205,15 @@ def dist_topo(df_similarity, text_result_file, distance_method):
 
 
 # This function is to classify entity pairs with the method of 'approx_topo'.
-def approx_topo(df_similarity, text_result_file):
+def approx_topo(df_similarity, df_matched, sou_inns, tar_inns):
     df_result = pd.DataFrame(columns=('sou_id', 'tar_id'))
 
     # Obtain the result of method 'approx'.
     df_approx = df_similarity[df_similarity['atr_within'] >= 0.8]
 
     # Refine the result of method 'approx' with 'topo'.
-    df_approx['topo'] = df_approx.apply(refine_topo, args=(text_result_file,), axis=1)
+    matched_set = set([tuple(value) for value in df_matched.values])
+    df_approx['topo'] = df_approx.apply(refine_topo, args=(matched_set, sou_inns, tar_inns), axis=1)
     df_approx_topo = df_approx[df_approx['topo'] == True]
 
     df_approx_topo_group = df_approx_topo.groupby(['sou_id'])
@@ -191,13 +231,14 @@ def approx_topo(df_similarity, text_result_file):
 
 
 # This function is to classify entity pairs with the method of 'dist_topo_approx'.
-def dist_topo_approx(df_similarity, text_result_file, distance_method):
+def dist_topo_approx(df_similarity, df_matched, distance_method, sou_inns, tar_inns):
     df_result = pd.DataFrame(columns=('sou_id', 'tar_id'))
 
     df_dist_result = best_dist(df_similarity, distance_method)
 
     # Refine the result of distance-based method with 'approx' with 'topo'.
-    df_dist_result['topo'] = df_dist_result.apply(refine_topo, args=(text_result_file,), axis=1)
+    matched_set = set([tuple(value) for value in df_matched.values])
+    df_dist_result['topo'] = df_dist_result.apply(refine_topo, args=(matched_set, sou_inns, tar_inns), axis=1)
     df_dist_approx_topo = df_dist_result[(df_dist_result['atr_within'] >= 0.8) & (df_dist_result['topo'] == True)]
     for sou_id, group in df_dist_approx_topo.groupby(['sou_id']):
         if len(group) == 1:
@@ -206,29 +247,106 @@ def dist_topo_approx(df_similarity, text_result_file, distance_method):
     return df_result
 
 
-# This function is to check whether there is at least one alignment in the INNs of source and target entities.
-def refine_topo(row, text_result_file):
-    df_text_matched = pd.read_csv(text_result_file, header=None, sep='\t')
-    df_text_matched.columns = ['sou_id', 'tar_id']
+# This function is to classify entity pairs with the method of 'assign'. Entity pairs whose approximate topological
+# relation is less than 0.8 and polyline entity pairs whose angle is not less than 45 degree are removed. The kept
+# entity pairs must all have the distance: a similarity store computed with lazy_hdv=True has no Hausdorff distance for
+# most entity pairs, and ValueError is raised for it instead of leaving these pairs out of the assignment. The kept
+# entity pairs form a sparse bipartite graph between source and target entities with the
+# distance as cost. Each connected component of the graph is solved with an optimal one-to-one assignment, which first
+# maximizes the number of alignments and then minimizes the total distance.
+def assign(df_similarity, distance_method, n_jobs=1):
+    # joblib and scipy are only imported here, so that the other methods are loaded quickly.
+    from joblib import Parallel, delayed
+    from scipy.sparse import coo_matrix
+    from scipy.sparse.csgraph import connected_components
+
+    is_line = np.asarray(df_similarity['sou_type'].isin(LINE_TYPES))
+    angle = df_similarity['angle'].values.astype(float) if 'angle' in df_similarity else np.zeros(len(df_similarity))
+    costs = df_similarity[distance_method].values.astype(float)
+    kept = (df_similarity['atr_within'].values.astype(float) >= 0.8) & (~is_line | (angle < 45))
+    if np.isnan(costs[kept]).any():
+        raise ValueError('The distance ' + distance_method + ' is missing for ' + str(int(np.isnan(costs[kept]).sum())) +
+                         ' kept entity pairs. Compute the similarity without lazy_hdv to use the method assign.')
+    instrumentation.count('assign_pairs_kept', int(kept.sum()))
+
+    # Sources and targets are numbered from 0 in the graph, and targets follow sources.
+    sou_codes, sou_nodes = np.unique(df_similarity['sou_id'].values[kept], return_inverse=True)
+    tar_codes, tar_nodes = np.unique(df_similarity['tar_id'].values[kept], return_inverse=True)
+    costs = costs[kept]
+    num_nodes = len(sou_codes) + len(tar_codes)
+    graph = coo_matrix((np.ones(len(costs)), (sou_nodes, tar_nodes + len(sou_codes))), shape=(num_nodes, num_nodes))
+    num_components, labels = connected_components(graph, directed=False)
+    instrumentation.count('assign_components', num_components)
+
+    # Entity pairs are grouped by the component of their source entity.
+    pair_components = labels[sou_nodes]
+    order = np.argsort(pair_components, kind='mergesort')
+    group_starts = np.flatnonzero(np.r_[True, pair_components[order][1:] != pair_components[order][:-1]])
+    groups = [positions for positions in np.split(order, group_starts[1:]) if len(positions) > 0]
+    component_pairs = [(sou_nodes[positions], tar_nodes[positions], costs[positions]) for positions in groups]
+
+    if len(component_pairs) > PARALLEL_COMPONENTS and n_jobs != 1:
+        assignments = Parallel(n_jobs=n_jobs)(delayed(assign_component)(*pairs) for pairs in component_pairs)
+    else:
+        assignments = [assign_component(*pairs) for pairs in component_pairs]
+
+    df_result = pd.DataFrame(columns=('sou_id', 'tar_id'))
+    if len(assignments) > 0:
+        sou_assigned = np.concatenate([assignment[0] for assignment in assignments])
+        tar_assigned = np.concatenate([assignment[1] for assignment in assignments])
+        df_result = pd.DataFrame({'sou_id': sou_codes[sou_assigned], 'tar_id': tar_codes[tar_assigned]},
+                                 columns=['sou_id', 'tar_id'])
+
+    return df_result
+
+
+# Solve the one-to-one assignment of one connected component. The component is given by the source nodes, target nodes
+# and costs of its entity pairs. Missing entity pairs get a cost higher than any assignment of existing pairs, and are
+# removed from the result.
+def assign_component(sou_nodes, tar_nodes, costs):
+    from scipy.optimize import linear_sum_assignment
+
+    sou_unique, sou_index = np.unique(sou_nodes, return_inverse=True)
+    tar_unique, tar_index = np.unique(tar_nodes, return_inverse=True)
+    missing_cost = (np.abs(costs).sum() + 1) * (min(len(sou_unique), len(tar_unique)) + 1)
+    cost_matrix = np.full((len(sou_unique), len(tar_unique)), missing_cost)
+    is_pair = np.zeros((len(sou_unique), len(tar_unique)), dtype=bool)
+    cost_matrix[sou_index, tar_index] = costs
+    is_pair[sou_index, tar_index] = True
+
+    rows, cols = linear_sum_assignment(cost_matrix)
+    assigned = is_pair[rows, cols]
+
+    return sou_unique[rows[assigned]], tar_unique[cols[assigned]]
 
+
+# This function is to check whether there is at least one alignment in the INNs of source and target entities. The
+# alignments found with textual labels are given as a set of pairs of codes.
+def refine_topo(row, matched_set, sou_inns, tar_inns):
     # Find the INNs of entities
-    sou_inns = row['topo_sou_inns']
-    tar_inns = row['topo_tar_inns']
+    sou_entity_inns = entity_inns(sou_inns, row['sou_id'])
+    tar_entity_inns = entity_inns(tar_inns, row['tar_id'])
 
     # Generate all the possible matching pairs with all the immediate surrounding entities
     possilbe_match_list = []
-    for m in range(len(sou_inns)):
-        current_sou_inns = sou_inns[m]
-        for n in range(len(tar_inns)):
-            current_tar_inns = tar_inns[n]
+    for m in range(len(sou_entity_inns)):
+        current_sou_inns = sou_entity_inns[m]
+        for n in range(len(tar_entity_inns)):
+            current_tar_inns = tar_entity_inns[n]
             possilbe_match_list.append((current_sou_inns, current_tar_inns))
 
     # Find already matched pairs existing in the result of textual label match.
     possible_match_set = set(possilbe_match_list)
-    matched_set = set([tuple(value) for value in df_text_matched.values])
     matched_inns = possible_match_set.intersection(matched_set)
 
     if len(matched_inns) == 0:
         return False
     else:
-        return True
\ No newline at end of file
+        return True
+
+
+# Obtain the codes of INNs of one entity from INNs stored as compressed sparse rows.
+def entity_inns(inns, code):
+    offsets, inn_codes = inns
+    code = int(code)
+    return inn_codes[offsets[code]:offsets[code + 1]]
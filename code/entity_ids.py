@@ -0,0 +1,58 @@
+import numpy as np
+import pandas as pd
+
+# All types of geometries stored in the categorical column of geometry types.
+GEOMETRY_TYPES = ['Point', 'LineString', 'Polygon', 'MultiPoint', 'MultiLineString', 'MultiPolygon']
+
+# Geometry types of polyline entities. The angle between polyline entities is checked by distance-based methods.
+LINE_TYPES = ['LineString', 'MultiLineString']
+
+
+# Build the ID dictionary of one map. The code of each FeaID is its position in the entity set.
+def build_id_dictionary(entity_set):
+    return pd.Index(entity_set['FeaID'].values)
+
+
+# Convert FeaIDs to int32 codes with the ID dictionary. FeaIDs which are not in the dictionary get the code -1.
+def encode_ids(id_dictionary, fea_ids):
+    return id_dictionary.get_indexer(pd.Index(fea_ids)).astype(np.int32)
+
+
+# Convert int32 codes back to FeaIDs with the ID dictionary. The code -1 of unknown FeaIDs can not be converted back,
+# and ValueError is raised for it instead of taking the last FeaID.
+def decode_ids(id_dictionary, codes):
+    codes = np.asarray(codes, dtype=np.int64)
+    if (codes < 0).any():
+        raise ValueError('Unknown entities can not be decoded: ' + str(int((codes < 0).sum())) + ' codes are negative.')
+
+    return id_dictionary.take(codes).values
+
+
+# Categorical column of the geometry types of entities.
+def geometry_types(geometries):
+    return pd.Categorical([geometry.geom_type for geometry in geometries], categories=GEOMETRY_TYPES)
+
+
+# Convert the FeaIDs of matched entity pairs to codes.
+def encode_matches(df_matched, sou_ids, tar_ids):
+    df_matched_codes = pd.DataFrame({'sou_id': encode_ids(sou_ids, df_matched.iloc[:, 0]),
+                                     'tar_id': encode_ids(tar_ids, df_matched.iloc[:, 1])})
+
+    return df_matched_codes
+
+
+# Convert the codes of matched entity pairs back to FeaIDs. This is used when the result is written in a file.
+def decode_matches(df_result, sou_ids, tar_ids):
+    df_result_ids = pd.DataFrame({'sou_id': decode_ids(sou_ids, df_result['sou_id'].values),
+                                  'tar_id': decode_ids(tar_ids, df_result['tar_id'].values)})
+
+    return df_result_ids
+
+
+# Convert the FeaIDs of a dataframe of similarity to codes.
+def encode_similarity(df_similarity, sou_ids, tar_ids):
+    df_similarity_codes = df_similarity.copy()
+    df_similarity_codes['sou_id'] = encode_ids(sou_ids, df_similarity['sou_id'])
+    df_similarity_codes['tar_id'] = encode_ids(tar_ids, df_similarity['tar_id'])
+
+    return df_similarity_codes
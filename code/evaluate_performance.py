@@ -1,5 +1,4 @@
 import pandas as pd
-import geopandas as gpd
 
 
 # Write matched result into a file named by name of matching method.
@@ -17,6 +16,8 @@ def write_result_file(df_result, method, text_result_path):
 
 # Select the ground truth with labels
 def select_ground_truth_labels(entity_set1, entity_set2, ground_truth_path):
+    # geopandas is only imported here, so that results can be evaluated without it.
+    import geopandas as gpd
     entity_set1_concated = gpd.GeoDataFrame(pd.concat(entity_set1, ignore_index=True))
     entity_set2_concated = gpd.GeoDataFrame(pd.concat(entity_set2, ignore_index=True))
     df_ground_truth = pd.read_csv(ground_truth_path, header=None, sep='\t')
@@ -4,15 +4,55 @@ import overlay_entities
 import evaluate_performance
 import pandas as pd
 import similarity_computation
-import classsification
-import pickle
+import instrumentation
+import incremental
+import similarity_store
+import entity_ids
+import geometry_normalization
+import stage_cache
+import numpy as np
+from text_label_match import textual_label_alignment
+from classify_align import alignment_classification, classification_distance_types, classification_result, \
+    read_text_matches, select_similarity_columns
+
+# Files written by 'affine_trans' with arcpy in the working directory, which are restored with its output from the
+# stage cache.
+AFFINE_SIDE_FILES = ['links.*', 'affine_trans1', 'affine_trans2']
+
+# Files written by 'overlapping_entity_pairs' in the working directory.
+OVERLAPPING_SIDE_FILES = ['intersection.*']
+
+# Classifying methods whose alignments of one source entity depend on all the other entity pairs, so that
+# 'incremental_classification' always performs them on all entity pairs: 'topo' finds alignments iteratively, and
+# 'assign' aligns each target entity with at most one source entity.
+GLOBAL_METHODS = ['topo', 'assign']
 
 
 # This function is the main function of our method. The input of it is two digitized maps, the ground truth, and string
-# of text label match method. The output is a .pkl file which stores the computed similarity between entities from two
-# input maps. One digitized map may include three vector data files (point, polyline, and polygon), or include part of
-# them.
-def execute_alignment(shapefile_list1, shapefile_list2, ground_truth, text_label_method, only_text=False):
+# of text label match method. The output is a similarity store which stores the computed similarity between entities
+# from two input maps. One digitized map may include three vector data files (point, polyline, and polygon), or
+# include part of them. The time, memory and counters of all stages are written in the JSON file report_file, and the
+# stage named profile_stage will be profiled with cProfile. inn_candidates is the method to find candidates of INNs, 'all' or
+# 'delaunay'. If lazy_hdv is True, the Hausdorff distance is only computed where method 'dist_hdv' needs it.
+# transform_method is the transformation of maps without georeferencing information, 'affine' or 'rubber_sheet'. If
+# cache_dir is given, the outputs of stages are kept in this directory, and stages whose inputs, settings and code are
+# unchanged since an earlier run are skipped.
+def execute_alignment(shapefile_list1, shapefile_list2, ground_truth, text_label_method, only_text=False,
+                      report_file='run_report.json', profile_stage=None, inn_candidates='all', lazy_hdv=False,
+                      transform_method='affine', cache_dir=None, cache_size_limit=stage_cache.CACHE_SIZE_LIMIT):
+    instrumentation.reset_report()
+    if profile_stage:
+        instrumentation.enable_profile(profile_stage, profile_stage + '.prof')
+    stage_cache.enable_cache(cache_dir, cache_size_limit)
+    with instrumentation.stage('execute_alignment'):
+        align_entity_sets(shapefile_list1, shapefile_list2, ground_truth, text_label_method, only_text, inn_candidates,
+                          lazy_hdv, transform_method)
+    instrumentation.write_report(report_file)
+
+
+# Read the entity sets of two maps and run the stages of the workflow on them.
+def align_entity_sets(shapefile_list1, shapefile_list2, ground_truth, text_label_method, only_text, inn_candidates='all',
+                      lazy_hdv=False, transform_method='affine'):
     entity_set1 = []
     entity_set2 = []
     entity_set_crs_tag = True
@@ -20,164 +60,474 @@ def execute_alignment(shapefile_list1, shapefile_list2, ground_truth, text_label
     # Obtain entities set from ShapeFiles, and examine whether they have georeferencing information. If both maps have
     # georeferencing information, this program will go to compute overlapping area and similarity directly. Otherwise,
     # these maps will be checked whether affine transformation can be employed on them.
-    for i in range(len(shapefile_list1)):
-        entity_set = gpd.read_file(shapefile_list1[i])
-        if not entity_set.empty:
-            entity_set1.append(entity_set)
-            if not entity_set.crs:
-                entity_set_crs_tag = False
-            else:
-                entity_set_crs1 = entity_set.crs
+    with instrumentation.stage('read_entities'):
+        for i in range(len(shapefile_list1)):
+            entity_set = gpd.read_file(shapefile_list1[i])
+            if not entity_set.empty:
+                entity_set1.append(entity_set)
+                if not entity_set.crs:
+                    entity_set_crs_tag = False
 
-    for i in range(len(shapefile_list2)):
-        entity_set = gpd.read_file(shapefile_list2[i])
-        if not entity_set.empty:
-            entity_set2.append(entity_set)
-            if not entity_set.crs:
-                entity_set_crs_tag = False
-            else:
-                entity_set_crs2 = entity_set.crs
+        for i in range(len(shapefile_list2)):
+            entity_set = gpd.read_file(shapefile_list2[i])
+            if not entity_set.empty:
+                entity_set2.append(entity_set)
+                if not entity_set.crs:
+                    entity_set_crs_tag = False
 
     # If only_text is True, this function will only retrieve alignments with textual labels.
     if only_text:
         ground_truth_label = evaluate_performance.select_ground_truth_labels(entity_set1, entity_set2, ground_truth)
         textual_label_alignment(entity_set1, entity_set2, text_label_method, ground_truth_label)
     else:
+        # The key of each stage is built from the key of the previous stage and the settings of the stage, so that a
+        # stage is computed again when any of its inputs is changed.
+        input_hashes = [stage_cache.file_hash(shapefile) for shapefile in list(shapefile_list1) + list(shapefile_list2)]
+        text_key = stage_cache.stage_key('textual_label_alignment', text_label_method, stage_cache.file_hash(ground_truth),
+                                         *input_hashes)
+        text_result_file = cached_text_alignment(entity_set1, entity_set2, text_label_method, ground_truth, text_key)
+
         # If two entity sets have georeference information, perform necessary CRS transformation to make the CRSs of two
         # entity sets same.
         if entity_set_crs_tag:
-            # Transform the CRS of entity_set2 to the CRS of entity_set1.
-            text_result_file = textual_label_alignment(entity_set1, entity_set2, text_label_method, ground_truth)
-            if dict.cmp(entity_set_crs1, entity_set_crs2) == 0:
-                entity_set2_overlaid = overlay_entities.transformation_crs(entity_set2, entity_set_crs1)
-            entity_set1_overlapping, entity_set2_overlapping = overlay_entities.overlapping_entity_pairs(entity_set1, entity_set2_overlaid)
-            similarity_calculation(entity_set1_overlapping, entity_set2_overlapping, text_result_file, True)
+            # Transform the CRSs of all layers to the CRS of the first layer of entity_set1. Maps are overlaid without
+            # control points, and layers which already have this CRS are not transformed.
+            with instrumentation.stage('reproject'):
+                entity_set1_overlaid = overlay_entities.transformation_crs(entity_set1, entity_set1[0].crs)
+                entity_set2_overlaid = overlay_entities.transformation_crs(entity_set2, entity_set1[0].crs)
+            overlapping_key = stage_key_after(text_key, 'overlapping_entity_pairs', 'crs')
+            with instrumentation.stage('overlapping_entity_pairs'):
+                entity_set1_overlapping, entity_set2_overlapping = stage_cache.cached(
+                    'overlapping_entity_pairs', overlapping_key,
+                    lambda: overlay_entities.overlapping_entity_pairs(entity_set1_overlaid, entity_set2_overlaid),
+                    OVERLAPPING_SIDE_FILES)
+            cached_similarity_calculation(overlapping_key, entity_set1_overlapping, entity_set2_overlapping,
+                                          text_result_file, True, inn_candidates, lazy_hdv)
         # Compute control points with alignments found with text label match. Then according to the computed control points,
         # whether maps can be transformed and overlaid will be checked.
         else:
-            text_result_file = textual_label_alignment(entity_set1, entity_set2, text_label_method, ground_truth)
-            trans_entity_set1, trans_entity_set2, overlaid = overlay_entities.affine_trans(entity_set1, entity_set2, text_result_file)
+            transform_key = stage_key_after(text_key, 'affine_trans', transform_method)
+            with instrumentation.stage('affine_trans'):
+                trans_entity_set1, trans_entity_set2, overlaid, df_control_points = stage_cache.cached(
+                    'affine_trans', transform_key,
+                    lambda: overlay_entities.affine_trans(entity_set1, entity_set2, text_result_file, transform_method),
+                    AFFINE_SIDE_FILES if transform_method == 'affine' else ())
             # If maps are overlaid, we will compute overlapping entities first, and then compute similarity between
             # overlapping entities.
             if overlaid:
-                entity_set1_overlapping, entity_set2_overlapping = overlay_entities.overlapping_entity_pairs(trans_entity_set1, trans_entity_set2)
-                similarity_calculation(entity_set1_overlapping, entity_set2_overlapping, text_result_file, overlaid)
+                overlapping_key = stage_key_after(transform_key, 'overlapping_entity_pairs')
+                with instrumentation.stage('overlapping_entity_pairs'):
+                    entity_set1_overlapping, entity_set2_overlapping = stage_cache.cached(
+                        'overlapping_entity_pairs', overlapping_key,
+                        lambda: overlay_entities.overlapping_entity_pairs(trans_entity_set1, trans_entity_set2),
+                        OVERLAPPING_SIDE_FILES)
+                cached_similarity_calculation(overlapping_key, entity_set1_overlapping, entity_set2_overlapping,
+                                              text_result_file, overlaid, inn_candidates, lazy_hdv)
             # If maps can not be overlaid, compute the similarity of feature 'topo' only.
             else:
-                similarity_calculation(trans_entity_set1, trans_entity_set2, text_result_file, overlaid)
+                cached_similarity_calculation(transform_key, trans_entity_set1, trans_entity_set2, text_result_file,
+                                              overlaid, inn_candidates)
 
 
-# With two input maps, this function is to align entities with textual labels using a certain text label
-# match method.
-def textual_label_alignment(entity_set1, entity_set2, text_label_method, ground_truth_label):
-    # Build textual label pairs of entities with the same type of geometries.
-    entity_label_pairs = text_label_match.generate_pairs_with_label(entity_set1, entity_set2)
+# Build the key of a stage from the key of the stage before it and the settings of the stage.
+def stage_key_after(previous_key, stage_name, *settings):
+    return stage_cache.stage_key(stage_name, previous_key, *settings)
 
-    # Align entities with selected textual label match method.
-    # If one machine learning method is selected, it will directly obtain the result and compute the performance.
-    machine_learning_methods = ['text_santos2018b', 'text_santos2018a', 'text_acheson2019', 'ensemble_learning']
-    if text_label_method in machine_learning_methods:
-        getattr(text_label_match, text_label_method)(entity_label_pairs, ground_truth_label)
+
+# Perform textual label alignment, or restore the file of its alignments from the stage cache.
+def cached_text_alignment(entity_set1, entity_set2, text_label_method, ground_truth, text_key):
+    def compute():
+        text_result_file = textual_label_alignment(entity_set1, entity_set2, text_label_method, ground_truth)
+        with open(text_result_file) as result_file:
+            return text_result_file, result_file.read()
+
+    text_result_file, content = stage_cache.cached('textual_label_alignment', text_key, compute)
+    with open(text_result_file, 'w') as result_file:
+        result_file.write(content)
+
+    return text_result_file
+
+
+# Compute the similarity store with 'similarity_calculation', or restore it from the stage cache.
+def cached_similarity_calculation(previous_key, entity_set1_processed, entity_set2_processed, text_result_file, overlaid,
+                                  inn_candidates='all', lazy_hdv=False):
+    similarity_key = stage_key_after(previous_key, 'similarity_calculation', overlaid, inn_candidates, lazy_hdv)
+    stage_cache.cached_directory('similarity_calculation', similarity_key, 'similarity_store',
+                                 lambda: similarity_calculation(entity_set1_processed, entity_set2_processed,
+                                                                text_result_file, overlaid, inn_candidates, lazy_hdv))
+
+
+# This function is the incremental version of 'execute_alignment' for maps whose entities are edited between runs.
+# The state of the previous run, including the alignments with textual labels, the affine transformation, the INNs
+# of entities and the similarity of entity pairs, is kept in state_file. Only the entities which are added, removed or
+# modified, and the entities whose INNs can be changed by them, are processed again. If the control points can be
+# changed by the edits, all the stages will be performed again. Maps with georeferencing information are not supported.
+def incremental_alignment(shapefile_list1, shapefile_list2, ground_truth, text_label_method, state_file='state.pkl',
+                          report_file='run_report.json'):
+    instrumentation.reset_report()
+    with instrumentation.stage('incremental_alignment'):
+        with instrumentation.stage('read_entities'):
+            entity_set1 = read_entity_sets(shapefile_list1)
+            entity_set2 = read_entity_sets(shapefile_list2)
+        entity_set1_all = gpd.GeoDataFrame(pd.concat(entity_set1, ignore_index=True))
+        entity_set2_all = gpd.GeoDataFrame(pd.concat(entity_set2, ignore_index=True))
+        hashes1 = incremental.entity_hashes(entity_set1_all)
+        hashes2 = incremental.entity_hashes(entity_set2_all)
+
+        state = incremental.load_state(state_file)
+        if state is None or state['text_label_method'] != text_label_method:
+            state = full_alignment_state(entity_set1, entity_set2, ground_truth, text_label_method)
+        else:
+            state = update_alignment_state(state, entity_set1, entity_set2, hashes1, hashes2, ground_truth)
+        state['hashes1'] = hashes1
+        state['hashes2'] = hashes2
+
+        with instrumentation.stage('write_similarity'):
+            incremental.save_state(state_file, state)
+            sou_ids = entity_ids.build_id_dictionary(state['processed1'])
+            tar_ids = entity_ids.build_id_dictionary(state['processed2'])
+            write_similarity(entity_ids.encode_similarity(state['similarity'], sou_ids, tar_ids), sou_ids, tar_ids,
+                             similarity_computation.inns_csr(state['inns1'], sou_ids),
+                             similarity_computation.inns_csr(state['inns2'], tar_ids))
+    instrumentation.write_report(report_file)
+
+
+# Read the entity sets of one map from ShapeFiles. Empty ShapeFiles are skipped.
+def read_entity_sets(shapefile_list):
+    entity_sets = []
+    for i in range(len(shapefile_list)):
+        entity_set = gpd.read_file(shapefile_list[i])
+        if not entity_set.empty:
+            entity_sets.append(entity_set)
+
+    return entity_sets
+
+
+# Perform all the stages of the workflow and keep their results as the state of incremental alignment.
+def full_alignment_state(entity_set1, entity_set2, ground_truth, text_label_method):
+    state = {'text_label_method': text_label_method, 'affine': None, 'radius': None, 'matches': {}, 'pending': {}}
+
+    text_result_file = textual_label_alignment(entity_set1, entity_set2, text_label_method, ground_truth)
+    df_text_matched = pd.read_csv(text_result_file, header=None, sep='\t')
+    df_text_matched.columns = ['sou_id', 'tar_id']
+    state['text_matches'] = [tuple(value) for value in df_text_matched.values]
+    state['control_point_matches'] = incremental.control_point_matches(state['text_matches'],
+                                                                      pd.concat(entity_set1, ignore_index=True))
+
+    with instrumentation.stage('affine_trans'):
+        trans_entity_set1, trans_entity_set2, overlaid, df_control_points = overlay_entities.affine_trans(entity_set1, entity_set2, text_result_file)
+    state['overlaid'] = overlaid
+    if overlaid:
+        state['affine'] = overlay_entities.fit_affine(df_control_points)
+        state['transformed1'] = gpd.GeoDataFrame(pd.concat(trans_entity_set1, ignore_index=True))
+        with instrumentation.stage('overlapping_entity_pairs'):
+            entity_set1_processed, entity_set2_processed = overlay_entities.overlapping_entity_pairs(trans_entity_set1, trans_entity_set2)
     else:
-        text_align_result = getattr(text_label_match, text_label_method)(entity_label_pairs)
-        text_result_file = text_label_match.labels_result_file(text_align_result, text_label_method)
-        evaluate_performance.eval_perf(text_result_file, ground_truth_label)
-        return text_result_file
+        entity_set1_processed, entity_set2_processed = trans_entity_set1, trans_entity_set2
+    state['processed1'] = entity_set1_processed
+    state['processed2'] = entity_set2_processed
+
+    with instrumentation.stage('topo'):
+        state['inns1'] = similarity_computation.entity_inns(entity_set1_processed)
+        state['inns2'] = similarity_computation.entity_inns(entity_set2_processed)
+
+    # The state is kept with FeaIDs, because codes of entities are changed when entities are added or removed.
+    with instrumentation.stage('generate_pairs'):
+        df_similarity = generate_entity_pairs(entity_set1_processed, entity_set2_processed, df_text_matched)
+    df_similarity, state['radius'] = merge_similarity(df_similarity.iloc[0:0], df_similarity, entity_set1_processed,
+                                                      entity_set2_processed, overlaid, None)
+    state['similarity'] = decode_entity_pairs(df_similarity, entity_set1_processed, entity_set2_processed)
+
+    return state
+
+
+# Update the state of the previous run with the entities which are added, removed or modified.
+def update_alignment_state(state, entity_set1, entity_set2, hashes1, hashes2, ground_truth):
+    entity_set1_all = gpd.GeoDataFrame(pd.concat(entity_set1, ignore_index=True))
+    entity_set2_all = gpd.GeoDataFrame(pd.concat(entity_set2, ignore_index=True))
+    added1, removed1, modified1 = incremental.diff_entities(state['hashes1'], hashes1)
+    added2, removed2, modified2 = incremental.diff_entities(state['hashes2'], hashes2)
+    changed1 = added1 | modified1
+    changed2 = added2 | modified2
+    print('Changed entities: %s added, %s removed, %s modified' % (len(added1) + len(added2), len(removed1) + len(removed2),
+                                                                    len(modified1) + len(modified2)))
+    if not (changed1 or changed2 or removed1 or removed2):
+        return state
+
+    # Only the label pairs including added or modified entities are matched again.
+    with instrumentation.stage('textual_label_alignment'):
+        text_matches = incremental.update_text_matches(state['text_matches'], entity_set1_all, entity_set2_all,
+                                                       changed1, changed2, removed1, removed2, state['text_label_method'])
+        text_result_file = text_label_match.labels_result_file(text_matches, state['text_label_method'])
+        evaluate_performance.eval_perf(text_result_file, ground_truth)
+
+    # Control points are computed with the alignments of points and polylines found with textual labels. If these
+    # alignments or their entities are changed, the transformation has to be computed again, and so does everything
+    # after it. Alignments of polygons do not yield control points, so they only make their entity pairs dirty.
+    control_point_matches = incremental.control_point_matches(text_matches, entity_set1_all)
+    control_points_changed = control_point_matches != state.get('control_point_matches') or any(
+        [sou_id in modified1 or tar_id in modified2 for sou_id, tar_id in control_point_matches])
+    if control_points_changed:
+        return full_alignment_state(entity_set1, entity_set2, ground_truth, state['text_label_method'])
+
+    # Otherwise, the fitted transformation is applied to the added and modified entities of the first map only.
+    if state['overlaid']:
+        transformed_geometries = dict(zip(state['transformed1']['FeaID'], state['transformed1'].geometry))
+        changed_set1 = overlay_entities.affine_entities(entity_set1_all[entity_set1_all['FeaID'].isin(changed1)], state['affine'])
+        transformed_geometries.update(zip(changed_set1['FeaID'], changed_set1.geometry))
+        trans_entity_set1 = entity_set1_all.copy()
+        trans_entity_set1['geometry'] = [transformed_geometries[fea_id] for fea_id in entity_set1_all['FeaID']]
+        state['transformed1'] = trans_entity_set1
+        with instrumentation.stage('overlapping_entity_pairs'):
+            entity_set1_processed, entity_set2_processed = overlay_entities.overlapping_entity_pairs([trans_entity_set1], [entity_set2_all])
+    else:
+        entity_set1_processed, entity_set2_processed = entity_set1_all, entity_set2_all
+
+    # Entities entering or leaving the overlapping area are also regarded as changed. Entities which are newly matched
+    # or no longer matched with textual labels need new entity pairs, but their INNs are not changed.
+    old_ids1 = set(state['processed1']['FeaID'])
+    old_ids2 = set(state['processed2']['FeaID'])
+    inn_changed1 = changed1 | removed1 | (old_ids1 ^ set(entity_set1_processed['FeaID']))
+    inn_changed2 = changed2 | removed2 | (old_ids2 ^ set(entity_set2_processed['FeaID']))
+    dirty1 = inn_changed1 | (set([sou_id for sou_id, tar_id in state['text_matches']]) ^ set([sou_id for sou_id, tar_id in text_matches]))
+    dirty2 = inn_changed2 | (set([tar_id for sou_id, tar_id in state['text_matches']]) ^ set([tar_id for sou_id, tar_id in text_matches]))
+
+    with instrumentation.stage('topo'):
+        inns1 = incremental.update_inns(entity_set1_processed, state['processed1'], state['inns1'], inn_changed1)
+        inns2 = incremental.update_inns(entity_set2_processed, state['processed2'], state['inns2'], inn_changed2)
+
+    # Entity pairs without dirty entities are kept, and entity pairs including dirty entities are built again. Their
+    # entities are all in the processed entity sets, so the kept entity pairs are converted to the new codes.
+    df_similarity_old = state['similarity']
+    df_kept = df_similarity_old[~df_similarity_old['sou_id'].isin(dirty1) & ~df_similarity_old['tar_id'].isin(dirty2)]
+    df_kept = entity_ids.encode_similarity(df_kept, entity_ids.build_id_dictionary(entity_set1_processed),
+                                           entity_ids.build_id_dictionary(entity_set2_processed))
+    df_text_matched = pd.DataFrame(text_matches, columns=['sou_id', 'tar_id'])
+    with instrumentation.stage('generate_pairs'):
+        dirty_set1 = entity_set1_processed['FeaID'].isin(dirty1).values
+        dirty_set2 = entity_set2_processed['FeaID'].isin(dirty2).values
+        df_new = pd.concat([generate_entity_pairs(entity_set1_processed, entity_set2_processed, df_text_matched, dirty_set1),
+                            generate_entity_pairs(entity_set1_processed, entity_set2_processed, df_text_matched,
+                                                  ~dirty_set1, dirty_set2)], ignore_index=True)
+    df_similarity, radius = merge_similarity(df_kept, df_new, entity_set1_processed, entity_set2_processed,
+                                             state['overlaid'], state['radius'])
+    df_similarity = decode_entity_pairs(df_similarity, entity_set1_processed, entity_set2_processed)
+
+    # Source entities whose rows of similarity or INNs are changed will be classified again.
+    changed_sources = incremental.changed_sources(df_similarity_old, df_similarity, state['inns1'], inns1,
+                                                  state['inns2'], inns2)
+    for key in state['matches']:
+        state['pending'][key] = state['pending'].get(key, set()) | changed_sources
+    if set(text_matches) != set(state['text_matches']):
+        state['matches'] = {}
+        state['pending'] = {}
+
+    state.update({'text_matches': text_matches, 'control_point_matches': control_point_matches,
+                  'processed1': entity_set1_processed, 'processed2': entity_set2_processed,
+                  'inns1': inns1, 'inns2': inns2, 'similarity': df_similarity, 'radius': radius})
+
+    return state
+
+
+# Convert the codes of entity pairs back to FeaIDs of the processed entities.
+def decode_entity_pairs(df_similarity, entity_set1_processed, entity_set2_processed):
+    df_similarity['sou_id'] = entity_set1_processed['FeaID'].values[df_similarity['sou_id'].values]
+    df_similarity['tar_id'] = entity_set2_processed['FeaID'].values[df_similarity['tar_id'].values]
+
+    return df_similarity
+
+
+# Compute the similarity of new entity pairs and merge them with the entity pairs kept from the previous run. Both are
+# given with the codes of entities in the processed entity sets. The approximate topological relation of all entity
+# pairs is computed again only if the radius of buffers is changed.
+def merge_similarity(df_kept, df_new, entity_set1_processed, entity_set2_processed, overlaid, radius):
+    df_new = df_new.copy()
+    df_kept = df_kept.copy()
+    if overlaid:
+        entity_set1_processed = geometry_normalization.normalized(entity_set1_processed)
+        entity_set2_processed = geometry_normalization.normalized(entity_set2_processed)
+        with instrumentation.stage('distance'):
+            if len(df_new) != 0:
+                distance_metrics(df_new, entity_set1_processed, entity_set2_processed)
+        with instrumentation.stage('topological_relations'):
+            relation_metrics(df_new, entity_set1_processed, entity_set2_processed)
+        df_new['recompute'] = True
+        df_kept['recompute'] = False
+        df_similarity = pd.concat([df_kept, df_new], ignore_index=True, sort=False)
+        # Concatenating with an empty dataframe can turn the boolean columns into objects, which would be stored as
+        # float64, so they are converted back. Missing values become False.
+        for column in similarity_computation.RELATION_COLUMNS:
+            df_similarity[column] = np.asarray(df_similarity[column].values == True, dtype=bool)
+
+        with instrumentation.stage('atr_within'):
+            new_radius = similarity_computation.compute_radius(df_similarity)
+            if new_radius != radius:
+                df_similarity['recompute'] = True
+            recompute = df_similarity['recompute'].astype(bool)
+            if recompute.any():
+                df_similarity.loc[recompute, 'atr_within'] = similarity_computation.atr_within(
+                    df_similarity[recompute], entity_set1_processed, entity_set2_processed, new_radius)
+        df_similarity = df_similarity.drop(columns=['recompute'])
+    else:
+        new_radius = radius
+        df_similarity = pd.concat([df_kept, df_new], ignore_index=True, sort=False)
+
+    return df_similarity, new_radius
 
 
 # With the processed entities, this function is to compute similarity depending on the different cases of processing
-# entities.
-def similarity_calculation(entity_set1_processed, entity_set2_processed, text_result_file, overlaid):
+# entities. FeaIDs of the processed entities are converted to int32 codes with the ID dictionary of each map, and the
+# dataframe of similarity is built with these codes. inn_candidates is passed to 'entity_inns', and lazy_hdv to
+# 'distance_metrics'. Entities which have not been normalized by 'overlapping_entity_pairs' are normalized first.
+def similarity_calculation(entity_set1_processed, entity_set2_processed, text_result_file, overlaid, inn_candidates='all',
+                           lazy_hdv=False):
+    with instrumentation.stage('normalize_geometry'):
+        entity_set1_processed = geometry_normalization.normalized(entity_set1_processed)
+        entity_set2_processed = geometry_normalization.normalized(entity_set2_processed)
     df_text_matched = pd.read_csv(text_result_file, header=None, sep='\t')
     df_text_matched.columns = ['sou_id', 'tar_id']
+    sou_ids = entity_ids.build_id_dictionary(entity_set1_processed)
+    tar_ids = entity_ids.build_id_dictionary(entity_set2_processed)
 
     # This piece of code is to build all possible entity pairs of two maps, and those entities which have been matched
     # using textual label match method will not be aligned further.
-    df_similarity = pd.DataFrame(columns=('sou_id', 'tar_id', 'sou_feature', 'tar_feature'))
-    num = 0
-    for index1, item1 in entity_set1_processed.iterrows():
-        if len(df_text_matched[df_text_matched['sou_id'].eq(item1['FeaID'])]) != 0:
-            continue
-        for index2, item2 in entity_set2_processed.iterrows():
-            if len(df_text_matched[df_text_matched['tar_id'].eq(item2['FeaID'])]) != 0:
-                continue
-            if item1.geometry.geom_type == item2.geometry.geom_type:
-                df_similarity.loc[num] = [item1['FeaID'], item2['FeaID'], item1.geometry, item2.geometry]
-                num = num + 1
+    with instrumentation.stage('generate_pairs'):
+        df_similarity = generate_entity_pairs(entity_set1_processed, entity_set2_processed, df_text_matched)
 
     # If two maps can be overlaid, four types of distance, angle of polyline entities, approximate topological
     # relations, and INNs will be computed. Otherwise, only INNs can be computed.
     if overlaid:
-        df_similarity['dist_edc'] = df_similarity.apply(similarity_computation.edc, axis=1)
-        df_similarity['dist_edv'] = df_similarity.apply(similarity_computation.edv, axis=1)
-        df_similarity['dist_hdv'] = df_similarity.apply(similarity_computation.hdv, axis=1)
-        df_similarity['dist_ednp'] = df_similarity.apply(similarity_computation.ednp, axis=1)
-        df_similarity['angle'] = df_similarity.apply(similarity_computation.angle_lines, axis=1)
+        with instrumentation.stage('distance'):
+            distance_metrics(df_similarity, entity_set1_processed, entity_set2_processed, lazy_hdv)
 
-        radius = similarity_computation.compute_radius(df_similarity)
-        df_similarity['atr_within'] = df_similarity.apply(similarity_computation.atr_within, args=(radius, ), axis=1)
+        with instrumentation.stage('atr_within'):
+            radius = similarity_computation.compute_radius(df_similarity)
+            df_similarity['atr_within'] = similarity_computation.atr_within(df_similarity, entity_set1_processed,
+                                                                            entity_set2_processed, radius)
 
-        df_similarity['topo_sou_inns'] = df_similarity.apply(similarity_computation.topo_sou, args=(entity_set1_processed,), axis=1)
-        df_similarity['topo_tar_inns'] = df_similarity.apply(similarity_computation.topo_tar, args=(entity_set2_processed,), axis=1)
+        with instrumentation.stage('topological_relations'):
+            relation_metrics(df_similarity, entity_set1_processed, entity_set2_processed)
+
+    # INNs are computed once for each entity of the entity pairs, and are stored as compressed sparse rows.
+    with instrumentation.stage('topo'):
+        sou_inns = similarity_computation.entity_inns(entity_set1_processed, sou_ids[np.unique(df_similarity['sou_id'].values)],
+                                                      inn_candidates)
+        tar_inns = similarity_computation.entity_inns(entity_set2_processed, tar_ids[np.unique(df_similarity['tar_id'].values)],
+                                                      inn_candidates)
+        sou_inns = similarity_computation.inns_csr(sou_inns, sou_ids)
+        tar_inns = similarity_computation.inns_csr(tar_inns, tar_ids)
+
+    # The computed dataframe of similarity will be written in a similarity store.
+    with instrumentation.stage('write_similarity'):
+        write_similarity(df_similarity, sou_ids, tar_ids, sou_inns, tar_inns)
+
+
+# Build entity pairs of the same geometry type from two entity sets. Entities which have been matched with textual
+# labels are not paired. Entity pairs are represented by the codes of entities, which are their positions in the entity
+# sets, and are ordered by source entity and then target entity. The boolean arrays sou_selected and tar_selected can
+# be used to only pair a part of entities. The geometries and derived columns are kept in the normalized entity sets,
+# and are looked up with the codes of entities.
+def generate_entity_pairs(entity_set1_processed, entity_set2_processed, df_text_matched, sou_selected=None, tar_selected=None):
+    entity_set1_processed = geometry_normalization.normalized(entity_set1_processed)
+    entity_set2_processed = geometry_normalization.normalized(entity_set2_processed)
+    sou_types = entity_set1_processed['geometry_type'].values
+    tar_types = entity_set2_processed['geometry_type'].values
+    sou_candidates = ~entity_set1_processed['FeaID'].isin(df_text_matched['sou_id']).values
+    tar_candidates = ~entity_set2_processed['FeaID'].isin(df_text_matched['tar_id']).values
+    if sou_selected is not None:
+        sou_candidates = sou_candidates & sou_selected
+    if tar_selected is not None:
+        tar_candidates = tar_candidates & tar_selected
+
+    sou_codes = []
+    tar_codes = []
+    for geometry_type in entity_ids.GEOMETRY_TYPES:
+        sou_type_codes = np.flatnonzero(sou_candidates & (sou_types == geometry_type))
+        tar_type_codes = np.flatnonzero(tar_candidates & (tar_types == geometry_type))
+        sou_codes.append(np.repeat(sou_type_codes, len(tar_type_codes)))
+        tar_codes.append(np.tile(tar_type_codes, len(sou_type_codes)))
+    sou_codes = np.concatenate(sou_codes).astype(np.int32)
+    tar_codes = np.concatenate(tar_codes).astype(np.int32)
+    order = np.lexsort((tar_codes, sou_codes))
+    sou_codes = sou_codes[order]
+    tar_codes = tar_codes[order]
+
+    df_similarity = pd.DataFrame({'sou_id': sou_codes, 'tar_id': tar_codes, 'sou_type': sou_types.take(sou_codes)},
+                                 columns=['sou_id', 'tar_id', 'sou_type'])
+    num_sources = len(entity_set1_processed) if sou_selected is None else int(sou_selected.sum())
+    num_targets = len(entity_set2_processed) if tar_selected is None else int(tar_selected.sum())
+    instrumentation.count('pairs_generated', len(df_similarity))
+    instrumentation.count('pairs_pruned', num_sources * num_targets - len(df_similarity))
+
+    return df_similarity
+
+
+# Compute four types of distance and the angle of polyline entities for each entity pair of the codes of entities in
+# the normalized entity sets. If lazy_hdv is True, the Hausdorff distance is only computed for the entity pairs which
+# can have the shortest distance of their source entity.
+def distance_metrics(df_similarity, entity_set1_processed, entity_set2_processed, lazy_hdv=False):
+    entity_sets = (entity_set1_processed, entity_set2_processed)
+    df_similarity['dist_edc'] = similarity_computation.edc_distances(df_similarity, *entity_sets)
+    df_similarity['dist_edv'] = similarity_computation.edv_distances(df_similarity, *entity_sets)
+    if lazy_hdv:
+        df_similarity['dist_hdv'] = similarity_computation.lazy_hdv(df_similarity, *entity_sets)
     else:
-        df_similarity['topo_sou_inns'] = df_similarity.apply(similarity_computation.topo_sou, args=(entity_set1_processed,), axis=1)
-        df_similarity['topo_tar_inns'] = df_similarity.apply(similarity_computation.topo_tar, args=(entity_set2_processed,), axis=1)
-
-    # The computed dataframe of similarity will be written in a pkl file.
-    with open('all.pkl', 'wb') as pickle_file:
-        pickle.dump(df_similarity, pickle_file)
-
-
-# With the pkl file containing the computed similarity scores, this function makes alignment classification.
-def alignment_classification(df_similarity_path, method_name, text_result_file, ground_truth, distance_method=None):
-    # Read the pkl file of similarity.
-    with open(df_similarity_path, 'rb') as pickle_file:
-        df_similarity = pickle.load(pickle_file)
-
-    # Corresponding columns of similarity will be chosen according to the name of used classification method.
-    method_dict = {'topo': ['topo_sou_inns', 'topo_tar_inns'], 'dist': ['dist_edc', 'dist_edv', 'dist_hdv', 'dist_ednp', 'angle'],
-                       'approx': ['atr_within'], 'dist_topo': [distance_method, 'angle', 'topo_sou_inns', 'topo_tar_inns'], 'dist_approx': [distance_method, 'angle', 'atr_within'],
-                       'approx_topo': ['atr_within', 'topo_sou_inns', 'topo_tar_inns'],
-                       'dist_topo_approx': [distance_method, 'angle', 'topo_sou_inns', 'topo_tar_inns', 'atr_within']}
-    selected_columns = sum([['sou_id'], ['tar_id'], method_dict[method_name]], [])
-    df_similarity = df_similarity[selected_columns]
-
-    # Different names of classification method will call the corresponding classification function, obtain the result,
-    # and evaluate the performance.
-    if method_name == 'topo':
-        df_matched = pd.read_csv(text_result_file, header=None, sep='\t')
-        df_result = getattr(classsification, method_name)(df_similarity, df_matched)
-        result_file = evaluate_performance.write_result_file(df_result, method_name, text_result_file)
-        evaluate_performance.eval_perf(result_file, ground_truth)
-
-    if method_name == 'dist':
-        distance_types = ['dist_edc', 'dist_edv', 'dist_ednp', 'dist_hdv']
-        for i in range(len(distance_types)):
-            df_result = getattr(classsification, method_name)(df_similarity, distance_types[i])
+        df_similarity['dist_hdv'] = similarity_computation.hdv_distances(df_similarity, *entity_sets)
+    df_similarity['dist_ednp'] = similarity_computation.ednp_distances(df_similarity, *entity_sets)
+    df_similarity['angle'] = similarity_computation.angle_lines(df_similarity, *entity_sets)
+
+
+# Compute the flags of topological relations and the overlap fraction for each entity pair of the codes of entities in
+# the normalized entity sets.
+def relation_metrics(df_similarity, entity_set1_processed, entity_set2_processed):
+    for column, values in similarity_computation.topological_relations(df_similarity, entity_set1_processed,
+                                                                       entity_set2_processed).items():
+        df_similarity[column] = values
+
+
+# Write the dataframe of similarity, the ID dictionaries and the INNs of entities of two maps in the similarity store.
+def write_similarity(df_similarity, sou_ids, tar_ids, sou_inns, tar_inns, similarity_file='similarity_store'):
+    similarity_store.write_store(similarity_file, df_similarity, sou_ids, tar_ids, sou_inns, tar_inns)
+
+
+# This function is the incremental version of 'alignment_classification' which works with the state of
+# 'incremental_alignment'. The result of each classification method is kept in state_file, and only the source
+# entities whose similarity has changed since the last classification are classified again. The methods of
+# GLOBAL_METHODS are always performed on all entity pairs.
+def incremental_classification(method_name, text_result_file, ground_truth, distance_method=None,
+                               state_file='state.pkl', report_file='run_report.json'):
+    instrumentation.reset_report()
+    state = incremental.load_state(state_file)
+    sou_ids = entity_ids.build_id_dictionary(state['processed1'])
+    tar_ids = entity_ids.build_id_dictionary(state['processed2'])
+    df_similarity = entity_ids.encode_similarity(state['similarity'], sou_ids, tar_ids)
+    df_similarity = select_similarity_columns(df_similarity, method_name, distance_method)
+    df_matched = read_text_matches(text_result_file, sou_ids, tar_ids)
+    sou_inns = similarity_computation.inns_csr(state['inns1'], sou_ids)
+    tar_inns = similarity_computation.inns_csr(state['inns2'], tar_ids)
+
+    # Results are kept with FeaIDs in the state.
+    with instrumentation.stage('classification_' + method_name):
+        for distance_type in classification_distance_types(method_name, distance_method):
+            key = (method_name, distance_type)
+            df_previous = state['matches'].get(key)
+            if method_name in GLOBAL_METHODS or df_previous is None:
+                df_result = classification_result(df_similarity, method_name, df_matched, distance_type, sou_inns, tar_inns)
+                df_result = entity_ids.decode_matches(df_result, sou_ids, tar_ids)
+            else:
+                changed_sources = entity_ids.encode_ids(sou_ids, list(state['pending'].get(key, set())))
+                df_changed = df_similarity[df_similarity['sou_id'].isin(changed_sources)]
+                df_result = df_previous[~df_previous['sou_id'].isin(state['pending'].get(key, set()))]
+                if len(df_changed) != 0:
+                    df_changed_result = classification_result(df_changed, method_name, df_matched, distance_type,
+                                                              sou_inns, tar_inns)
+                    df_result = pd.concat([df_result, entity_ids.decode_matches(df_changed_result, sou_ids, tar_ids)],
+                                          ignore_index=True)
+            state['matches'][key] = df_result
+            state['pending'][key] = set()
+
             result_file = evaluate_performance.write_result_file(df_result, method_name, text_result_file)
             evaluate_performance.eval_perf(result_file, ground_truth)
 
-    if method_name == 'approx':
-        df_result = getattr(classsification, method_name)(df_similarity)
-        result_file = evaluate_performance.write_result_file(df_result, method_name, text_result_file)
-        evaluate_performance.eval_perf(result_file, ground_truth)
-
-    if method_name == 'dist_topo':
-        df_result = getattr(classsification, method_name)(df_similarity, text_result_file, distance_method)
-        result_file = evaluate_performance.write_result_file(df_result, method_name, text_result_file)
-        evaluate_performance.eval_perf(result_file, ground_truth)
-
-    if method_name == 'dist_approx':
-        df_result = getattr(classsification, method_name)(df_similarity, distance_method)
-        result_file = evaluate_performance.write_result_file(df_result, method_name, text_result_file)
-        evaluate_performance.eval_perf(result_file, ground_truth)
-
-    if method_name == 'approx_topo':
-        df_result = getattr(classsification, method_name)(df_similarity, text_result_file)
-        result_file = evaluate_performance.write_result_file(df_result, method_name, text_result_file)
-        evaluate_performance.eval_perf(result_file, ground_truth)
-
-    if method_name == 'dist_topo_approx':
-        df_result = getattr(classsification, method_name)(df_similarity, text_result_file, distance_method)
-        result_file = evaluate_performance.write_result_file(df_result, method_name, text_result_file)
-        evaluate_performance.eval_perf(result_file, ground_truth)
\ No newline at end of file
+    incremental.save_state(state_file, state)
+    instrumentation.write_report(report_file, merge=True)
@@ -0,0 +1,76 @@
+import numpy as np
+import entity_ids
+
+# Columns derived from the geometry of each entity by 'normalize_entities'. 'valid' tells whether the geometry can be
+# used by later stages, which is the case if it was valid as read or was repaired, and 'repaired' tells whether it was
+# repaired. 'vertices' is the array of all vertices of the entity.
+DERIVED_COLUMNS = ['geometry_type', 'valid', 'repaired', 'centroid_x', 'centroid_y', 'minx', 'miny', 'maxx', 'maxy', 'length', 'area',
+                   'vertices']
+
+# Normalize the geometries of an entity set once after they are read or transformed. Invalid polygons are repaired,
+# and a repaired geometry is used as a valid one. The geometry type, centroid, bounds, length, area and vertices of each
+# entity are computed, so that later stages read these columns instead of computing them again. Multipart geometries
+# are kept as one entity, and the vertices of all their parts are included. Empty geometries have no centroid, and
+# their centroid and bounds are NaN.
+def normalize_entities(entity_set):
+    entity_set = entity_set.copy()
+    geometries = list(entity_set.geometry)
+    valid_as_read = np.array([geometry.is_valid for geometry in geometries], dtype=bool)
+    geometries = [geometry if valid_as_read[i] else repair_geometry(geometry) for i, geometry in enumerate(geometries)]
+    valid = np.array([valid_as_read[i] or geometry.is_valid for i, geometry in enumerate(geometries)], dtype=bool)
+    entity_set['geometry'] = geometries
+
+    centroids = [geometry.centroid for geometry in geometries]
+    bounds = np.array([geometry.bounds for geometry in geometries], dtype=np.float64).reshape(-1, 4)
+    entity_set['geometry_type'] = entity_ids.geometry_types(geometries)
+    entity_set['valid'] = valid
+    entity_set['repaired'] = valid & ~valid_as_read
+    entity_set['centroid_x'] = np.array([np.nan if centroid.is_empty else centroid.x for centroid in centroids],
+                                        dtype=np.float64)
+    entity_set['centroid_y'] = np.array([np.nan if centroid.is_empty else centroid.y for centroid in centroids],
+                                        dtype=np.float64)
+    for i, column in enumerate(['minx', 'miny', 'maxx', 'maxy']):
+        entity_set[column] = bounds[:, i]
+    entity_set['length'] = np.array([geometry.length for geometry in geometries], dtype=np.float64)
+    entity_set['area'] = np.array([geometry.area for geometry in geometries], dtype=np.float64)
+    vertices = np.empty(len(geometries), dtype=object)
+    vertices[:] = [geometry_vertices(geometry) for geometry in geometries]
+    entity_set['vertices'] = vertices
+
+    return entity_set
+
+
+# Normalize an entity set if it has not been normalized yet.
+def normalized(entity_set):
+    if all([column in entity_set.columns for column in DERIVED_COLUMNS]):
+        return entity_set
+
+    return normalize_entities(entity_set)
+
+
+# Repair an invalid polygon with a buffer of zero width. If the repaired polygon is empty, or the geometry is not a
+# polygon, the geometry is kept.
+def repair_geometry(geometry):
+    if geometry.geom_type not in ['Polygon', 'MultiPolygon']:
+        return geometry
+    repaired = geometry.buffer(0)
+    if repaired.is_empty:
+        return geometry
+
+    return repaired
+
+
+# All the vertices of a geometry as an array of shape (n, 2). Interiors of polygons and parts of multipart geometries
+# are included. An empty geometry has no vertices.
+def geometry_vertices(geometry):
+    if geometry.is_empty:
+        return np.zeros((0, 2))
+    if geometry.geom_type.startswith('Multi') or geometry.geom_type == 'GeometryCollection':
+        parts = [geometry_vertices(part) for part in geometry.geoms]
+        return np.vstack(parts) if len(parts) > 0 else np.zeros((0, 2))
+    if geometry.geom_type == 'Polygon':
+        rings = [geometry.exterior] + list(geometry.interiors)
+        return np.vstack([np.asarray(ring.coords)[:, :2] for ring in rings])
+
+    return np.asarray(geometry.coords)[:, :2].reshape(-1, 2)
+
@@ -0,0 +1,134 @@
+import hashlib
+import os
+import pickle
+import pandas as pd
+import text_label_match
+import similarity_computation
+
+
+# Compute a content hash for each entity with its geometry and textual label. The hashes of two runs are compared to
+# find the entities which are edited.
+def entity_hashes(entity_set):
+    hashes = {}
+    for index, row in entity_set.iterrows():
+        content = row.geometry.wkb + str(row['Label']).encode('utf-8')
+        hashes[row['FeaID']] = hashlib.sha1(content).hexdigest()
+
+    return hashes
+
+
+# Find the entities which are added, removed and modified since the previous run.
+def diff_entities(old_hashes, new_hashes):
+    added = set(new_hashes) - set(old_hashes)
+    removed = set(old_hashes) - set(new_hashes)
+    modified = set([fea_id for fea_id in new_hashes if fea_id in old_hashes and old_hashes[fea_id] != new_hashes[fea_id]])
+
+    return added, removed, modified
+
+
+# Read the state of the previous run. None will be returned if there is no previous run.
+def load_state(state_file):
+    if not os.path.exists(state_file):
+        return None
+    with open(state_file, 'rb') as pickle_file:
+        return pickle.load(pickle_file)
+
+
+# Write the state of the current run.
+def save_state(state_file, state):
+    with open(state_file, 'wb') as pickle_file:
+        pickle.dump(state, pickle_file)
+
+
+# Update the alignments found with textual labels. Alignments of unchanged entities are kept, and only the label pairs
+# which include one added or modified entity are matched again.
+# Machine learning methods write their result with the ground truth and cannot match only some label pairs, so they
+# are not supported.
+def update_text_matches(old_matches, entity_set1, entity_set2, changed1, changed2, removed1, removed2, text_label_method):
+    if text_label_method in text_label_match.MACHINE_LEARNING_METHODS:
+        raise ValueError('The textual label method ' + text_label_method + ' is a machine learning method, which cannot '
+                         'be used for incremental alignment.')
+    kept_matches = [(sou_id, tar_id) for sou_id, tar_id in old_matches
+                    if sou_id not in changed1 and sou_id not in removed1 and
+                    tar_id not in changed2 and tar_id not in removed2]
+
+    changed_set1 = entity_set1[entity_set1['FeaID'].isin(changed1)]
+    unchanged_set1 = entity_set1[~entity_set1['FeaID'].isin(changed1)]
+    changed_set2 = entity_set2[entity_set2['FeaID'].isin(changed2)]
+    label_pairs = text_label_match.generate_pairs_with_label([changed_set1], [entity_set2]) + \
+        text_label_match.generate_pairs_with_label([unchanged_set1], [changed_set2])
+    new_matches = getattr(text_label_match, text_label_method)(label_pairs)
+
+    return kept_matches + new_matches
+
+
+# The alignments found with textual labels which yield control points, which are alignments of points or polylines
+# as in 'overlay_entities.generate_control_points'. The geometry type is taken from the source entity.
+def control_point_matches(matches, entity_set1):
+    areas = dict(zip(entity_set1['FeaID'], [geometry.area for geometry in entity_set1.geometry]))
+
+    return set([(sou_id, tar_id) for sou_id, tar_id in matches if sou_id in areas and areas[sou_id] == 0.0])
+
+
+# Update INNs of all the entities of one map after some entities are changed. The changed entities are those added,
+# removed or modified, or those entering or leaving the overlapping area. INNs of changed entities are computed again.
+# For an unchanged entity, the nearest segment to another unchanged entity is only tested again when a changed entity
+# can block or unblock it: an INN stays an INN unless the new geometry of a changed entity intersects the segment, and
+# a non-INN is only tested against all entities when the old geometry of a changed entity intersected the segment.
+def update_inns(entity_set, old_entity_set, old_inns, changed_ids):
+    new_geometries = list(zip(entity_set['FeaID'], entity_set.geometry))
+    changed_new = [(fea_id, geometry) for fea_id, geometry in new_geometries if fea_id in changed_ids]
+    changed_old = [geometry for fea_id, geometry in zip(old_entity_set['FeaID'], old_entity_set.geometry)
+                   if fea_id in changed_ids]
+
+    inns = {}
+    for fea_id, geometry in new_geometries:
+        if fea_id in changed_ids or fea_id not in old_inns:
+            inns[fea_id] = similarity_computation.immediate_neighbours(geometry, fea_id, entity_set)
+            continue
+
+        current_inns = []
+        old_entity_inns = set(old_inns[fea_id])
+        for other_id, other_geometry in new_geometries:
+            if other_id == fea_id:
+                continue
+            if other_id in changed_ids:
+                is_immediate = similarity_computation.is_immediate_neighbour(geometry, fea_id, other_geometry,
+                                                                             other_id, entity_set)[0]
+            else:
+                segment = similarity_computation.nearest_segments(geometry, other_geometry)
+                if other_id in old_entity_inns:
+                    is_immediate = not any([segment.intersects(changed_geometry) for changed_id, changed_geometry in changed_new])
+                elif any([segment.intersects(changed_geometry) for changed_geometry in changed_old]):
+                    is_immediate = similarity_computation.is_immediate_neighbour(geometry, fea_id, other_geometry,
+                                                                                 other_id, entity_set)[0]
+                else:
+                    is_immediate = False
+            if is_immediate:
+                current_inns.append(other_id)
+        inns[fea_id] = current_inns
+
+    return inns
+
+
+# Organize rows of similarity by source entity.
+def similarity_rows(df_similarity):
+    rows = {}
+    for values in df_similarity.itertuples(index=False):
+        row = tuple([None if pd.isnull(value) else value for value in values])
+        rows.setdefault(row[0], set()).add(row)
+
+    return rows
+
+
+# Find the source entities which need to be classified again: their rows of similarity are different between two runs,
+# their INNs are changed, or INNs of their target entities are changed.
+def changed_sources(df_similarity_old, df_similarity_new, old_inns1, new_inns1, old_inns2, new_inns2):
+    rows_old = similarity_rows(df_similarity_old)
+    rows_new = similarity_rows(df_similarity_new)
+    sources = set([sou_id for sou_id in set(rows_old) | set(rows_new) if rows_old.get(sou_id) != rows_new.get(sou_id)])
+    sources = sources | set([sou_id for sou_id in new_inns1 if old_inns1.get(sou_id) != new_inns1[sou_id]])
+    changed_targets = set([tar_id for tar_id in new_inns2 if old_inns2.get(tar_id) != new_inns2[tar_id]])
+    sources = sources | set(df_similarity_new[df_similarity_new['tar_id'].isin(changed_targets)]['sou_id'])
+
+    return sources
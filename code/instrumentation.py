@@ -0,0 +1,101 @@
+import cProfile
+import json
+import os
+import sys
+import time
+from contextlib import contextmanager
+
+# The module 'resource' is only available on Unix. On other platforms the peak memory will not be recorded.
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# run_report is used to store the time and memory of each stage and all the counters of the current run.
+run_report = {'stages': [], 'counters': {}}
+
+# profile_setting is used to store the name of the stage which will be profiled with cProfile, the output file and the
+# number of profiles written so far, which is added to the output file name so that no profile is overwritten.
+profile_setting = {'stage': None, 'output': None, 'index': 0}
+
+
+# Clear the recorded stages, counters and profiled stage to start a new run.
+def reset_report():
+    run_report['stages'] = []
+    run_report['counters'] = {}
+    profile_setting['stage'] = None
+    profile_setting['output'] = None
+
+
+# Attach cProfile to one stage. The profile of this stage will be written in the output file, which can be read with
+# the module 'pstats'.
+def enable_profile(stage_name, output_file='profile.prof'):
+    profile_setting['stage'] = stage_name
+    profile_setting['output'] = output_file
+
+
+# Peak resident set size of the current process in MB since it started. ru_maxrss is in bytes on macOS and in kilobytes
+# on Linux and other Unix platforms.
+def peak_rss():
+    if resource is None:
+        return None
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        return round(max_rss / (1024.0 * 1024.0), 2)
+    return round(max_rss / 1024.0, 2)
+
+
+# Record the wall time, CPU time and memory of one stage of the workflow. The peak memory of a process can not be reset,
+# so 'max_rss_mb' is the running maximum of the process at the end of the stage, and 'max_rss_increase_mb' is how much
+# the stage raised it. A stage which allocates less than an earlier stage has an increase of 0.
+@contextmanager
+def stage(stage_name):
+    profiler = None
+    if profile_setting['stage'] == stage_name:
+        profiler = cProfile.Profile()
+        profiler.enable()
+
+    rss_start = peak_rss()
+    wall_start = time.perf_counter()
+    cpu_start = time.process_time()
+    try:
+        yield
+    finally:
+        wall_time = time.perf_counter() - wall_start
+        cpu_time = time.process_time() - cpu_start
+        rss_end = peak_rss()
+        record = {'stage': stage_name, 'wall_time': round(wall_time, 4), 'cpu_time': round(cpu_time, 4),
+                  'max_rss_mb': rss_end,
+                  'max_rss_increase_mb': round(rss_end - rss_start, 2) if rss_end is not None else None}
+        if profiler is not None:
+            profiler.disable()
+            profile_setting['index'] += 1
+            output_root, output_ext = os.path.splitext(profile_setting['output'])
+            output_file = '%s_%d%s' % (output_root, profile_setting['index'], output_ext)
+            profiler.dump_stats(output_file)
+            record['profile'] = output_file
+        run_report['stages'].append(record)
+
+
+# Increase a counter of the current run, such as the number of generated pairs or built buffers.
+def count(counter_name, number=1):
+    run_report['counters'][counter_name] = run_report['counters'].get(counter_name, 0) + number
+
+
+# Write the report of the current run into a JSON file. If merge is True and the file exists, the stages and counters
+# of the current run are added to the report in the file, such as the report of the alignment run before
+# classification.
+def write_report(report_file='run_report.json', merge=False):
+    report = run_report
+    if merge and os.path.exists(report_file):
+        with open(report_file, 'r') as json_file:
+            report = json.load(json_file)
+        report['stages'] = report.get('stages', []) + run_report['stages']
+        counters = report.get('counters', {})
+        for counter_name, number in run_report['counters'].items():
+            counters[counter_name] = counters.get(counter_name, 0) + number
+        report['counters'] = counters
+    with open(report_file, 'w') as json_file:
+        json.dump(report, json_file, indent=2)
+
+    return report_file
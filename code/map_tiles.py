@@ -0,0 +1,296 @@
+import json
+import os
+import re
+from collections import OrderedDict
+import numpy as np
+import pandas as pd
+from shapely.affinity import affine_transform
+from shapely.geometry import Point
+from shapely.geometry import box
+import instrumentation
+
+# Width and height in pixels of the tiles of the pyramid.
+TILE_SIZE = 256
+
+# Tiles read from the pyramid are kept in a LRU cache. The total size of the cached tiles is kept under the limit.
+tile_cache = {'tiles': OrderedDict(), 'bytes': 0, 'limit': 256 * 1024 * 1024}
+
+# Opened memory maps of the levels of pyramids, keyed by (cache_dir, level).
+level_arrays = {}
+
+
+# Convert a scanned map image into a tiled pyramid in cache_dir. Level 0 has the resolution of the image, and each next
+# level halves the width and height by averaging 2x2 pixels, until the level fits in one tile. Each level is a memory
+# mapped .npy file of shape (tile rows, tile columns, tile size, tile size, bands), so that each tile is contiguous.
+# The image is read tile by tile with windowed reads and is never loaded as a whole.
+def build_pyramid(image_file, cache_dir, tile_size=TILE_SIZE):
+    import rasterio
+    from rasterio.windows import Window
+
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir)
+    clear_cache(cache_dir)
+
+    with rasterio.open(image_file) as dataset:
+        width = dataset.width
+        height = dataset.height
+        bands = dataset.count
+        dtype = np.dtype(dataset.dtypes[0])
+        transform = list(dataset.transform)[:6]
+
+        # Level 0 is filled by reading the image tile by tile. Partial tiles on the border are padded with the pixels
+        # on their edges.
+        with instrumentation.stage('pyramid_level_0'):
+            rows, cols = tile_grid(width, height, tile_size)
+            level_array = np.lib.format.open_memmap(os.path.join(cache_dir, 'level_0.npy'), mode='w+', dtype=dtype,
+                                                    shape=(rows, cols, tile_size, tile_size, bands))
+            for row in range(rows):
+                for col in range(cols):
+                    window = Window(col * tile_size, row * tile_size, min(tile_size, width - col * tile_size),
+                                    min(tile_size, height - row * tile_size))
+                    tile = np.transpose(dataset.read(window=window), (1, 2, 0))
+                    level_array[row, col] = np.pad(tile, ((0, tile_size - tile.shape[0]), (0, tile_size - tile.shape[1]),
+                                                          (0, 0)), mode='edge')
+            level_array.flush()
+
+    levels = [{'file': 'level_0.npy', 'width': width, 'height': height, 'rows': rows, 'cols': cols}]
+    while levels[-1]['rows'] > 1 or levels[-1]['cols'] > 1:
+        with instrumentation.stage('pyramid_level_' + str(len(levels))):
+            levels.append(downsample_level(cache_dir, levels[-1], len(levels), tile_size, bands, dtype))
+
+    manifest = {'image': os.path.abspath(image_file), 'width': width, 'height': height, 'bands': bands,
+                'dtype': dtype.name, 'tile_size': tile_size, 'transform': transform, 'levels': levels}
+    with open(os.path.join(cache_dir, 'manifest.json'), 'w') as manifest_file:
+        json.dump(manifest, manifest_file, indent=2)
+
+    return manifest
+
+
+# Build the next level of a pyramid from the previous level. Each tile of the next level is built from 2x2 tiles of
+# the previous level, which are read from the memory map of the previous level. Only the pixels within the image are
+# averaged: missing tiles beyond the last row or column and the padding of partial tiles are not mixed into the
+# average. As in level 0, partial tiles on the border are padded with the pixels on their edges.
+def downsample_level(cache_dir, previous_level, level, tile_size, bands, dtype):
+    previous_array = np.load(os.path.join(cache_dir, previous_level['file']), mmap_mode='r')
+    width = (previous_level['width'] + 1) // 2
+    height = (previous_level['height'] + 1) // 2
+    rows, cols = tile_grid(width, height, tile_size)
+    level_file = 'level_' + str(level) + '.npy'
+    level_array = np.lib.format.open_memmap(os.path.join(cache_dir, level_file), mode='w+', dtype=dtype,
+                                            shape=(rows, cols, tile_size, tile_size, bands))
+
+    for row in range(rows):
+        for col in range(cols):
+            block = np.zeros((2 * tile_size, 2 * tile_size, bands), dtype=np.float64)
+            for i in range(2):
+                for j in range(2):
+                    if 2 * row + i < previous_level['rows'] and 2 * col + j < previous_level['cols']:
+                        block[i * tile_size:(i + 1) * tile_size, j * tile_size:(j + 1) * tile_size] = \
+                            previous_array[2 * row + i, 2 * col + j]
+
+            # Pixels of the block within the previous level are counted, and the sum of each 2x2 pixels is divided by
+            # their number.
+            valid_rows = np.arange(2 * tile_size) + 2 * row * tile_size < previous_level['height']
+            valid_cols = np.arange(2 * tile_size) + 2 * col * tile_size < previous_level['width']
+            valid = np.outer(valid_rows, valid_cols).astype(np.float64)
+            block = block * valid[:, :, np.newaxis]
+            sums = block.reshape(tile_size, 2, tile_size, 2, bands).sum(axis=(1, 3))
+            counts = valid.reshape(tile_size, 2, tile_size, 2).sum(axis=(1, 3))
+            tile_height = min(tile_size, height - row * tile_size)
+            tile_width = min(tile_size, width - col * tile_size)
+            tile = sums[:tile_height, :tile_width] / counts[:tile_height, :tile_width, np.newaxis]
+            tile = np.pad(tile, ((0, tile_size - tile_height), (0, tile_size - tile_width), (0, 0)), mode='edge')
+            if np.issubdtype(dtype, np.integer):
+                tile = np.round(tile)
+            level_array[row, col] = tile.astype(dtype)
+    level_array.flush()
+
+    return {'file': level_file, 'width': width, 'height': height, 'rows': rows, 'cols': cols}
+
+
+# The number of rows and columns of tiles covering an image.
+def tile_grid(width, height, tile_size):
+    return (height + tile_size - 1) // tile_size, (width + tile_size - 1) // tile_size
+
+
+# Read the manifest of a pyramid.
+def read_manifest(cache_dir):
+    with open(os.path.join(cache_dir, 'manifest.json')) as manifest_file:
+        return json.load(manifest_file)
+
+
+# Set the limit in bytes of the total size of the cached tiles.
+def set_cache_limit(limit):
+    tile_cache['limit'] = limit
+    evict_tiles()
+
+
+# Read one tile of a level of a pyramid. The tile is copied from the memory map of the level and kept in the LRU cache.
+def read_tile(cache_dir, level, row, col):
+    key = (cache_dir, level, row, col)
+    if key in tile_cache['tiles']:
+        tile_cache['tiles'].move_to_end(key)
+        instrumentation.count('tile_cache_hits')
+        return tile_cache['tiles'][key]
+
+    if (cache_dir, level) not in level_arrays:
+        level_arrays[(cache_dir, level)] = np.load(os.path.join(cache_dir, 'level_' + str(level) + '.npy'), mmap_mode='r')
+    tile = np.array(level_arrays[(cache_dir, level)][row, col])
+    instrumentation.count('tiles_read')
+
+    tile_cache['tiles'][key] = tile
+    tile_cache['bytes'] = tile_cache['bytes'] + tile.nbytes
+    evict_tiles()
+
+    return tile
+
+
+# Remove the cached tiles and memory maps of the pyramid in cache_dir, which are out of date when it is built again.
+def clear_cache(cache_dir):
+    for key in [key for key in level_arrays if key[0] == cache_dir]:
+        del level_arrays[key]
+    for key in [key for key in tile_cache['tiles'] if key[0] == cache_dir]:
+        tile = tile_cache['tiles'].pop(key)
+        tile_cache['bytes'] = tile_cache['bytes'] - tile.nbytes
+
+
+# Remove the least recently used tiles until the total size of cached tiles is under the limit.
+def evict_tiles():
+    while tile_cache['bytes'] > tile_cache['limit'] and len(tile_cache['tiles']) > 0:
+        key, tile = tile_cache['tiles'].popitem(last=False)
+        tile_cache['bytes'] = tile_cache['bytes'] - tile.nbytes
+
+
+# Read a window of a level of a pyramid. The window (col_off, row_off, width, height) is in pixels of the level, and is
+# clipped to the level. Only the tiles intersecting the window are read.
+def read_window(cache_dir, manifest, level, window):
+    tile_size = manifest['tile_size']
+    level_info = manifest['levels'][level]
+    col_off = int(max(0, np.floor(window[0])))
+    row_off = int(max(0, np.floor(window[1])))
+    col_end = int(min(level_info['width'], np.ceil(window[0] + window[2])))
+    row_end = int(min(level_info['height'], np.ceil(window[1] + window[3])))
+    image = np.zeros((max(0, row_end - row_off), max(0, col_end - col_off), manifest['bands']), dtype=manifest['dtype'])
+
+    for row in range(row_off // tile_size, (row_end - 1) // tile_size + 1):
+        for col in range(col_off // tile_size, (col_end - 1) // tile_size + 1):
+            tile = read_tile(cache_dir, level, row, col)
+            # Intersection of the tile and the window in pixels of the level.
+            top = max(row_off, row * tile_size)
+            bottom = min(row_end, (row + 1) * tile_size)
+            left = max(col_off, col * tile_size)
+            right = min(col_end, (col + 1) * tile_size)
+            image[top - row_off:bottom - row_off, left - col_off:right - col_off] = \
+                tile[top - row * tile_size:bottom - row * tile_size, left - col * tile_size:right - col * tile_size]
+
+    return image, (col_off, row_off, col_end - col_off, row_end - row_off)
+
+
+# Select the coarsest level of a pyramid whose resolution is still finer than the output. viewport_width is the width
+# of the viewport in pixels of level 0.
+def select_level(manifest, viewport_width, output_width):
+    level = 0
+    while level + 1 < len(manifest['levels']) and viewport_width / 2.0 ** (level + 1) >= output_width:
+        level = level + 1
+
+    return level
+
+
+# The affine transformation from map coordinates to pixels of level 0 in the order used by shapely
+# [a, b, d, e, xoff, yoff]. It is the inverse of the transformation of the image, which is the identity for images
+# without georeferencing information.
+def image_map_to_pixel(manifest):
+    a, b, c, d, e, f = manifest['transform']
+    inverse = np.linalg.inv(np.array([[a, b, c], [d, e, f], [0.0, 0.0, 1.0]]))
+
+    return [inverse[0][0], inverse[0][1], inverse[1][0], inverse[1][1], inverse[0][2], inverse[1][2]]
+
+
+# Render a viewport of a scanned map with the entities of two maps, the found alignments and the links of control
+# points, and save the figure in output_file. The viewport (minx, miny, maxx, maxy) is in map coordinates, and
+# map_to_pixel is the affine transformation from map coordinates to pixels of the image (see 'image_map_to_pixel').
+# Both entity sets must be in the same coordinates, e.g. the transformed entity sets of 'affine_trans'. result_file is
+# a file of alignments written by the classification, and df_control_points are the control points of 'affine_trans'.
+# Only the tiles of the level selected for output_width are read.
+def render_alignments(cache_dir, output_file, viewport, entity_set1, entity_set2, result_file=None,
+                      df_control_points=None, map_to_pixel=None, output_width=1024):
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+
+    manifest = read_manifest(cache_dir)
+    if map_to_pixel is None:
+        map_to_pixel = image_map_to_pixel(manifest)
+
+    # The window of the viewport in pixels of level 0 and of the selected level.
+    viewport_box = box(*viewport)
+    viewport_pixels = affine_transform(viewport_box, map_to_pixel).bounds
+    level = select_level(manifest, viewport_pixels[2] - viewport_pixels[0], output_width)
+    scale = 2.0 ** level
+    level_window = (viewport_pixels[0] / scale, viewport_pixels[1] / scale,
+                    (viewport_pixels[2] - viewport_pixels[0]) / scale, (viewport_pixels[3] - viewport_pixels[1]) / scale)
+    with instrumentation.stage('read_tiles'):
+        image, window = read_window(cache_dir, manifest, level, level_window)
+
+    figure, axes = plt.subplots(figsize=(output_width / 100.0, output_width / 100.0 * max(1, image.shape[0]) /
+                                         max(1, image.shape[1])), dpi=100)
+    if image.size > 0:
+        axes.imshow(image[:, :, :3] if image.shape[2] >= 3 else image[:, :, 0], cmap='gray',
+                    extent=(window[0] * scale, (window[0] + window[2]) * scale,
+                            (window[1] + window[3]) * scale, window[1] * scale))
+
+    # Entities are drawn in pixels of level 0.
+    for entity_set, color in [(entity_set1, 'red'), (entity_set2, 'blue')]:
+        for geometry in entity_set.geometry:
+            if geometry.intersects(viewport_box):
+                draw_geometry(axes, affine_transform(geometry, map_to_pixel), color)
+
+    # Found alignments are drawn as links between representative points of matched entities.
+    if result_file is not None:
+        points1 = dict(zip(entity_set1['FeaID'], entity_set1.geometry.representative_point()))
+        points2 = dict(zip(entity_set2['FeaID'], entity_set2.geometry.representative_point()))
+        df_result = pd.read_csv(result_file, header=None, sep='\t')
+        for sou_id, tar_id in df_result.values:
+            if sou_id in points1 and tar_id in points2:
+                if points1[sou_id].intersects(viewport_box) or points2[tar_id].intersects(viewport_box):
+                    draw_link(axes, affine_transform(points1[sou_id], map_to_pixel),
+                              affine_transform(points2[tar_id], map_to_pixel), 'green')
+
+    # Links of control points are drawn from the control point of the first map to the control point of the second map.
+    if df_control_points is not None:
+        for index, row in df_control_points.iterrows():
+            draw_link(axes, affine_transform(control_point(row['cp1']), map_to_pixel),
+                      affine_transform(control_point(row['cp2']), map_to_pixel), 'orange')
+
+    axes.set_xlim(viewport_pixels[0], viewport_pixels[2])
+    axes.set_ylim(viewport_pixels[3], viewport_pixels[1])
+    axes.set_axis_off()
+    figure.savefig(output_file, bbox_inches='tight')
+    plt.close(figure)
+
+
+# Draw the boundary of a geometry in pixels.
+def draw_geometry(axes, geometry, color):
+    if geometry.geom_type.startswith('Multi') or geometry.geom_type == 'GeometryCollection':
+        for part in geometry.geoms:
+            draw_geometry(axes, part, color)
+    elif geometry.geom_type == 'Polygon':
+        for ring in [geometry.exterior] + list(geometry.interiors):
+            axes.plot(*ring.xy, color=color, linewidth=0.8)
+    elif geometry.geom_type == 'Point':
+        axes.plot(geometry.x, geometry.y, marker='o', markersize=2, color=color)
+    else:
+        axes.plot(*geometry.xy, color=color, linewidth=0.8)
+
+
+# Draw a link between two points in pixels.
+def draw_link(axes, point1, point2, color):
+    axes.plot([point1.x, point2.x], [point1.y, point2.y], color=color, linewidth=0.8)
+    axes.plot(point2.x, point2.y, marker='o', markersize=2, color=color)
+
+
+# Convert the coordinates of a control point, which are a list with one coordinate tuple, to a shapely point.
+def control_point(coordinates):
+    coordinates = re.sub(r'[\[()\]]', '', str(coordinates)).split(',')
+
+    return Point(float(coordinates[0]), float(coordinates[1]))
@@ -1,4 +1,3 @@
-import arcpy
 import geopandas as gpd
 import shapely
 import csv
@@ -8,13 +7,34 @@ from shapely.geometry import Point
 import re
 from shapely.geometry import MultiPoint
 import shutil
-from shapely.validation import explain_validity
-
-
-# Affine transformation with the generated control points.
-def affine_trans(entity_set1, entity_set2, text_result_file):
+import numpy as np
+from shapely.affinity import affine_transform
+from shapely.geometry import Polygon
+from scipy.spatial import Delaunay
+import instrumentation
+import geometry_normalization
+from functools import partial
+import pyproj
+
+# pyproj.Transformer is only available in pyproj 2.1 or later. pyproj.transform is used with older versions.
+try:
+    from pyproj import Transformer
+except ImportError:
+    Transformer = None
+
+# crs_transformers is used to store the function reprojecting coordinates for each pair of CRSs.
+crs_transformers = {}
+
+
+# Affine transformation with the generated control points. The filtered control points used by the final
+# transformation are also returned. If transform_method is 'rubber_sheet', the entities are transformed without arcpy:
+# the control points are filtered with a fitted affine transformation, and the final transformation is the piecewise
+# affine rubber sheeting of 'rubber_sheet_entities'.
+def affine_trans(entity_set1, entity_set2, text_result_file, transform_method='affine'):
     # Compute control points with the result of textual label match.
-    df_control_points = generate_control_points(entity_set1, entity_set2, text_result_file)
+    with instrumentation.stage('generate_control_points'):
+        df_control_points = generate_control_points(entity_set1, entity_set2, text_result_file)
+    instrumentation.count('control_points', len(df_control_points))
 
     # Examine whether rubber sheeting can be performed to further adjust the spatial positions of the entities.
     # This also means whether entities can be overlaid.
@@ -26,39 +46,63 @@ def affine_trans(entity_set1, entity_set2, text_result_file):
         overlaid = False
         entity_set1 = gpd.GeoDataFrame(pd.concat(entity_set1, ignore_index=True))
         entity_set2 = gpd.GeoDataFrame(pd.concat(entity_set2, ignore_index=True))
-        return entity_set1, entity_set2, overlaid
+        return entity_set1, entity_set2, overlaid, df_control_points
 
     # If the number of found control points is greater than 3, affine transformation will be performed. In order to
     # remove potentially wrong found control points, this process includes three steps.
     # The first step is to perform an initial affine transformation.
-    links_sour_tar(df_control_points)  # Generate map links using all found control points.
-    folder_affine_trans('affine_trans1')  # New a folder to store the result of affine transformation.
-    trans_entity_set1 = []
-    # Each shapefile of the first dataset will be transformed.
-    for i in range(len(entity_set1)):
-        # Copy the shapefile to be transformed.
-        locals()['gdf_' + str(i)] = entity_set1[i].copy()
-        locals().get('gdf_' + str(i)).to_file('affine_trans1/gdf_' + str(i) + '.shp')
-        # Perform affine transformation.
-        arcpy.TransformFeatures_edit(in_features='affine_trans1/gdf_' + str(i) + '.shp', in_link_features="links.shp", method='AFFINE')
-        trans_entity_set1.append(gpd.read_file('affine_trans1/gdf_' + str(i) + '.shp'))
+    if transform_method == 'rubber_sheet':
+        return rubber_sheet_trans(entity_set1, entity_set2, df_control_points)
+    # arcpy is only imported when it is used, so that other stages can be run on machines without ArcGIS.
+    import arcpy
+    with instrumentation.stage('transform_features1'):
+        links_sour_tar(df_control_points)  # Generate map links using all found control points.
+        folder_affine_trans('affine_trans1')  # New a folder to store the result of affine transformation.
+        trans_entity_set1 = []
+        # Each shapefile of the first dataset will be transformed.
+        for i in range(len(entity_set1)):
+            # Copy the shapefile to be transformed.
+            locals()['gdf_' + str(i)] = entity_set1[i].copy()
+            locals().get('gdf_' + str(i)).to_file('affine_trans1/gdf_' + str(i) + '.shp')
+            # Perform affine transformation.
+            arcpy.TransformFeatures_edit(in_features='affine_trans1/gdf_' + str(i) + '.shp', in_link_features="links.shp", method='AFFINE')
+            trans_entity_set1.append(gpd.read_file('affine_trans1/gdf_' + str(i) + '.shp'))
 
     # Filter control points based on spatial distances of the control points computed with the transformed result.
     trans_entity_set2 = entity_set2
-    df_control_points_filtered = filter_cp(trans_entity_set1, trans_entity_set2, df_control_points)
+    with instrumentation.stage('filter_cp'):
+        df_control_points_filtered = filter_cp(trans_entity_set1, trans_entity_set2, df_control_points)
 
     # Affine transformation again with filtered control points.
-    links_sour_tar(df_control_points_filtered)
-    folder_affine_trans('affine_trans2')
-    trans_entity_set1 = []
-    for i in range(len(entity_set1)):
-        locals()['gdf_' + str(i)] = entity_set1[i].copy()
-        locals().get('gdf_' + str(i)).to_file('affine_trans2/gdf_' + str(i) + '.shp')
-        arcpy.TransformFeatures_edit(in_features='affine_trans2/gdf_' + str(i) + '.shp',
-                                       in_link_features="links.shp", method='AFFINE')
-        trans_entity_set1.append(gpd.read_file('affine_trans2/gdf_' + str(i) + '.shp'))
+    with instrumentation.stage('transform_features2'):
+        links_sour_tar(df_control_points_filtered)
+        folder_affine_trans('affine_trans2')
+        trans_entity_set1 = []
+        for i in range(len(entity_set1)):
+            locals()['gdf_' + str(i)] = entity_set1[i].copy()
+            locals().get('gdf_' + str(i)).to_file('affine_trans2/gdf_' + str(i) + '.shp')
+            arcpy.TransformFeatures_edit(in_features='affine_trans2/gdf_' + str(i) + '.shp',
+                                           in_link_features="links.shp", method='AFFINE')
+            trans_entity_set1.append(gpd.read_file('affine_trans2/gdf_' + str(i) + '.shp'))
+
+    return trans_entity_set1, trans_entity_set2, overlaid, df_control_points_filtered
+
+
+# The steps of 'affine_trans' with rubber sheeting. The initial transformation is the affine transformation fitted with
+# all control points, and the final transformation is rubber sheeting with the filtered control points.
+def rubber_sheet_trans(entity_set1, entity_set2, df_control_points):
+    with instrumentation.stage('transform_features1'):
+        affine_parameters = fit_affine(df_control_points)
+        trans_entity_set1 = [affine_entities(entity_set, affine_parameters) for entity_set in entity_set1]
+
+    trans_entity_set2 = entity_set2
+    with instrumentation.stage('filter_cp'):
+        df_control_points_filtered = filter_cp(trans_entity_set1, trans_entity_set2, df_control_points)
 
-    return trans_entity_set1, trans_entity_set2, overlaid
+    with instrumentation.stage('transform_features2'):
+        trans_entity_set1 = [rubber_sheet_entities(entity_set, df_control_points_filtered) for entity_set in entity_set1]
+
+    return trans_entity_set1, trans_entity_set2, True, df_control_points_filtered
 
 
 # Compute control points based on the matched entities with labels.
@@ -182,64 +226,216 @@ def links_sour_tar(df_control_points):
     links_gdf.to_file("links.shp")
 
 
-# For maps which have georeferencing information, if necessary, make the CRSs of maps same by CRS transformation.
+# Fit the parameters of affine transformation from source map to target map with control points by least squares,
+# which is the same fit as the method 'AFFINE' of arcpy. The parameters are in the order used by shapely
+# [a, b, d, e, xoff, yoff].
+def fit_affine(df_control_points):
+    source_points, target_points = control_point_arrays(df_control_points)
+    source_points = np.c_[source_points, np.ones(len(source_points))]
+
+    solution = np.linalg.lstsq(source_points, target_points, rcond=None)[0]
+
+    return [solution[0][0], solution[1][0], solution[0][1], solution[1][1], solution[2][0], solution[2][1]]
+
+
+# Coordinates of control points of source map and target map as two arrays of shape (n, 2).
+def control_point_arrays(df_control_points):
+    source_points = []
+    target_points = []
+    for index, row in df_control_points.iterrows():
+        coordinates1 = re.sub('[\[()\]]', '', str(row['cp1'])).split(',')
+        coordinates2 = re.sub('[\[()\]]', '', str(row['cp2'])).split(',')
+        source_points.append([float(coordinates1[0]), float(coordinates1[1])])
+        target_points.append([float(coordinates2[0]), float(coordinates2[1])])
+
+    return np.array(source_points).reshape(-1, 2), np.array(target_points).reshape(-1, 2)
+
+
+# Rubber sheeting of an entity set with control points. The control points of the source map are triangulated with
+# Delaunay triangulation, and each triangle is transformed with the affine transformation which maps its vertices to
+# the control points of the target map. Vertices outside the convex hull of the control points are transformed with
+# the affine transformation fitted with all control points. The vertices of all entities are transformed together.
+def rubber_sheet_entities(entity_set, df_control_points):
+    source_points, target_points = control_point_arrays(df_control_points)
+    affine_parameters = fit_affine(df_control_points)
+
+    coordinate_arrays = []
+    for geometry in entity_set.geometry:
+        coordinate_arrays.extend(geometry_coordinates(geometry))
+    lengths = [len(coordinates) for coordinates in coordinate_arrays]
+    coordinates = np.vstack(coordinate_arrays) if len(coordinate_arrays) > 0 else np.zeros((0, 2))
+    instrumentation.count('vertices_transformed', len(coordinates))
+
+    transformed = piecewise_affine(coordinates, source_points, target_points, affine_parameters)
+    transformed_arrays = iter(np.split(transformed, np.cumsum(lengths)[:-1]) if len(lengths) > 0 else [])
+
+    entity_set_transformed = entity_set.copy()
+    entity_set_transformed['geometry'] = [rebuild_geometry(geometry, transformed_arrays) for geometry in entity_set.geometry]
+
+    return entity_set_transformed
+
+
+# Transform points with the piecewise affine transformation of triangles of control points. Each point is located in
+# its triangle, and is transformed with its barycentric coordinates in the triangle. Points outside all triangles are
+# transformed with affine_parameters. If the control points can not be triangulated, all points are transformed with
+# affine_parameters.
+def piecewise_affine(points, source_points, target_points, affine_parameters):
+    a, b, d, e, xoff, yoff = affine_parameters
+    transformed = np.c_[a * points[:, 0] + b * points[:, 1] + xoff, d * points[:, 0] + e * points[:, 1] + yoff]
+
+    try:
+        triangulation = Delaunay(source_points)
+    except (RuntimeError, ValueError, IndexError):
+        return transformed
+
+    simplices = triangulation.find_simplex(points)
+    inside = simplices >= 0
+    instrumentation.count('vertices_outside_hull', int((~inside).sum()))
+    affine_matrices = triangulation.transform[simplices[inside]]
+    barycentric = np.einsum('ijk,ik->ij', affine_matrices[:, :2, :], points[inside] - affine_matrices[:, 2, :])
+    barycentric = np.c_[barycentric, 1 - barycentric.sum(axis=1)]
+    transformed[inside] = np.einsum('ij,ijk->ik', barycentric, target_points[triangulation.simplices[simplices[inside]]])
+
+    return transformed
+
+
+# The coordinate arrays of a geometry: one array for a point or a line, and one array for each ring of a polygon.
+# Parts of multipart geometries follow each other.
+def geometry_coordinates(geometry):
+    if geometry.geom_type.startswith('Multi') or geometry.geom_type == 'GeometryCollection':
+        return sum([geometry_coordinates(part) for part in geometry.geoms], [])
+    if geometry.geom_type == 'Polygon':
+        return [np.asarray(ring.coords)[:, :2] for ring in [geometry.exterior] + list(geometry.interiors)]
+
+    return [np.asarray(geometry.coords)[:, :2]]
+
+
+# Build a geometry of the same type as geometry with transformed coordinate arrays, which are taken from the iterator
+# coordinate_arrays in the order of 'geometry_coordinates'.
+def rebuild_geometry(geometry, coordinate_arrays):
+    if geometry.geom_type.startswith('Multi') or geometry.geom_type == 'GeometryCollection':
+        return type(geometry)([rebuild_geometry(part, coordinate_arrays) for part in geometry.geoms])
+    if geometry.geom_type == 'Polygon':
+        exterior = next(coordinate_arrays)
+        return Polygon(exterior, [next(coordinate_arrays) for ring in geometry.interiors])
+    if geometry.geom_type == 'Point':
+        return Point(next(coordinate_arrays)[0])
+
+    return type(geometry)(next(coordinate_arrays))
+
+
+# Transform the geometries of an entity set with fitted affine parameters.
+def affine_entities(entity_set, affine_parameters):
+    entity_set_transformed = entity_set.copy()
+    entity_set_transformed['geometry'] = [affine_transform(geometry, affine_parameters) for geometry in entity_set.geometry]
+
+    return entity_set_transformed
+
+
+# For maps which have georeferencing information, make the CRSs of all layers the same as entity_set_crs. Layers which
+# are already in entity_set_crs are kept. The coordinates of all layers with the same CRS are reprojected together in
+# one call of the transformer of their CRS.
 def transformation_crs(entity_set2, entity_set_crs):
-    entity_set_transformed = []
-    for item in entity_set2:
-        item.to_crs(entity_set_crs)
-        entity_set_transformed.append(item)
+    entity_set_transformed = list(entity_set2)
+    target_key = crs_key(entity_set_crs)
+    layers = {}
+    for i, item in enumerate(entity_set2):
+        if crs_key(item.crs) != target_key:
+            layers.setdefault(crs_key(item.crs), []).append(i)
+
+    for source_key, positions in layers.items():
+        source_crs = entity_set2[positions[0]].crs
+        coordinate_arrays = []
+        for i in positions:
+            for geometry in entity_set2[i].geometry:
+                coordinate_arrays.extend(geometry_coordinates(geometry))
+        lengths = [len(coordinates) for coordinates in coordinate_arrays]
+        coordinates = np.vstack(coordinate_arrays) if len(coordinate_arrays) > 0 else np.zeros((0, 2))
+        instrumentation.count('vertices_reprojected', len(coordinates))
+
+        transformed = crs_transformer(source_crs, entity_set_crs)(coordinates)
+        transformed_arrays = iter(np.split(transformed, np.cumsum(lengths)[:-1]) if len(lengths) > 0 else [])
+        for i in positions:
+            geometries = [rebuild_geometry(geometry, transformed_arrays) for geometry in entity_set2[i].geometry]
+            entity_set_transformed[i] = gpd.GeoDataFrame(entity_set2[i].drop(columns='geometry'), geometry=geometries,
+                                                         crs=entity_set_crs)
 
     return entity_set_transformed
 
 
-# Search the entities which are within the overlapping area of two entity sets. Only entities within the overlapping
-# area will be processed further.
-def overlapping_entity_pairs(entity_set1_overlaid, entity_set2_overlaid):
-    entity_set1_overlaid = gpd.GeoDataFrame(pd.concat(entity_set1_overlaid, ignore_index=True))
-    entity_set2_overlaid = gpd.GeoDataFrame(pd.concat(entity_set2_overlaid, ignore_index=True))
-    all_vertices1 = []
-    all_vertices2 = []
+# A key of a CRS which is the same for equal CRSs. CRSs read by geopandas are dictionaries of PROJ parameters or CRS
+# objects of pyproj.
+def crs_key(crs):
+    if isinstance(crs, dict):
+        return ' '.join(['+%s=%s' % (key, value) for key, value in sorted(crs.items())])
+    if hasattr(crs, 'to_wkt'):
+        return crs.to_wkt()
 
-    # Obtain vertices of all entities to be matched.
-    for index, row in entity_set1_overlaid.iterrows():
-        if row.geometry.geom_type == 'Polygon':
-            all_vertices1.append(list(row.geometry.exterior.coords))
-        else:
-            all_vertices1.append(list(row.geometry.coords))
-    all_vertices1 = MultiPoint(sum(all_vertices1, []))
+    return str(crs)
 
-    for index, row in entity_set2_overlaid.iterrows():
-        if row.geometry.geom_type == 'Polygon':
-            all_vertices2.append(list(row.geometry.exterior.coords))
+
+# Build the function which reprojects an array of coordinates of shape (n, 2) from source_crs to target_crs. One
+# function is built for each pair of CRSs and kept in crs_transformers. pyproj.Transformer is used if the installed
+# pyproj has it, and pyproj.transform otherwise.
+def crs_transformer(source_crs, target_crs):
+    key = (crs_key(source_crs), crs_key(target_crs))
+    if key not in crs_transformers:
+        if Transformer is not None:
+            transformer = Transformer.from_crs(pyproj.CRS.from_user_input(source_crs),
+                                               pyproj.CRS.from_user_input(target_crs), always_xy=True)
+            transform = transformer.transform
         else:
-            all_vertices2.append(list(row.geometry.coords))
-    all_vertices2 = MultiPoint(sum(all_vertices2, []))
+            source_proj = pyproj.Proj(source_crs, preserve_units=True)
+            target_proj = pyproj.Proj(target_crs, preserve_units=True)
+            transform = partial(pyproj.transform, source_proj, target_proj)
+        crs_transformers[key] = lambda coordinates: np.column_stack(transform(coordinates[:, 0], coordinates[:, 1])) \
+            if len(coordinates) > 0 else coordinates
+        instrumentation.count('crs_transformers_built')
+
+    return crs_transformers[key]
 
-    # Compute overlapping area by computing the intersection area of convex_hulls which are generated with all vertices.
+
+# Search the entities which are within the overlapping area of two entity sets. Only entities within the overlapping
+# area will be processed further. Entities are normalized first, and the vertices, bounds and validity of entities are
+# read from their derived columns.
+def overlapping_entity_pairs(entity_set1_overlaid, entity_set2_overlaid):
+    entity_set1_overlaid = gpd.GeoDataFrame(pd.concat(entity_set1_overlaid, ignore_index=True))
+    entity_set2_overlaid = gpd.GeoDataFrame(pd.concat(entity_set2_overlaid, ignore_index=True))
+    with instrumentation.stage('normalize_geometry'):
+        entity_set1_overlaid = geometry_normalization.normalized(entity_set1_overlaid)
+        entity_set2_overlaid = geometry_normalization.normalized(entity_set2_overlaid)
+
+    # Compute overlapping area by computing the intersection area of convex_hulls which are generated with all vertices
+    # of entities to be matched.
+    all_vertices1 = MultiPoint([tuple(vertex) for vertex in np.vstack(list(entity_set1_overlaid['vertices']))])
+    all_vertices2 = MultiPoint([tuple(vertex) for vertex in np.vstack(list(entity_set2_overlaid['vertices']))])
     all_vertices1_convexhull = all_vertices1.convex_hull
     all_vertices2_convexhull = all_vertices2.convex_hull
     overlapping_area = all_vertices1_convexhull.intersection(all_vertices2_convexhull)
     links_gdf = gpd.GeoDataFrame(geometry=[overlapping_area])
     links_gdf.to_file("intersection.shp")
 
-    # Those entities which do not intersect with the overlapping area will be removed.
-    entity_set1_overlaid_copy = entity_set1_overlaid.copy()
-    for index, row in entity_set1_overlaid.iterrows():
-        if explain_validity(row.geometry) == 'Valid Geometry':
-            if row.geometry.intersect(overlapping_area).is_empty:
-                delete_index = entity_set1_overlaid_copy[entity_set1_overlaid_copy['FeaID'] == row.FeaID].index.tolist()
-                entity_set1_overlaid_copy.drop(entity_set1_overlaid_copy.index[delete_index], inplace=True)
-                entity_set1_overlaid_copy.index = range(len(entity_set1_overlaid_copy))
-
-    entity_set2_overlaid_copy = entity_set2_overlaid.copy()
-    for index, row in entity_set2_overlaid.iterrows():
-        if explain_validity(row.geometry) == 'Valid Geometry':
-            if row.geometry.intersect(overlapping_area).is_empty:
-                delete_index = entity_set2_overlaid_copy[entity_set2_overlaid_copy['FeaID'] == row.FeaID].index.tolist()
-                entity_set2_overlaid_copy.drop(entity_set2_overlaid_copy.index[delete_index], inplace=True)
-                entity_set2_overlaid_copy.index = range(len(entity_set2_overlaid_copy))
-
-    return entity_set1_overlaid_copy, entity_set2_overlaid_copy
+    # Those entities which do not intersect with the overlapping area will be removed. Invalid entities are kept.
+    entity_set1_overlapping = entity_set1_overlaid[overlapping_entities(entity_set1_overlaid, overlapping_area)]
+    entity_set2_overlapping = entity_set2_overlaid[overlapping_entities(entity_set2_overlaid, overlapping_area)]
+
+    return entity_set1_overlapping.reset_index(drop=True), entity_set2_overlapping.reset_index(drop=True)
+
+
+# Find the entities of a normalized entity set which intersect the overlapping area, or are invalid. Only entities
+# whose bounds intersect the bounds of the overlapping area are tested with their geometries.
+def overlapping_entities(entity_set, overlapping_area):
+    kept = ~entity_set['valid'].values
+    if overlapping_area.is_empty:
+        return kept
+    minx, miny, maxx, maxy = overlapping_area.bounds
+    candidates = (entity_set['minx'].values <= maxx) & (entity_set['maxx'].values >= minx) & \
+                 (entity_set['miny'].values <= maxy) & (entity_set['maxy'].values >= miny) & ~kept
+    geometries = entity_set.geometry.values
+    for i in np.flatnonzero(candidates):
+        kept[i] = geometries[i].intersects(overlapping_area)
+
+    return kept
 
 
 # New a folder to store result of affine transformation.
@@ -1,182 +1,509 @@
-from shapely.geometry import MultiPoint
 import numpy as np
-from shapely.validation import explain_validity
 from shapely.geometry import LineString
 from shapely.ops import nearest_points
-
-
-# Distance between entities of point geometry
-def point_distance(point1, point2):
-    return point1.distance(point2)
-
-
-# Euclidean distance between centroids of entities
-def edc(row):
-    geometry_sou = row['sou_feature']
-    geometry_tar = row['tar_feature']
-    if geometry_sou.geom_type == "Point" and geometry_tar.geom_type == 'Point':
-        distance = point_distance(geometry_sou, geometry_tar)
-    else:
-        distance = geometry_sou.centroid.distance(geometry_tar.centroid)
-    return distance
-
-
-# Shortest euclidean distance between vertices of entities
-def edv(row):
-    geometry_sou = row['sou_feature']
-    geometry_tar = row['tar_feature']
-    if geometry_sou.geom_type == "Point" and geometry_tar.geom_type == 'Point':
-        distance = point_distance(geometry_sou, geometry_tar)
-    else:
-        # Obtain all the vertices of entities
-        if geometry_sou.geom_type == 'Polygon':
-            vertices1 = list(geometry_sou.exterior.coords)
+from shapely.prepared import prep
+from scipy.spatial import Delaunay
+from scipy.spatial import cKDTree
+from scipy.spatial.distance import cdist
+import geometry_normalization
+import instrumentation
+from entity_ids import encode_ids
+
+# Entities with more vertices than this number get a KD-tree of their vertices when the distance 'edv' is computed.
+KD_TREE_VERTICES = 32
+
+# Topological relations of DE-9IM computed between the source entity and the target entity of each entity pair.
+RELATION_PREDICATES = ['within', 'contains', 'overlaps', 'touches', 'crosses']
+
+# Boolean columns of similarity which store the topological relations of RELATION_PREDICATES.
+RELATION_COLUMNS = ['relation_' + predicate for predicate in RELATION_PREDICATES]
+
+
+# The values of one column of the source and target entities of all entity pairs. The columns of entities are kept
+# in the normalized entity sets of the two maps, and the codes of entities in entity pairs are their positions there.
+def pair_values(df_similarity, entity_set1, entity_set2, column):
+    return entity_set1[column].values[df_similarity['sou_id'].values], \
+        entity_set2[column].values[df_similarity['tar_id'].values]
+
+
+# Euclidean distance between centroids of entities for all entity pairs, computed with the centroids of normalized
+# entities. The centroid of a point is the point itself.
+def edc_distances(df_similarity, entity_set1, entity_set2):
+    centroid_x_sou, centroid_x_tar = pair_values(df_similarity, entity_set1, entity_set2, 'centroid_x')
+    centroid_y_sou, centroid_y_tar = pair_values(df_similarity, entity_set1, entity_set2, 'centroid_y')
+
+    return np.hypot(centroid_x_sou - centroid_x_tar, centroid_y_sou - centroid_y_tar)
+
+
+# Shortest euclidean distance between vertices for all entity pairs. The vertices of each entity are obtained once, and
+# a KD-tree is built for entities with more than KD_TREE_VERTICES vertices. Entity pairs are processed in batches by
+# target entity: if the target entity has a KD-tree, the vertices of all its source entities are queried together.
+# Empty geometries have no vertices, and their entity pairs get NaN.
+def edv_distances(df_similarity, entity_set1, entity_set2):
+    sou_codes = df_similarity['sou_id'].values
+    tar_codes = df_similarity['tar_id'].values
+    sou_cache = vertex_cache(sou_codes, entity_set1['vertices'].values)
+    tar_cache = vertex_cache(tar_codes, entity_set2['vertices'].values)
+
+    distances = np.full(len(df_similarity), np.nan)
+    order = np.argsort(tar_codes, kind='mergesort')
+    group_starts = np.flatnonzero(np.r_[True, tar_codes[order][1:] != tar_codes[order][:-1]])
+    for positions in np.split(order, group_starts[1:]):
+        if len(positions) == 0:
+            continue
+        tar_vertices, tar_tree = tar_cache[tar_codes[positions[0]]]
+        if tar_tree is not None:
+            sou_vertices = [sou_cache[code][0] for code in sou_codes[positions]]
+            num_vertices = np.array([len(vertices) for vertices in sou_vertices])
+            nonempty = num_vertices > 0
+            if not nonempty.any():
+                continue
+            # Empty groups add no vertex distances, so reducing from the offsets of the other groups gives their minima.
+            vertex_distances = tar_tree.query(np.vstack(sou_vertices))[0]
+            offsets = np.r_[0, np.cumsum(num_vertices)[:-1]]
+            distances[positions[nonempty]] = np.minimum.reduceat(vertex_distances, offsets[nonempty])
+            continue
+        for position in positions:
+            sou_vertices, sou_tree = sou_cache[sou_codes[position]]
+            if len(sou_vertices) == 0 or len(tar_vertices) == 0:
+                continue
+            if sou_tree is not None:
+                distances[position] = sou_tree.query(tar_vertices)[0].min()
+            else:
+                distances[position] = cdist(sou_vertices, tar_vertices).min()
+    instrumentation.count('kd_trees_built', sum([tree is not None for vertices, tree in sou_cache.values()]) +
+                          sum([tree is not None for vertices, tree in tar_cache.values()]))
+
+    return distances
+
+
+# Cache the vertices of the entities of one map given by their codes, and the KD-trees of entities with many vertices.
+# vertex_arrays holds the vertices of all entities of the map. The cache maps the code of each entity to (vertices,
+# KD-tree or None).
+def vertex_cache(codes, vertex_arrays):
+    cache = {}
+    for code in np.unique(codes):
+        vertices = vertex_arrays[code]
+        tree = cKDTree(vertices) if len(vertices) > KD_TREE_VERTICES else None
+        cache[code] = (vertices, tree)
+
+    return cache
+
+
+# Hausdorff distance for all entity pairs. The distance of two points is the distance between their centroids, and only
+# the other entity pairs are computed with their geometries.
+def hdv_distances(df_similarity, entity_set1, entity_set2):
+    distances = edc_distances(df_similarity, entity_set1, entity_set2)
+    geometries_sou, geometries_tar = pair_values(df_similarity, entity_set1, entity_set2, 'geometry')
+    for position in np.flatnonzero(~point_pairs(df_similarity)):
+        distances[position] = geometries_sou[position].hausdorff_distance(geometries_tar[position])
+
+    return distances
+
+
+# Whether the entities of each entity pair are points. Both entities of a pair have the same geometry type.
+def point_pairs(df_similarity):
+    return np.asarray(df_similarity['sou_type'].values == 'Point', dtype=bool)
+
+
+# Hausdorff distance of the entity pairs which can have the shortest Hausdorff distance of their source entity. Other
+# entity pairs get NaN. For each source entity, target entities are visited in ascending order of a lower bound, and the
+# visit stops when the lower bound exceeds the shortest distance computed so far. The shortest distance and all the
+# entity pairs tied with it are exact, which is all that the distance-based classifying methods use.
+def lazy_hdv(df_similarity, entity_set1, entity_set2):
+    geometries_sou, geometries_tar = pair_values(df_similarity, entity_set1, entity_set2, 'geometry')
+    sou_codes = df_similarity['sou_id'].values
+    is_point = point_pairs(df_similarity)
+    centroid_distances = edc_distances(df_similarity, entity_set1, entity_set2)
+    bounds = ['minx', 'miny', 'maxx', 'maxy']
+    lower_bounds = hausdorff_lower_bound(entity_set1[bounds].values[sou_codes],
+                                         entity_set2[bounds].values[df_similarity['tar_id'].values])
+
+    distances = np.full(len(df_similarity), np.nan)
+    current_sou = None
+    shortest = np.inf
+    for position in np.lexsort((lower_bounds, sou_codes)):
+        if sou_codes[position] != current_sou:
+            current_sou = sou_codes[position]
+            shortest = np.inf
+        elif lower_bounds[position] > shortest:
+            continue
+        if is_point[position]:
+            distances[position] = centroid_distances[position]
         else:
-            vertices1 = list(geometry_sou.coords)
-        vertices1 = MultiPoint(vertices1)
+            distances[position] = geometries_sou[position].hausdorff_distance(geometries_tar[position])
+        shortest = min(shortest, distances[position])
+    instrumentation.count('hausdorff_computed', int(np.count_nonzero(~np.isnan(distances))))
+    instrumentation.count('hausdorff_skipped', int(np.count_nonzero(np.isnan(distances))))
 
-        if geometry_tar.geom_type == 'Polygon':
-            vertices2 = list(geometry_tar.exterior.coords)
-        else:
-            vertices2 = list(geometry_tar.coords)
-        vertices2 = MultiPoint(vertices2)
+    return distances
 
-        distance = vertices1.distance(vertices2)
 
-    return distance
+# Lower bound of the Hausdorff distance between entities from their bounding boxes. Each side of a bounding box goes
+# through a vertex, and that vertex is at least as far from the other entity as the gap between the same sides of the
+# two bounding boxes.
+def hausdorff_lower_bound(bounds_sou, bounds_tar):
+    return np.abs(bounds_sou - bounds_tar).max(axis=1)
 
 
-# Hausdorff distance with vertices of entities
-def hdv(row):
-    geometry_sou = row['sou_feature']
-    geometry_tar = row['tar_feature']
-    if geometry_sou.geom_type == "Point" and geometry_tar.geom_type == 'Point':
-        distance = point_distance(geometry_sou, geometry_tar)
-    else:
-        distance = geometry_sou.hausdorff_distance(geometry_tar)
-    return distance
+# Euclidean distance of nearest points for all entity pairs. As in 'hdv_distances', the distance of two points is the
+# distance between their centroids.
+def ednp_distances(df_similarity, entity_set1, entity_set2):
+    distances = edc_distances(df_similarity, entity_set1, entity_set2)
+    geometries_sou, geometries_tar = pair_values(df_similarity, entity_set1, entity_set2, 'geometry')
+    for position in np.flatnonzero(~point_pairs(df_similarity)):
+        distances[position] = geometries_sou[position].distance(geometries_tar[position])
 
+    return distances
 
-# Euclidean distance of nearest points between entities
-def ednp(row):
-    geometry_sou = row['sou_feature']
-    geometry_tar = row['tar_feature']
-    if geometry_sou.geom_type == "Point" and geometry_tar.geom_type == 'Point':
-        distance = point_distance(geometry_sou, geometry_tar)
-    else:
-        distance = geometry_sou.distance(geometry_tar)
 
-    return distance
+# Compute the angle between entities of polyline for all entity pairs. Both entities of a pair have the same geometry
+# type. Other entity pairs, and polylines of zero length which have no direction, have no angle and get NaN.
+def angle_lines(df_similarity, entity_set1, entity_set2):
+    lengths_sou, lengths_tar = pair_values(df_similarity, entity_set1, entity_set2, 'length')
+    vertices_sou, vertices_tar = pair_values(df_similarity, entity_set1, entity_set2, 'vertices')
+    is_line = np.asarray(df_similarity['sou_type'].values == 'LineString', dtype=bool)
+    angles = np.full(len(df_similarity), np.nan)
+    for position in np.flatnonzero(is_line & (lengths_sou > 0) & (lengths_tar > 0)):
+        angles[position] = line_angle(vertices_sou[position], vertices_tar[position])
 
+    return angles
 
-# Compute the angle between entities of polyline
-def angle_lines(row):
-    geometry_sou = row['sou_feature']
-    geometry_tar = row['tar_feature']
-    if geometry_sou.geom_type == 'LineString' and geometry_tar.geom_type == 'LineString':
 
-        coord_list1 = list(geometry_sou.coords)
-        coord_list2 = list(geometry_tar.coords)
-        # Vectors of first and second points of entities
-        arr_a = np.array([(coord_list1[1][0] - coord_list1[0][0]), (coord_list1[1][1] - coord_list1[0][1])])
-        arr_b = np.array([(coord_list2[1][0] - coord_list2[0][0]), (coord_list2[1][1] - coord_list2[0][1])])
+# Compute the angle between two polylines from their first segments.
+def line_angle(coord_list1, coord_list2):
+    # Vectors of first and second points of entities
+    arr_a = np.array([(coord_list1[1][0] - coord_list1[0][0]), (coord_list1[1][1] - coord_list1[0][1])])
+    arr_b = np.array([(coord_list2[1][0] - coord_list2[0][0]), (coord_list2[1][1] - coord_list2[0][1])])
 
-        # Cosine between two vectors
-        cos_value = (float(arr_a.dot(arr_b)) / (np.sqrt(arr_a.dot(arr_a)) * np.sqrt(arr_b.dot(arr_b))))
-        angle = np.arccos(cos_value) * 180 / np.pi
-        if angle > 90:
-            angle = 180 - angle
-        return angle
+    # Cosine between two vectors
+    cos_value = (float(arr_a.dot(arr_b)) / (np.sqrt(arr_a.dot(arr_a)) * np.sqrt(arr_b.dot(arr_b))))
+    angle = np.arccos(cos_value) * 180 / np.pi
+    if angle > 90:
+        angle = 180 - angle
+    return angle
 
 
-# Compute radius to be used to generate buffer zones.
+# Compute radius to be used to generate buffer zones. The Hausdorff distance of an entity pair is never shorter than the
+# distance of nearest points, so it can not be the minimum and is not used. Rows of df_distance are not reordered.
 def compute_radius(df_distance):
     # Minimum 0.05 quantile of ascending sorted distance matrices will be chosen as the radius.
     nth_distance = int(len(df_distance) * 0.05)-1
 
     # Compute 0.05 quantile for each type of distances.
-    df_distance.sort_values('dist_edc', inplace=True)
-    radius_edc = df_distance.iloc[nth_distance]['dist_edc']
-    df_distance.sort_values('dist_edv', inplace=True)
-    radius_edv = df_distance.iloc[nth_distance]['dist_edv']
-    df_distance.sort_values('dist_hdv', inplace=True)
-    radius_hdv = df_distance.iloc[nth_distance]['dist_hdv']
-    df_distance.sort_values('dist_ednp', inplace=True)
-    radius_ednp = df_distance.iloc[nth_distance]['dist_ednp']
+    radius_edc = np.sort(df_distance['dist_edc'].values)[nth_distance]
+    radius_edv = np.sort(df_distance['dist_edv'].values)[nth_distance]
+    radius_ednp = np.sort(df_distance['dist_ednp'].values)[nth_distance]
 
-    radius = round(min(radius_edc, radius_ednp, radius_edv, radius_hdv), 2)
+    radius = round(min(radius_edc, radius_ednp, radius_edv), 2)
 
     return radius
 
 
-# Examine entity pair to be matched whether they have approximate topological relations of approximately within.
-def atr_within(row, radius):
-    geometry_sou = row['sou_feature']
-    geometry_tar = row['tar_feature']
-    buf_1 = geometry_sou.buffer(radius)
-    buf_2 = geometry_tar.buffer(radius)
-
-    if explain_validity(geometry_sou) == 'Valid Geometry' and explain_validity(geometry_tar) == 'Valid Geometry':
+# Examine all entity pairs to be matched whether they have approximate topological relations of approximately within.
+# The buffer of each entity is built once for all its entity pairs. The relation is not computed for entities whose
+# geometries are invalid and could not be repaired, and their entity pairs get NaN.
+def atr_within(df_similarity, entity_set1, entity_set2, radius):
+    valid_sou, valid_tar = pair_values(df_similarity, entity_set1, entity_set2, 'valid')
+    sou_codes = df_similarity['sou_id'].values
+    tar_codes = df_similarity['tar_id'].values
+    geometries1 = entity_set1.geometry.values
+    geometries2 = entity_set2.geometry.values
+    buffers_sou = {}
+    buffers_tar = {}
+    area_ratios = np.full(len(df_similarity), np.nan)
+    for position in np.flatnonzero(valid_sou.astype(bool) & valid_tar.astype(bool)):
+        sou_code = sou_codes[position]
+        tar_code = tar_codes[position]
+        if sou_code not in buffers_sou:
+            buffers_sou[sou_code] = geometries1[sou_code].buffer(radius)
+        if tar_code not in buffers_tar:
+            buffers_tar[tar_code] = geometries2[tar_code].buffer(radius)
+        buf_1 = buffers_sou[sou_code]
+        buf_2 = buffers_tar[tar_code]
         area = buf_1.intersection(buf_2).area
-        area_ratio = area/(min(buf_1.area, buf_2.area))
-        return area_ratio
+        area_ratios[position] = area/(min(buf_1.area, buf_2.area))
+    instrumentation.count('buffers_built', len(buffers_sou) + len(buffers_tar))
+
+    return area_ratios
+
+
+# Compute the topological relations of RELATION_PREDICATES and the overlap fraction of all entity pairs. Only entity
+# pairs whose bounds intersect are tested, and the geometry of each source entity is prepared once for all its target
+# entities to test whether they intersect. The DE-9IM matrix of each intersecting pair is computed once with 'relate',
+# and all the relations are read from it. Other entity pairs, and pairs including invalid entities which could not be
+# repaired, have no relation and an overlap fraction of 0. The result maps the name of each column to its values.
+def topological_relations(df_similarity, entity_set1, entity_set2):
+    relations = dict([(predicate, np.zeros(len(df_similarity), dtype=bool)) for predicate in RELATION_PREDICATES])
+    overlap_fractions = np.zeros(len(df_similarity))
+    minx_sou, minx_tar = pair_values(df_similarity, entity_set1, entity_set2, 'minx')
+    miny_sou, miny_tar = pair_values(df_similarity, entity_set1, entity_set2, 'miny')
+    maxx_sou, maxx_tar = pair_values(df_similarity, entity_set1, entity_set2, 'maxx')
+    maxy_sou, maxy_tar = pair_values(df_similarity, entity_set1, entity_set2, 'maxy')
+    valid_sou, valid_tar = pair_values(df_similarity, entity_set1, entity_set2, 'valid')
+    candidates = (minx_sou <= maxx_tar) & (minx_tar <= maxx_sou) & (miny_sou <= maxy_tar) & (miny_tar <= maxy_sou) & \
+        valid_sou.astype(bool) & valid_tar.astype(bool)
+    positions = np.flatnonzero(candidates)
+    instrumentation.count('relation_pairs_tested', len(positions))
+
+    sou_codes = df_similarity['sou_id'].values
+    geometries_sou, geometries_tar = pair_values(df_similarity, entity_set1, entity_set2, 'geometry')
+    vertices_sou, vertices_tar = pair_values(df_similarity, entity_set1, entity_set2, 'vertices')
+    areas = np.column_stack(pair_values(df_similarity, entity_set1, entity_set2, 'area')).astype(np.float64)
+    lengths = np.column_stack(pair_values(df_similarity, entity_set1, entity_set2, 'length')).astype(np.float64)
+    current_sou = None
+    prepared_sou = None
+    for position in positions[np.argsort(sou_codes[positions], kind='mergesort')]:
+        if sou_codes[position] != current_sou:
+            current_sou = sou_codes[position]
+            prepared_sou = prep(geometries_sou[position])
+        geometry_tar = geometries_tar[position]
+        if not prepared_sou.intersects(geometry_tar):
+            continue
+        for predicate, value in relation_flags(geometries_sou[position].relate(geometry_tar)).items():
+            relations[predicate][position] = value
+        overlap_fractions[position] = overlap_fraction(geometries_sou[position], geometry_tar, areas[position],
+                                                       lengths[position], vertices_sou[position], vertices_tar[position])
+
+    columns = dict([(column, relations[predicate]) for column, predicate in zip(RELATION_COLUMNS, RELATION_PREDICATES)])
+    columns['overlap_fraction'] = overlap_fractions
+
+    return columns
+
+
+# The relations of RELATION_PREDICATES read from the DE-9IM matrix of two geometries, with the same definitions as
+# shapely. The dimension of each geometry is the highest dimension in the row or column of its interior.
+def relation_flags(matrix):
+    dimensions = dict([('F', -1), ('0', 0), ('1', 1), ('2', 2)])
+    dimension_sou = max([dimensions[matrix[i]] for i in [0, 1, 2]])
+    dimension_tar = max([dimensions[matrix[i]] for i in [0, 3, 6]])
+
+    flags = {'within': relate_pattern(matrix, 'T*F**F***'), 'contains': relate_pattern(matrix, 'T*****FF*')}
+    flags['touches'] = not (dimension_sou == 0 and dimension_tar == 0) and (
+        relate_pattern(matrix, 'FT*******') or relate_pattern(matrix, 'F**T*****') or relate_pattern(matrix, 'F***T****'))
+    if dimension_sou < dimension_tar:
+        flags['crosses'] = relate_pattern(matrix, 'T*T******')
+    elif dimension_sou > dimension_tar:
+        flags['crosses'] = relate_pattern(matrix, 'T*****T**')
+    else:
+        flags['crosses'] = dimension_sou == 1 and relate_pattern(matrix, '0********')
+    if dimension_sou == dimension_tar and dimension_sou == 1:
+        flags['overlaps'] = relate_pattern(matrix, '1*T***T**')
+    else:
+        flags['overlaps'] = dimension_sou == dimension_tar and relate_pattern(matrix, 'T*T***T**')
 
+    return flags
 
-# Compute INNs for source entity.
-def topo_sou(row, entity_set):
-    inns = []
-    row_sou_geometry = row['sou_feature']
-    row_sou_id = row['sou_id']
 
-    # Check each one entity whether it is an INN for the current entity.
-    for index, entity in entity_set.iterrows():
-        is_immediate = True
-        geometry = entity.geometry
-        computed_nearest_segments = nearest_segments(row_sou_geometry, geometry)
-        if entity['FeaID'] == row_sou_id:
+# Whether a DE-9IM matrix matches a pattern. 'T' matches any dimension, 'F' matches no intersection, and '*' matches
+# anything.
+def relate_pattern(matrix, pattern):
+    for value, expected in zip(matrix, pattern):
+        if expected == '*' or value == expected or (expected == 'T' and value != 'F'):
             continue
-
-        # If the generated nearest segment intersects with any other entity except the source entities and current
-        # entities, this entity will not be regarded as an INN of source entity.
-        for i in range(len(entity_set)):
-            current_geometry = entity_set.iloc[i].geometry
-            if computed_nearest_segments.intersects(current_geometry) and (
-                    (entity_set.iloc[i].FeaID == row['sou_id']) is False) and (
-                    (entity_set.iloc[i].FeaID == entity['FeaID']) is False):
-                is_immediate = False
-                break
-        if is_immediate:
-            inns.append(entity['FeaID'])
+        return False
+
+    return True
+
+
+# The fraction of the smaller entity of an intersecting entity pair which is covered by the other entity: the ratio of
+# areas for polygons and of lengths for polylines. areas, lengths and vertices are those of the source and target
+# entities. For points and multipoints, it is the fraction of the distinct points of the smaller entity which are also
+# points of the other entity.
+def overlap_fraction(geometry_sou, geometry_tar, areas, lengths, vertices_sou, vertices_tar):
+    if areas.min() > 0:
+        return geometry_sou.intersection(geometry_tar).area / areas.min()
+    if lengths.min() > 0:
+        return geometry_sou.intersection(geometry_tar).length / lengths.min()
+
+    points_sou = np.unique(vertices_sou, axis=0)
+    points_tar = np.unique(vertices_tar, axis=0)
+    if min(len(points_sou), len(points_tar)) == 0:
+        return 0.0
+    num_shared = len(points_sou) + len(points_tar) - len(np.unique(np.vstack([points_sou, points_tar]), axis=0))
+
+    return num_shared / float(min(len(points_sou), len(points_tar)))
+
+
+# Compute INNs of the entities of one map. If fea_ids is given, only INNs of these entities are computed. The result
+# maps the FeaID of each entity to the FeaIDs of its INNs. With inn_candidates 'all', every other entity is checked
+# with the nearest-segment test. With inn_candidates 'delaunay', only the entities adjacent in the Delaunay
+# triangulation of densified boundaries are checked. This is much faster but approximate: an entity whose nearest
+# segment passes between other entities without touching them is an INN, but is often not adjacent in the
+# triangulation, so the INNs found with 'delaunay' are a subset of those found with 'all'. Candidates are only
+# generated for the entities whose INNs are computed.
+def entity_inns(entity_set, fea_ids=None, inn_candidates='all', spacing=None):
+    candidates = None
+    if inn_candidates == 'delaunay':
+        candidates = delaunay_candidates(entity_set, spacing)
+
+    # Entities which may block the nearest segment are searched with the spatial index of the map instead of testing
+    # all entities. The nearest segment of two points is built from their centroids.
+    entity_set = geometry_normalization.normalized(entity_set)
+    spatial_index = entity_set.sindex
+    geometries = list(entity_set.geometry)
+    entity_fea_ids = list(entity_set['FeaID'])
+    is_point = np.asarray(entity_set['geometry_type'].values == 'Point', dtype=bool)
+    centroids = entity_set[['centroid_x', 'centroid_y']].values
+    num_tests = 0
+
+    inns = {}
+    for i in range(len(geometries)):
+        if fea_ids is not None and entity_fea_ids[i] not in fea_ids:
+            continue
+        current_inns = []
+        for j in entity_candidates(candidates, i, len(geometries)):
+            if is_point[i] and is_point[j]:
+                computed_nearest_segments = LineString([centroids[i], centroids[j]])
+            else:
+                computed_nearest_segments = nearest_segments(geometries[i], geometries[j])
+            is_immediate = True
+            for k in spatial_index.intersection(computed_nearest_segments.bounds):
+                if k == i or k == j:
+                    continue
+                num_tests = num_tests + 1
+                if computed_nearest_segments.intersects(geometries[k]):
+                    is_immediate = False
+                    break
+            if is_immediate:
+                current_inns.append(entity_fea_ids[j])
+        inns[entity_fea_ids[i]] = current_inns
+    instrumentation.count('nearest_segment_tests', num_tests)
 
     return inns
 
 
-# Compute INNs for target entity.
-def topo_tar(row, entity_set):
+# The positions of the INN candidates of the entity at position i, in ascending order. If candidates is None, all other
+# entities are candidates, and they are generated one by one.
+def entity_candidates(candidates, i, num_entities):
+    if candidates is None:
+        return (j for j in range(num_entities) if j != i)
+
+    return sorted(candidates[i])
+
+
+# Generate INN candidates of each entity from the Delaunay triangulation of points on the boundaries of all entities
+# of one map. Two entities are candidates of each other if a triangle edge connects their points. The vertices of
+# boundaries are densified with the distance spacing, by default 1/500 of the extent of the map. The result is a list
+# of sets of positions of candidate entities. If the triangulation can not be built, None is returned, and all entities
+# are candidates.
+def delaunay_candidates(entity_set, spacing=None):
+    if spacing is None:
+        minx, miny, maxx, maxy = entity_set.total_bounds
+        spacing = max(maxx - minx, maxy - miny) / 500.0
+
+    points = []
+    labels = []
+    for i, geometry in enumerate(entity_set.geometry):
+        geometry_points = boundary_points(geometry, spacing)
+        points.extend(geometry_points)
+        labels.extend([i] * len(geometry_points))
+    labels = np.array(labels, dtype=np.int64)
+
+    try:
+        triangulation = Delaunay(np.array(points, dtype=float))
+    except (RuntimeError, ValueError, IndexError):
+        return None
+
+    # Edges of triangles, and points which are not used by the triangulation because they coincide with another point.
+    simplices = triangulation.simplices
+    edges = np.vstack([simplices[:, [0, 1]], simplices[:, [1, 2]], simplices[:, [0, 2]],
+                       triangulation.coplanar[:, [0, 2]]])
+    label_edges = labels[edges]
+    label_edges = label_edges[label_edges[:, 0] != label_edges[:, 1]]
+    label_edges = np.unique(np.sort(label_edges, axis=1), axis=0)
+
+    candidates = [set() for i in range(len(entity_set))]
+    for label1, label2 in label_edges:
+        candidates[label1].add(label2)
+        candidates[label2].add(label1)
+    instrumentation.count('inn_candidates', 2 * len(label_edges))
+
+    return candidates
+
+
+# Points on the boundary of an entity. Vertices are kept, and points are added on each line every distance spacing.
+def boundary_points(geometry, spacing):
+    if geometry.geom_type == 'Point':
+        return [(geometry.x, geometry.y)]
+    if geometry.geom_type == 'MultiPoint':
+        return [(point.x, point.y) for point in geometry.geoms]
+
+    if geometry.geom_type == 'Polygon':
+        lines = [geometry.exterior] + list(geometry.interiors)
+    elif geometry.geom_type == 'MultiPolygon':
+        lines = sum([[polygon.exterior] + list(polygon.interiors) for polygon in geometry.geoms], [])
+    elif geometry.geom_type == 'MultiLineString':
+        lines = list(geometry.geoms)
+    else:
+        lines = [geometry]
+
+    points = []
+    for line in lines:
+        points.extend([coordinate[:2] for coordinate in line.coords])
+        for k in range(1, int(line.length // spacing) + 1):
+            point = line.interpolate(k * spacing)
+            points.append((point.x, point.y))
+
+    return points
+
+
+# Store INNs of the entities of one map as compressed sparse rows. INNs of the entity with code i are
+# inn_codes[offsets[i]:offsets[i + 1]]. Entities whose INNs are not computed have no INNs.
+def inns_csr(inns, id_dictionary):
+    offsets = np.zeros(len(id_dictionary) + 1, dtype=np.int64)
+    entity_codes = []
+    for fea_id, fea_id_inns in inns.items():
+        code = id_dictionary.get_loc(fea_id)
+        offsets[code + 1] = len(fea_id_inns)
+        entity_codes.append((code, fea_id_inns))
+    offsets = np.cumsum(offsets)
+
+    inn_codes = np.zeros(offsets[-1], dtype=np.int32)
+    for code, fea_id_inns in entity_codes:
+        inn_codes[offsets[code]:offsets[code + 1]] = encode_ids(id_dictionary, fea_id_inns)
+
+    return offsets, inn_codes
+
+
+# Compute INNs of one entity among all the entities of its map.
+def immediate_neighbours(entity_geometry, entity_id, entity_set):
     inns = []
-    row_tar_geometry = row['tar_feature']
-    row_tar_id = row['tar_id']
+    num_tests = 0
 
+    # Check each one entity whether it is an INN for the current entity.
     for index, entity in entity_set.iterrows():
-        is_immediate = True
-        geometry = entity.geometry
-        computed_nearest_segments = nearest_segments(row_tar_geometry, geometry)
-        if entity['FeaID'] == row_tar_id:
+        if entity['FeaID'] == entity_id:
             continue
-
-        for i in range(len(entity_set)):
-            current_geometry = entity_set.iloc[i].geometry
-            if computed_nearest_segments.intersects(current_geometry) and (
-                    (entity_set.iloc[i].FeaID == row['tar_id']) is False) and (
-                    (entity_set.iloc[i].FeaID == entity['FeaID']) is False):
-                is_immediate = False
-                break
+        is_immediate, num_entity_tests = is_immediate_neighbour(entity_geometry, entity_id, entity.geometry,
+                                                                 entity['FeaID'], entity_set)
+        num_tests = num_tests + num_entity_tests
         if is_immediate:
             inns.append(entity['FeaID'])
+    instrumentation.count('nearest_segment_tests', num_tests)
 
     return inns
 
 
+# Examine whether the second entity is an INN of the first entity. The number of performed nearest-segment tests is
+# also returned.
+def is_immediate_neighbour(entity_geometry, entity_id, neighbour_geometry, neighbour_id, entity_set):
+    computed_nearest_segments = nearest_segments(entity_geometry, neighbour_geometry)
+    num_tests = 0
+
+    # If the generated nearest segment intersects with any other entity except the current entity and the neighbour,
+    # the neighbour will not be regarded as an INN of the current entity.
+    for i in range(len(entity_set)):
+        current_geometry = entity_set.iloc[i].geometry
+        num_tests = num_tests + 1
+        if computed_nearest_segments.intersects(current_geometry) and (
+                (entity_set.iloc[i].FeaID == entity_id) is False) and (
+                (entity_set.iloc[i].FeaID == neighbour_id) is False):
+            return False, num_tests
+
+    return True, num_tests
+
+
 # Generate the nearest segments for each two geometries
 def nearest_segments(geometry1, geometry2):
     generated_nearest_points = [o for o in nearest_points(geometry1, geometry2)]
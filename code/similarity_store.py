@@ -0,0 +1,98 @@
+import json
+import os
+import numpy as np
+import pandas as pd
+
+# Version of the format of the similarity store.
+STORE_VERSION = 1
+
+# Columns of the similarity dataframe which are not written in the store.
+GEOMETRY_COLUMNS = ['sou_feature', 'tar_feature']
+
+
+# Write the similarity of entity pairs in a directory. Each column is written in its own .npy file of fixed width: codes
+# of entities as int32, geometry types as int8 codes of categories, flags of topological relations as booleans, and
+# metrics as float64. The ID dictionaries of two maps and INNs stored as compressed sparse rows are written in the same
+# way. The file 'manifest.json' describes all the columns. Geometries are not written.
+def write_store(store_path, df_similarity, sou_ids, tar_ids, sou_inns, tar_inns):
+    if not os.path.exists(store_path):
+        os.makedirs(store_path)
+
+    manifest = {'version': STORE_VERSION, 'rows': len(df_similarity), 'columns': {}}
+    for column in df_similarity.columns:
+        if column in GEOMETRY_COLUMNS:
+            continue
+        values = df_similarity[column]
+        description = {'file': column + '.npy'}
+        if column in ['sou_id', 'tar_id']:
+            array = values.values.astype(np.int32)
+        elif isinstance(values.dtype, pd.CategoricalDtype):
+            array = values.cat.codes.values.astype(np.int8)
+            description['categories'] = [str(category) for category in values.cat.categories]
+        elif pd.api.types.is_bool_dtype(values):
+            array = values.values.astype(np.bool_)
+        else:
+            array = pd.to_numeric(values, errors='coerce').values.astype(np.float64)
+        np.save(os.path.join(store_path, description['file']), array)
+        manifest['columns'][column] = description
+
+    np.save(os.path.join(store_path, 'sou_ids.npy'), id_array(sou_ids))
+    np.save(os.path.join(store_path, 'tar_ids.npy'), id_array(tar_ids))
+    for name, inns in [('sou_inns', sou_inns), ('tar_inns', tar_inns)]:
+        np.save(os.path.join(store_path, name + '_offsets.npy'), inns[0].astype(np.int64))
+        np.save(os.path.join(store_path, name + '_codes.npy'), inns[1].astype(np.int32))
+
+    with open(os.path.join(store_path, 'manifest.json'), 'w') as manifest_file:
+        json.dump(manifest, manifest_file, indent=2)
+
+
+# Convert an ID dictionary to an array of fixed width. FeaIDs of strings are stored as unicode strings.
+def id_array(id_dictionary):
+    values = np.asarray(id_dictionary.values)
+    if values.dtype == object:
+        values = values.astype(str)
+
+    return values
+
+
+# Read the manifest of a similarity store.
+def read_manifest(store_path):
+    with open(os.path.join(store_path, 'manifest.json')) as manifest_file:
+        manifest = json.load(manifest_file)
+    if manifest['version'] != STORE_VERSION:
+        raise ValueError('Unsupported version of similarity store: ' + str(manifest['version']))
+
+    return manifest
+
+
+# Open a similarity store. Only the columns given in the list columns are read into the dataframe of similarity, and all
+# columns are read if columns is None. Files are opened as memory maps, and the dataframe is built on the memory maps
+# without copying them, so that processes reading the same store share pages. The result has the same keys as the
+# dictionary written by 'write_similarity'.
+def read_store(store_path, columns=None):
+    manifest = read_manifest(store_path)
+    if columns is None:
+        columns = list(manifest['columns'])
+
+    arrays = {}
+    for column in columns:
+        description = manifest['columns'][column]
+        array = open_array(store_path, description['file'])
+        if 'categories' in description:
+            arrays[column] = pd.Categorical.from_codes(array, description['categories'])
+        else:
+            arrays[column] = array
+    df_similarity = pd.DataFrame(arrays, index=pd.RangeIndex(manifest['rows']), columns=columns, copy=False)
+
+    similarity = {'similarity': df_similarity,
+                  'sou_ids': pd.Index(open_array(store_path, 'sou_ids.npy')),
+                  'tar_ids': pd.Index(open_array(store_path, 'tar_ids.npy'))}
+    for name in ['sou_inns', 'tar_inns']:
+        similarity[name] = (open_array(store_path, name + '_offsets.npy'), open_array(store_path, name + '_codes.npy'))
+
+    return similarity
+
+
+# Open one .npy file of a similarity store as a read-only memory map.
+def open_array(store_path, file_name):
+    return np.load(os.path.join(store_path, file_name), mmap_mode='r')
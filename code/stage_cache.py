@@ -0,0 +1,204 @@
+import glob
+import hashlib
+import json
+import os
+import pickle
+import shutil
+import time
+import instrumentation
+
+# Default size limit of the stage cache in MB. The least recently used entries are evicted beyond this size.
+CACHE_SIZE_LIMIT = 2048
+
+# Files of a ShapeFile which are hashed together with the .shp file.
+SHAPEFILE_EXTENSIONS = ['.shp', '.shx', '.dbf', '.prj', '.cpg']
+
+# cache_setting is used to store the directory and size limit of the stage cache. The cache is disabled if the
+# directory is None.
+cache_setting = {'directory': None, 'limit': CACHE_SIZE_LIMIT}
+
+# code_hash is used to store the version of the code, which is computed once in each process.
+code_hash = {'version': None}
+
+
+# Enable the stage cache in cache_dir. size_limit is in MB.
+def enable_cache(cache_dir, size_limit=CACHE_SIZE_LIMIT):
+    cache_setting['directory'] = cache_dir
+    cache_setting['limit'] = size_limit
+    if cache_dir is not None and not os.path.exists(cache_dir):
+        os.makedirs(cache_dir)
+
+
+# Disable the stage cache. Entries already written are kept.
+def disable_cache():
+    cache_setting['directory'] = None
+
+
+# Hash the content of an input file. For a ShapeFile, the files of its attributes and projection are also hashed.
+def file_hash(file_path):
+    root, extension = os.path.splitext(file_path)
+    file_paths = [file_path]
+    if extension.lower() == '.shp':
+        file_paths = [root + item for item in SHAPEFILE_EXTENSIONS if os.path.exists(root + item)]
+
+    content_hash = hashlib.sha1()
+    for path in file_paths:
+        with open(path, 'rb') as input_file:
+            for block in iter(lambda: input_file.read(1 << 20), b''):
+                content_hash.update(block)
+
+    return content_hash.hexdigest()
+
+
+# Hash the source code of all modules of the workflow, so that entries written by another version of the code are not
+# used. The code does not change while a process runs, so the hash is computed once.
+def code_version():
+    if code_hash['version'] is None:
+        source_hash = hashlib.sha1()
+        for source_file in sorted(glob.glob(os.path.join(os.path.dirname(os.path.abspath(__file__)), '*.py'))):
+            with open(source_file, 'rb') as source:
+                source_hash.update(source.read())
+        code_hash['version'] = source_hash.hexdigest()
+
+    return code_hash['version']
+
+
+# Build the key of one stage from its inputs. parts are the hashes of input files, names of methods, parameters, and
+# the keys of previous stages. The key also includes the version of the code.
+def stage_key(stage_name, *parts):
+    content = json.dumps([stage_name, code_version()] + [str(part) for part in parts])
+
+    return hashlib.sha1(content.encode('utf-8')).hexdigest()
+
+
+# Directory of the entry of one stage in the cache.
+def entry_path(stage_name, key):
+    return os.path.join(cache_setting['directory'], stage_name + '_' + key)
+
+
+# Return the output of a stage from the cache, or compute it with compute and store it. Outputs are stored with pickle.
+# side_files are glob patterns of the files and directories which the stage writes in the working directory, such as
+# 'intersection.*'. They are stored with the output and written again when the output is restored. If the cache is
+# disabled, the output is always computed.
+def cached(stage_name, key, compute, side_files=()):
+    if cache_setting['directory'] is None:
+        return compute()
+
+    entry = entry_path(stage_name, key)
+    output_file = os.path.join(entry, 'output.pkl')
+    if os.path.exists(output_file):
+        instrumentation.count('cache_hits')
+        touch_entry(entry)
+        restore_side_files(entry)
+        with open(output_file, 'rb') as pickle_file:
+            return pickle.load(pickle_file)
+
+    instrumentation.count('cache_misses')
+    output = compute()
+    write_entry(entry, lambda path: write_output(path, output, side_files))
+
+    return output
+
+
+# Write the output of a stage with pickle, and copy the files matching side_files in the entry.
+def write_output(entry, output, side_files=()):
+    with open(os.path.join(entry, 'output.pkl'), 'wb') as pickle_file:
+        pickle.dump(output, pickle_file)
+    store_side_files(entry, side_files)
+
+
+# Copy the files and directories matching the glob patterns side_files from the working directory to an entry.
+def store_side_files(entry, side_files):
+    side_dir = os.path.join(entry, 'side_files')
+    for pattern in side_files:
+        for path in glob.glob(pattern):
+            target = os.path.join(side_dir, path)
+            if not os.path.exists(os.path.dirname(target)):
+                os.makedirs(os.path.dirname(target))
+            if os.path.isdir(path):
+                shutil.copytree(path, target)
+            else:
+                shutil.copy2(path, target)
+
+
+# Copy the side files of an entry back to the working directory, replacing the files of an earlier run.
+def restore_side_files(entry):
+    side_dir = os.path.join(entry, 'side_files')
+    if not os.path.exists(side_dir):
+        return
+    for name in os.listdir(side_dir):
+        path = os.path.join(side_dir, name)
+        if os.path.isdir(path):
+            if os.path.exists(name):
+                shutil.rmtree(name)
+            shutil.copytree(path, name)
+        else:
+            shutil.copy2(path, name)
+
+
+# Restore the directory written by a stage, such as the similarity store, from the cache, or compute it with compute
+# and store a copy of it. If the cache is disabled, the directory is always computed.
+def cached_directory(stage_name, key, directory, compute):
+    if cache_setting['directory'] is None:
+        compute()
+        return
+
+    entry = entry_path(stage_name, key)
+    cached_copy = os.path.join(entry, 'directory')
+    if os.path.exists(cached_copy):
+        instrumentation.count('cache_hits')
+        touch_entry(entry)
+        if os.path.exists(directory):
+            shutil.rmtree(directory)
+        shutil.copytree(cached_copy, directory)
+        return
+
+    instrumentation.count('cache_misses')
+    compute()
+    write_entry(entry, lambda path: shutil.copytree(directory, os.path.join(path, 'directory')))
+
+
+# Write an entry in a temporary directory first, so that an interrupted run does not leave an incomplete entry.
+def write_entry(entry, write):
+    temporary_entry = entry + '.tmp'
+    if os.path.exists(temporary_entry):
+        shutil.rmtree(temporary_entry)
+    os.makedirs(temporary_entry)
+    write(temporary_entry)
+    if os.path.exists(entry):
+        shutil.rmtree(entry)
+    os.rename(temporary_entry, entry)
+    touch_entry(entry)
+    evict_entries()
+
+
+# Mark an entry as used. The time of last use is the modification time of its directory.
+def touch_entry(entry):
+    now = time.time()
+    os.utime(entry, (now, now))
+
+
+# Size of an entry in bytes.
+def entry_size(entry):
+    size = 0
+    for root, directories, files in os.walk(entry):
+        for file_name in files:
+            size = size + os.path.getsize(os.path.join(root, file_name))
+
+    return size
+
+
+# Evict the least recently used entries until the size of the cache is within its limit.
+def evict_entries():
+    cache_dir = cache_setting['directory']
+    entries = [os.path.join(cache_dir, name) for name in os.listdir(cache_dir) if not name.endswith('.tmp')]
+    entries = sorted(entries, key=os.path.getmtime)
+    sizes = [entry_size(entry) for entry in entries]
+    total_size = sum(sizes)
+    limit = cache_setting['limit'] * 1024 * 1024
+    for entry, size in zip(entries, sizes):
+        if total_size <= limit:
+            break
+        shutil.rmtree(entry)
+        total_size = total_size - size
+        instrumentation.count('cache_evictions')
@@ -3,8 +3,31 @@ import os
 import pandas as pd
 import geopandas as gpd
 import re
+import instrumentation
 from evaluate_performance import eval_perf
 
+# Textual label methods which learn from the ground truth and write their result directly.
+MACHINE_LEARNING_METHODS = ['text_santos2018b', 'text_santos2018a', 'text_acheson2019', 'ensemble_learning']
+
+
+# With two input maps, this function is to align entities with textual labels using a certain text label
+# match method.
+def textual_label_alignment(entity_set1, entity_set2, text_label_method, ground_truth_label):
+    with instrumentation.stage('textual_label_alignment'):
+        # Build textual label pairs of entities with the same type of geometries.
+        entity_label_pairs = generate_pairs_with_label(entity_set1, entity_set2)
+        instrumentation.count('label_pairs_generated', len(entity_label_pairs))
+
+        # Align entities with selected textual label match method.
+        # If one machine learning method is selected, it will directly obtain the result and compute the performance.
+        if text_label_method in MACHINE_LEARNING_METHODS:
+            globals()[text_label_method](entity_label_pairs, ground_truth_label)
+        else:
+            text_align_result = globals()[text_label_method](entity_label_pairs)
+            text_result_file = labels_result_file(text_align_result, text_label_method)
+            eval_perf(text_result_file, ground_truth_label)
+            return text_result_file
+
 
 # Find all entities which have textual labels,and organize them into pairs of the same geometry type.
 def generate_pairs_with_label(entity_set1, entity_set2):
@@ -0,0 +1,316 @@
+import os
+import fiona
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+from joblib import Parallel, delayed
+from shapely.geometry import box
+from shapely.ops import unary_union
+import classsification
+import entity_ids
+import evaluate_performance
+import execute_align
+import geometry_normalization
+import instrumentation
+import overlay_entities
+import similarity_computation
+
+# Number of features read at once when the overlapping area of maps is computed.
+READ_CHUNK_SIZE = 10000
+
+# Number of tiles whose entity pairs are used to estimate the radius of buffers of 'atr_within'.
+RADIUS_SAMPLE_TILES = 10
+
+
+# This function is the tiled version of 'execute_alignment' and 'alignment_classification' for maps which do not fit in
+# memory. The overlapping area of two maps is cut into square tiles of tile_size. Each tile is processed independently
+# by 'align_tile' with the entities within the tile and its halo, which is a zone of width halo around the tile. Only
+# these entities are read from the ShapeFiles, so the memory used depends on the size of tiles. An entity is owned by
+# the tile which contains its representative point, and each tile only classifies the entity pairs of its own source
+# entities. Target entities farther than halo from the tile, and INNs farther than halo, are not seen by the tile, so
+# halo should be wider than the distance between aligned entities and the distance of INNs. Source entities whose INNs
+# reach the border of the halo may miss INNs beyond it; they are counted as 'inns_at_halo', and a message is printed.
+# text_result_file is the result of textual label alignment of the two maps. The radius of buffers of 'atr_within' can
+# not be computed from all entity pairs at once. It is given by radius, or estimated with 'estimate_radius' from the
+# entity pairs of RADIUS_SAMPLE_TILES tiles if radius is None. If df_control_points is given, entities of the first map
+# are transformed with transform_method, 'affine' or 'rubber_sheet'; otherwise the two maps are assumed to be overlaid
+# already. Tiles are processed on n_jobs processes, and the alignments of each tile are written in tile_dir.
+def tiled_alignment(shapefile_list1, shapefile_list2, text_result_file, ground_truth, method_name, tile_size, halo,
+                    radius=None, distance_method='dist_hdv', df_control_points=None, transform_method='affine', n_jobs=1,
+                    tile_dir='tiles', report_file='run_report.json'):
+    instrumentation.reset_report()
+    transform = map_transform(df_control_points, transform_method)
+    with instrumentation.stage('overlapping_area'):
+        overlapping_area = map_hull(shapefile_list1, transform).intersection(map_hull(shapefile_list2, None))
+    tiles = overlap_tiles(overlapping_area, tile_size)
+    instrumentation.count('tiles', len(tiles))
+    if not os.path.exists(tile_dir):
+        os.makedirs(tile_dir)
+    if radius is None:
+        with instrumentation.stage('estimate_radius'):
+            radius = estimate_radius(tiles, overlapping_area, shapefile_list1, shapefile_list2, text_result_file, halo,
+                                     transform)
+        print('Estimated radius: %s' % radius)
+
+    # Counters of the processes of tiles are not added to the report, so the number of source entities whose INNs reach
+    # the halo is returned by each tile.
+    with instrumentation.stage('align_tiles'):
+        tile_outputs = Parallel(n_jobs=n_jobs)(
+            delayed(align_tile)(os.path.join(tile_dir, 'tile_' + str(i) + '.txt'), tile, overlapping_area,
+                                shapefile_list1, shapefile_list2, text_result_file, method_name, halo, radius,
+                                distance_method, transform) for i, tile in enumerate(tiles))
+    tile_files = [tile_file for tile_file, num_at_halo in tile_outputs]
+    num_at_halo = sum([num_at_halo for tile_file, num_at_halo in tile_outputs])
+    instrumentation.count('inns_at_halo', num_at_halo)
+    if num_at_halo > 0:
+        print('INNs of %s source entities reach the halo of their tile and may be incomplete; use a wider halo.'
+              % num_at_halo)
+
+    with instrumentation.stage('merge_tiles'):
+        df_result = merge_tile_results(tile_files, method_name)
+    result_file = evaluate_performance.write_result_file(df_result, method_name, text_result_file)
+    evaluate_performance.eval_perf(result_file, ground_truth)
+    instrumentation.write_report(report_file)
+
+
+# Align the entities owned by one tile. The bounds of the tile are (minx, miny, maxx, maxy) in the coordinates of the
+# second map. The alignments of the source entities owned by the tile are written in tile_file with FeaIDs, together
+# with whether their target entities are owned by the tile. tile_file and the number of source entities whose INNs
+# reach the border of the halo are returned. The arguments are plain values, so that tiles can also be processed on
+# separate machines.
+def align_tile(tile_file, tile, overlapping_area, shapefile_list1, shapefile_list2, text_result_file, method_name, halo,
+               radius, distance_method, transform):
+    halo_box, entity_set1, entity_set2 = tile_entities(tile, overlapping_area, shapefile_list1, shapefile_list2, halo,
+                                                       transform)
+    sou_owned = owned_entities(entity_set1, tile, overlapping_area)
+    tar_owned = owned_entities(entity_set2, tile, overlapping_area)
+
+    df_result = pd.DataFrame(columns=('sou_id', 'tar_id'))
+    num_at_halo = 0
+    if sou_owned.any() and len(entity_set2) > 0:
+        df_text_matched = pd.read_csv(text_result_file, header=None, sep='\t')
+        df_text_matched.columns = ['sou_id', 'tar_id']
+        sou_ids = entity_ids.build_id_dictionary(entity_set1)
+        tar_ids = entity_ids.build_id_dictionary(entity_set2)
+
+        # Similarity is computed as in 'similarity_calculation' for the pairs of owned source entities.
+        df_similarity = execute_align.generate_entity_pairs(entity_set1, entity_set2, df_text_matched,
+                                                            sou_selected=sou_owned)
+        if len(df_similarity) > 0:
+            execute_align.distance_metrics(df_similarity, entity_set1, entity_set2)
+            df_similarity['atr_within'] = similarity_computation.atr_within(df_similarity, entity_set1, entity_set2, radius)
+            execute_align.relation_metrics(df_similarity, entity_set1, entity_set2)
+            sou_inns = similarity_computation.entity_inns(entity_set1, sou_ids[np.unique(df_similarity['sou_id'].values)])
+            tar_inns = similarity_computation.entity_inns(entity_set2, tar_ids[np.unique(df_similarity['tar_id'].values)])
+            num_at_halo = len(inns_at_halo(sou_inns, entity_set1, halo_box))
+            sou_inns = similarity_computation.inns_csr(sou_inns, sou_ids)
+            tar_inns = similarity_computation.inns_csr(tar_inns, tar_ids)
+
+            # The method 'topo' keeps its alignments in a module variable, which must not include other tiles.
+            classsification.df_all_matching = pd.DataFrame(columns=('sou_id', 'tar_id'))
+            df_matched = entity_ids.encode_matches(df_text_matched, sou_ids, tar_ids)
+            df_similarity = execute_align.select_similarity_columns(df_similarity, method_name, distance_method)
+            df_result = execute_align.classification_result(df_similarity, method_name, df_matched, distance_method,
+                                                            sou_inns, tar_inns)
+            df_result = df_result[sou_owned[df_result['sou_id'].values.astype(np.int64)]]
+            tar_result_owned = tar_owned[df_result['tar_id'].values.astype(np.int64)]
+            df_result = entity_ids.decode_matches(df_result, sou_ids, tar_ids)
+            df_result['tar_owned'] = tar_result_owned
+
+    df_result.reindex(columns=['sou_id', 'tar_id', 'tar_owned']).to_csv(tile_file, index=0, sep='\t')
+
+    return tile_file, num_at_halo
+
+
+# Read and normalize the entities of both maps within the halo of a tile and the overlapping area. Entities of the
+# first map are transformed with transform. The halo box of the tile is also returned.
+def tile_entities(tile, overlapping_area, shapefile_list1, shapefile_list2, halo, transform):
+    halo_box = box(tile[0] - halo, tile[1] - halo, tile[2] + halo, tile[3] + halo)
+    entity_set1 = transform_entities(read_tile_entities(shapefile_list1, source_bounds(halo_box.bounds, transform)),
+                                     transform)
+    entity_set1 = entities_in_area(geometry_normalization.normalized(entity_set1), halo_box, overlapping_area)
+    entity_set2 = geometry_normalization.normalized(read_tile_entities(shapefile_list2, halo_box.bounds))
+    entity_set2 = entities_in_area(entity_set2, halo_box, overlapping_area)
+
+    return halo_box, entity_set1, entity_set2
+
+
+# The FeaIDs of the entities whose INNs reach the border of the halo box. Entities beyond the halo are not read, and
+# they can only be INNs of an entity if its neighbourhood reaches the border, so the INNs of these entities may be
+# incomplete. An INN reaches the border if its bounds are not inside the halo box.
+def inns_at_halo(inns, entity_set, halo_box):
+    minx, miny, maxx, maxy = halo_box.bounds
+    inside = (entity_set['minx'].values > minx) & (entity_set['miny'].values > miny) & \
+             (entity_set['maxx'].values < maxx) & (entity_set['maxy'].values < maxy)
+    at_border = set(entity_set['FeaID'].values[~inside])
+
+    return set([fea_id for fea_id, fea_id_inns in inns.items() if any([inn in at_border for inn in fea_id_inns])])
+
+
+# Estimate the radius of buffers of 'atr_within' from the entity pairs of a sample of tiles. The radius of
+# 'compute_radius' is a quantile of the distances of all entity pairs, and the quantile of the pairs of up to
+# num_sample_tiles tiles, spread evenly over the tiles, is used in its place. The Hausdorff distance is not used by
+# 'compute_radius', so it is not computed.
+def estimate_radius(tiles, overlapping_area, shapefile_list1, shapefile_list2, text_result_file, halo, transform,
+                    num_sample_tiles=RADIUS_SAMPLE_TILES):
+    df_text_matched = pd.read_csv(text_result_file, header=None, sep='\t')
+    df_text_matched.columns = ['sou_id', 'tar_id']
+    sample = np.unique(np.linspace(0, len(tiles) - 1, min(num_sample_tiles, len(tiles))).astype(np.int64))
+    df_distances = []
+    for i in sample:
+        halo_box, entity_set1, entity_set2 = tile_entities(tiles[i], overlapping_area, shapefile_list1, shapefile_list2,
+                                                           halo, transform)
+        sou_owned = owned_entities(entity_set1, tiles[i], overlapping_area)
+        if not sou_owned.any() or len(entity_set2) == 0:
+            continue
+        df_similarity = execute_align.generate_entity_pairs(entity_set1, entity_set2, df_text_matched,
+                                                            sou_selected=sou_owned)
+        if len(df_similarity) == 0:
+            continue
+        entity_sets = (entity_set1, entity_set2)
+        df_distances.append(pd.DataFrame({'dist_edc': similarity_computation.edc_distances(df_similarity, *entity_sets),
+                                          'dist_edv': similarity_computation.edv_distances(df_similarity, *entity_sets),
+                                          'dist_ednp': similarity_computation.ednp_distances(df_similarity, *entity_sets)}))
+    if len(df_distances) == 0:
+        raise ValueError('No entity pairs are found in the sample of tiles, and the radius can not be estimated.')
+
+    return similarity_computation.compute_radius(pd.concat(df_distances, ignore_index=True))
+
+
+# Merge the alignments of all tiles. An alignment found by several tiles, such as tiles which share a source entity
+# on their border, is kept once. For the one-to-one method 'assign', a target entity may still be aligned by tiles on
+# both sides of a border, and the alignment of the tile owning the target entity is kept.
+def merge_tile_results(tile_files, method_name):
+    df_tiles = [pd.read_csv(tile_file, sep='\t') for tile_file in tile_files]
+    if len(df_tiles) == 0:
+        return pd.DataFrame(columns=('sou_id', 'tar_id'))
+    df_result = pd.concat(df_tiles, ignore_index=True)
+    df_result = df_result.sort_values('tar_owned', ascending=False, kind='mergesort')
+    df_result = df_result.drop_duplicates(['sou_id', 'tar_id'])
+    if method_name == 'assign':
+        df_result = df_result.drop_duplicates('tar_id')
+
+    return df_result[['sou_id', 'tar_id']]
+
+
+# Cut the bounds of the overlapping area into square tiles of tile_size. Tiles are given as (minx, miny, maxx, maxy)
+# and cover the maximum bounds.
+def overlap_tiles(overlapping_area, tile_size):
+    if overlapping_area.is_empty:
+        return []
+    minx, miny, maxx, maxy = overlapping_area.bounds
+    tiles = []
+    for row in range(int(np.floor((maxy - miny) / tile_size)) + 1):
+        for col in range(int(np.floor((maxx - minx) / tile_size)) + 1):
+            tiles.append((minx + col * tile_size, miny + row * tile_size,
+                          minx + (col + 1) * tile_size, miny + (row + 1) * tile_size))
+
+    return tiles
+
+
+# Find the entities owned by a tile. The representative point of each entity is moved into the bounds of the
+# overlapping area, and the entity is owned by the tile if the point is within the tile. The maximum sides of a tile
+# are not included, so that each entity is owned by one tile.
+def owned_entities(entity_set, tile, overlapping_area):
+    if len(entity_set) == 0:
+        return np.zeros(0, dtype=bool)
+    minx, miny, maxx, maxy = overlapping_area.bounds
+    points = entity_set.geometry.representative_point()
+    x = np.clip(points.x.values, minx, maxx)
+    y = np.clip(points.y.values, miny, maxy)
+
+    return (x >= tile[0]) & (x < tile[2]) & (y >= tile[1]) & (y < tile[3])
+
+
+# Keep the entities of a normalized entity set which intersect the halo of a tile and the overlapping area. As in
+# 'overlapping_entity_pairs', invalid geometries are not removed.
+def entities_in_area(entity_set, halo_box, overlapping_area):
+    kept = overlay_entities.overlapping_entities(entity_set, halo_box)
+    kept[kept] = overlay_entities.overlapping_entities(entity_set[kept], overlapping_area)
+
+    return entity_set[kept].reset_index(drop=True)
+
+
+# Read the entities of one map within bounds from all its ShapeFiles.
+def read_tile_entities(shapefile_list, bounds):
+    entity_sets = [gpd.read_file(shapefile, bbox=bounds) for shapefile in shapefile_list]
+    entity_sets = [entity_set for entity_set in entity_sets if not entity_set.empty]
+    if len(entity_sets) == 0:
+        return gpd.GeoDataFrame({'FeaID': [], 'geometry': []})
+
+    return gpd.GeoDataFrame(pd.concat(entity_sets, ignore_index=True, sort=False))
+
+
+# Compute the convex hull of all entities of one map, reading READ_CHUNK_SIZE features at once. The entities are
+# transformed with transform first.
+def map_hull(shapefile_list, transform):
+    hull = None
+    for shapefile in shapefile_list:
+        with fiona.open(shapefile) as features:
+            chunk = []
+            for feature in features:
+                chunk.append(feature)
+                if len(chunk) == READ_CHUNK_SIZE:
+                    hull = update_hull(hull, chunk, transform)
+                    chunk = []
+            if len(chunk) > 0:
+                hull = update_hull(hull, chunk, transform)
+
+    return hull if hull is not None else box(0, 0, 0, 0).buffer(0)
+
+
+# Update a convex hull with the entities of a chunk of features.
+def update_hull(hull, chunk, transform):
+    entity_set = transform_entities(gpd.GeoDataFrame.from_features(chunk), transform)
+    chunk_hull = unary_union([geometry.convex_hull for geometry in entity_set.geometry]).convex_hull
+    if hull is None:
+        return chunk_hull
+
+    return unary_union([hull, chunk_hull]).convex_hull
+
+
+# The transformation from the first map to the second map. Besides the control points, the fitted affine
+# transformation is kept. For rubber sheeting, the largest residual of control points under the affine transformation
+# is also kept, which bounds the distance between rubber sheeting and the affine transformation.
+def map_transform(df_control_points, transform_method):
+    if df_control_points is None:
+        return None
+    affine_parameters = overlay_entities.fit_affine(df_control_points)
+    residual = 0.0
+    if transform_method == 'rubber_sheet':
+        source_points, target_points = overlay_entities.control_point_arrays(df_control_points)
+        a, b, d, e, xoff, yoff = affine_parameters
+        residuals = np.c_[a * source_points[:, 0] + b * source_points[:, 1] + xoff,
+                          d * source_points[:, 0] + e * source_points[:, 1] + yoff] - target_points
+        residual = float(np.hypot(residuals[:, 0], residuals[:, 1]).max())
+
+    return {'method': transform_method, 'control_points': df_control_points, 'affine': affine_parameters,
+            'residual': residual}
+
+
+# Transform the entities of the first map with transform.
+def transform_entities(entity_set, transform):
+    if transform is None or len(entity_set) == 0:
+        return entity_set
+    if transform['method'] == 'rubber_sheet':
+        return overlay_entities.rubber_sheet_entities(entity_set, transform['control_points'])
+
+    return overlay_entities.affine_entities(entity_set, transform['affine'])
+
+
+# The bounds in the coordinates of the first map of the entities which can be transformed into bounds in the
+# coordinates of the second map. The bounds are extended by the residual of rubber sheeting and are mapped with the
+# inverse of the affine transformation.
+def source_bounds(bounds, transform):
+    if transform is None:
+        return bounds
+    minx, miny, maxx, maxy = bounds
+    margin = transform['residual']
+    a, b, d, e, xoff, yoff = transform['affine']
+    inverse = np.linalg.inv(np.array([[a, b, xoff], [d, e, yoff], [0.0, 0.0, 1.0]]))
+    corners = np.array([[minx - margin, miny - margin, 1.0], [maxx + margin, miny - margin, 1.0],
+                        [maxx + margin, maxy + margin, 1.0], [minx - margin, maxy + margin, 1.0]])
+    source_corners = corners.dot(inverse.T)
+
+    return (source_corners[:, 0].min(), source_corners[:, 1].min(), source_corners[:, 0].max(),
+            source_corners[:, 1].max())
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# The modules of the workflow are in the directory 'code' and are imported by their names.
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'code'))
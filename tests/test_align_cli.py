@@ -0,0 +1,45 @@
+import os
+import subprocess
+import sys
+import pytest
+import align_cli
+
+# Directory of the source code, from which modules are imported in a new process.
+CODE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'code')
+
+
+# Modules loaded in a new process by importing one module.
+def loaded_modules(module_name):
+    output = subprocess.check_output([sys.executable, '-c', 'import sys, ' + module_name +
+                                      '; print(" ".join(sys.modules))'], cwd=CODE_DIR)
+
+    return set(output.decode().split())
+
+
+# The classification stage does not load geopandas, arcpy, scipy or joblib when it is imported.
+def test_classify_imports():
+    modules = loaded_modules('classify_align')
+
+    assert not modules & {'geopandas', 'arcpy', 'scipy', 'joblib'}
+
+
+# A method combined with one type of distance can not be run without --distance.
+def test_classify_needs_distance(capsys):
+    with pytest.raises(SystemExit):
+        align_cli.main(['classify', '--method', 'assign', '--text-result', 'text.txt', '--ground-truth', 'gt.txt'])
+
+    assert '--distance' in capsys.readouterr().err
+
+
+# Each method of 'sweep' which uses one type of distance is run with every type of distance given.
+def test_sweep(monkeypatch, tmp_path):
+    import classify_align
+    monkeypatch.chdir(tmp_path)
+    runs = []
+    monkeypatch.setattr(classify_align, 'classify_entity_pairs', lambda store, method_name, text_result, ground_truth,
+                        distance_type, n_jobs: runs.append((method_name, distance_type)))
+
+    align_cli.main(['sweep', '--methods', 'dist', 'assign', '--distances', 'dist_hdv', 'dist_edc', '--text-result',
+                    'text.txt', '--ground-truth', 'gt.txt'])
+
+    assert runs == [('dist', None), ('assign', 'dist_hdv'), ('assign', 'dist_edc')]
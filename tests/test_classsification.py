@@ -0,0 +1,27 @@
+import numpy as np
+import pandas as pd
+import pytest
+import classsification
+
+
+# Entity pairs of one connected component where aligning each source entity with its closest target entity would
+# align both source entities with the same target entity.
+def component_pairs(distances):
+    return pd.DataFrame({'sou_id': np.array([0, 0, 1, 1], dtype=np.int32),
+                         'tar_id': np.array([0, 1, 0, 1], dtype=np.int32),
+                         'sou_type': pd.Categorical(['Polygon'] * 4),
+                         'dist_hdv': distances,
+                         'atr_within': [0.9, 0.9, 0.9, 0.9]})
+
+
+# The assignment minimizes the total distance of one-to-one alignments.
+def test_assign_component():
+    df_result = classsification.assign(component_pairs([1.0, 2.0, 1.5, 10.0]), 'dist_hdv')
+
+    assert sorted([tuple(value) for value in df_result.values]) == [(0, 1), (1, 0)]
+
+
+# Entity pairs without the distance, as written with lazy_hdv, are rejected.
+def test_assign_missing_distance():
+    with pytest.raises(ValueError):
+        classsification.assign(component_pairs([1.0, np.nan, 1.5, 10.0]), 'dist_hdv')
@@ -0,0 +1,22 @@
+import numpy as np
+import pandas as pd
+import pytest
+import entity_ids
+
+
+# FeaIDs are converted to codes and back, and unknown FeaIDs get the code -1.
+def test_encode_decode_ids():
+    id_dictionary = entity_ids.build_id_dictionary(pd.DataFrame({'FeaID': ['a', 'b', 'c']}))
+    codes = entity_ids.encode_ids(id_dictionary, ['c', 'a', 'x'])
+
+    assert codes.dtype == np.int32
+    assert list(codes) == [2, 0, -1]
+    assert list(entity_ids.decode_ids(id_dictionary, codes[:2])) == ['c', 'a']
+
+
+# The code -1 of an unknown FeaID is not decoded as the last FeaID.
+def test_decode_negative_codes():
+    id_dictionary = pd.Index(['a', 'b', 'c'])
+
+    with pytest.raises(ValueError):
+        entity_ids.decode_ids(id_dictionary, [0, -1])
@@ -0,0 +1,72 @@
+import random
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+from shapely.geometry import LineString, Point, box
+import execute_align
+import geometry_normalization
+import similarity_store
+
+
+# A normalized entity set of one map with random points, polylines and polygons.
+def random_entity_set(rng, num_entities, prefix):
+    geometries = []
+    for i in range(num_entities):
+        x, y = rng.uniform(0, 10), rng.uniform(0, 10)
+        geometries.append([Point(x, y), LineString([(x, y), (x + rng.uniform(-2, 2), y + rng.uniform(-2, 2))]),
+                           box(x, y, x + rng.uniform(0.1, 2), y + rng.uniform(0.1, 2))][i % 3])
+
+    return geometry_normalization.normalize_entities(
+        gpd.GeoDataFrame({'FeaID': [prefix + str(i) for i in range(num_entities)]}, geometry=geometries))
+
+
+# Entity pairs only hold the codes and geometry type of their entities, and entities matched with textual labels are
+# not paired.
+def test_generate_entity_pairs():
+    rng = random.Random(0)
+    entity_set1 = random_entity_set(rng, 9, 's')
+    entity_set2 = random_entity_set(rng, 9, 't')
+
+    df_similarity = execute_align.generate_entity_pairs(entity_set1, entity_set2,
+                                                        pd.DataFrame({'sou_id': ['s0'], 'tar_id': ['t3']}))
+
+    assert list(df_similarity.columns) == ['sou_id', 'tar_id', 'sou_type']
+    assert len(df_similarity) == 2 * 2 + 3 * 3 + 3 * 3
+    assert not (df_similarity['sou_id'] == 0).any() and not (df_similarity['tar_id'] == 3).any()
+    assert (entity_set1['geometry_type'].values[df_similarity['sou_id'].values] ==
+            entity_set2['geometry_type'].values[df_similarity['tar_id'].values]).all()
+
+
+# Merging the entity pairs kept from a previous run with new entity pairs gives the similarity of all entity pairs
+# computed at once.
+def test_merge_similarity():
+    rng = random.Random(1)
+    entity_set1 = random_entity_set(rng, 30, 's')
+    entity_set2 = random_entity_set(rng, 30, 't')
+    df_pairs = execute_align.generate_entity_pairs(entity_set1, entity_set2, pd.DataFrame({'sou_id': [], 'tar_id': []}))
+    df_all, radius = execute_align.merge_similarity(df_pairs.iloc[0:0], df_pairs, entity_set1, entity_set2, True, None)
+
+    kept = df_pairs['sou_id'].values < 15
+    df_merged, merged_radius = execute_align.merge_similarity(df_all[kept], df_pairs[~kept], entity_set1, entity_set2,
+                                                              True, radius)
+
+    assert merged_radius == radius
+    df_merged = df_merged.sort_values(['sou_id', 'tar_id']).reset_index(drop=True)
+    pd.testing.assert_frame_equal(df_merged[df_all.columns], df_all.reset_index(drop=True), check_dtype=False)
+
+
+# The similarity of two overlaid maps is written in the similarity store with the derived columns of entities left in
+# the entity sets.
+def test_similarity_calculation(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    rng = random.Random(2)
+    (tmp_path / 'text.txt').write_text('s0\tt0\n')
+
+    execute_align.similarity_calculation(random_entity_set(rng, 12, 's'), random_entity_set(rng, 12, 't'), 'text.txt',
+                                         True)
+
+    df_similarity = similarity_store.read_store('similarity_store')['similarity']
+    assert {'dist_edc', 'dist_edv', 'dist_hdv', 'dist_ednp', 'angle', 'atr_within', 'overlap_fraction'} <= \
+        set(df_similarity.columns)
+    assert not any([column.startswith('sou_') and column not in ['sou_id', 'sou_type'] for column in df_similarity])
+    assert np.isfinite(df_similarity['dist_edc'].values).all()
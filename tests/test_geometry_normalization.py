@@ -0,0 +1,23 @@
+import geopandas as gpd
+from shapely.geometry import LineString, Polygon
+import geometry_normalization
+
+
+# An invalid polygon is repaired and used as a valid one, and the derived columns are those of the repaired shape.
+def test_repaired_polygon():
+    bowtie = Polygon([(0, 0), (2, 2), (2, 0), (0, 2)])
+    entity_set = gpd.GeoDataFrame({'FeaID': ['a', 'b']}, geometry=[bowtie, LineString([(0, 0), (3, 4)])])
+
+    normalized = geometry_normalization.normalize_entities(entity_set)
+
+    assert list(normalized['valid']) == [True, True]
+    assert list(normalized['repaired']) == [True, False]
+    assert normalized.geometry[0].is_valid
+    assert normalized['area'][0] == normalized.geometry[0].area
+    assert normalized['length'][1] == 5.0
+
+
+# An empty geometry has no vertices.
+def test_empty_geometry_vertices():
+    assert geometry_normalization.geometry_vertices(Polygon()).shape == (0, 2)
+    assert geometry_normalization.geometry_vertices(LineString()).shape == (0, 2)
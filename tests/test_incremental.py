@@ -0,0 +1,83 @@
+import geopandas as gpd
+import pandas as pd
+import pytest
+from shapely.geometry import LineString, Point, box
+import evaluate_performance
+import execute_align
+import incremental
+
+
+# A map of three entities with textual labels.
+def entity_set(labels):
+    return gpd.GeoDataFrame({'FeaID': ['p', 'l', 'a'], 'Label': labels},
+                            geometry=[Point(0, 0), LineString([(0, 0), (1, 1)]), box(0, 0, 1, 1)])
+
+
+# Entities are added, removed or modified by comparing their hashes.
+def test_diff_entities():
+    old_hashes = {'a': '1', 'b': '2', 'c': '3'}
+    new_hashes = {'b': '2', 'c': '4', 'd': '5'}
+
+    added, removed, modified = incremental.diff_entities(old_hashes, new_hashes)
+
+    assert (added, removed, modified) == ({'d'}, {'a'}, {'c'})
+
+
+# The hash of an entity changes with its label.
+def test_entity_hashes():
+    old_hashes = incremental.entity_hashes(entity_set(['A', 'B', 'C']))
+    new_hashes = incremental.entity_hashes(entity_set(['A', 'B', 'D']))
+
+    assert incremental.diff_entities(old_hashes, new_hashes) == (set(), set(), {'a'})
+
+
+# Only the label pairs including changed entities are matched again, and alignments of removed entities are dropped.
+def test_update_text_matches():
+    entity_set1 = entity_set(['Main St', 'River', 'Hall'])
+    entity_set2 = gpd.GeoDataFrame({'FeaID': ['P', 'L', 'A'], 'Label': ['MAIN ST', 'River', 'Hall']},
+                                   geometry=[Point(0, 0), LineString([(0, 0), (1, 1)]), box(0, 0, 1, 1)])
+    old_matches = [('l', 'L'), ('a', 'A'), ('x', 'X')]
+
+    matches = incremental.update_text_matches(old_matches, entity_set1, entity_set2, {'p'}, set(), {'x'}, set(),
+                                              'simple_str_case_punc')
+
+    assert sorted(matches) == [('a', 'A'), ('l', 'L'), ('p', 'P')]
+
+
+# Machine learning methods can not match a part of the label pairs.
+def test_update_text_matches_machine_learning():
+    with pytest.raises(ValueError):
+        incremental.update_text_matches([], entity_set(['A', 'B', 'C']), entity_set(['A', 'B', 'C']), {'p'}, set(),
+                                        set(), set(), 'text_santos2018a')
+
+
+# Only alignments of points and polylines yield control points.
+def test_control_point_matches():
+    matches = [('p', 'P'), ('l', 'L'), ('a', 'A')]
+
+    assert incremental.control_point_matches(matches, entity_set(['A', 'B', 'C'])) == {('p', 'P'), ('l', 'L')}
+
+
+# A changed source entity which now takes the target entity of an unchanged source entity is assigned again with all
+# entity pairs, so that no target entity is aligned with two source entities.
+def test_incremental_assign(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    df_similarity = pd.DataFrame({'sou_id': ['s0', 's0', 's1', 's1'], 'tar_id': ['t0', 't1', 't0', 't1'],
+                                  'sou_type': pd.Categorical(['Polygon'] * 4), 'dist_hdv': [1.0, 2.0, 0.1, 10.0],
+                                  'angle': [0.0] * 4, 'atr_within': [1.0] * 4})
+    key = ('assign', 'dist_hdv')
+    incremental.save_state('state.pkl', {
+        'processed1': pd.DataFrame({'FeaID': ['s0', 's1']}), 'processed2': pd.DataFrame({'FeaID': ['t0', 't1']}),
+        'similarity': df_similarity, 'inns1': {}, 'inns2': {},
+        'matches': {key: pd.DataFrame({'sou_id': ['s0', 's1'], 'tar_id': ['t0', 't1']})}, 'pending': {key: {'s1'}}})
+    (tmp_path / 'text.txt').write_text('s9\tt9\n')
+    # Only the result of the classification is checked.
+    results = []
+    monkeypatch.setattr(evaluate_performance, 'write_result_file', lambda df_result, *args: results.append(df_result))
+    monkeypatch.setattr(evaluate_performance, 'eval_perf', lambda *args: None)
+
+    execute_align.incremental_classification('assign', 'text.txt', 'gt.txt', 'dist_hdv', report_file='report.json')
+
+    df_result = results[0]
+    assert not df_result['tar_id'].duplicated().any()
+    assert sorted(zip(df_result['sou_id'], df_result['tar_id'])) == [('s0', 't1'), ('s1', 't0')]
@@ -0,0 +1,52 @@
+import json
+import instrumentation
+
+
+# Each stage records its time and memory, and counters are summed.
+def test_stage_and_counters():
+    instrumentation.reset_report()
+    with instrumentation.stage('first'):
+        instrumentation.count('pairs', 3)
+    instrumentation.count('pairs')
+
+    record = instrumentation.run_report['stages'][0]
+    assert record['stage'] == 'first'
+    assert record['wall_time'] >= 0 and record['cpu_time'] >= 0
+    assert 'max_rss_mb' in record and 'max_rss_increase_mb' in record
+    assert instrumentation.run_report['counters'] == {'pairs': 4}
+
+
+# Merging adds the stages and counters of the current run to the report in the file.
+def test_write_report_merge(tmp_path):
+    report_file = str(tmp_path / 'run_report.json')
+    instrumentation.reset_report()
+    with instrumentation.stage('align'):
+        instrumentation.count('pairs', 2)
+    instrumentation.write_report(report_file)
+
+    instrumentation.reset_report()
+    with instrumentation.stage('classify'):
+        instrumentation.count('pairs', 1)
+    instrumentation.write_report(report_file, merge=True)
+
+    with open(report_file) as json_file:
+        report = json.load(json_file)
+    assert [record['stage'] for record in report['stages']] == ['align', 'classify']
+    assert report['counters'] == {'pairs': 3}
+
+
+# Each profile is written into its own file, and a new run does not profile the stage of the previous run.
+def test_profile_reset(tmp_path):
+    instrumentation.reset_report()
+    instrumentation.enable_profile('stage', str(tmp_path / 'stage.prof'))
+    for _ in range(2):
+        with instrumentation.stage('stage'):
+            pass
+    profiles = [record['profile'] for record in instrumentation.run_report['stages']]
+    assert len(set(profiles)) == 2
+    assert all((tmp_path / profile).exists() for profile in profiles)
+
+    instrumentation.reset_report()
+    with instrumentation.stage('stage'):
+        pass
+    assert 'profile' not in instrumentation.run_report['stages'][0]
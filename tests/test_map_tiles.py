@@ -0,0 +1,45 @@
+import os
+import numpy as np
+import map_tiles
+
+
+# Write level 0 of a pyramid of one band from an image, with partial tiles padded with the pixels on their edges.
+def write_level_0(cache_dir, image, tile_size):
+    height, width = image.shape
+    rows, cols = map_tiles.tile_grid(width, height, tile_size)
+    level_array = np.zeros((rows, cols, tile_size, tile_size, 1), dtype=image.dtype)
+    padded = np.pad(image, ((0, rows * tile_size - height), (0, cols * tile_size - width)), mode='edge')
+    for row in range(rows):
+        for col in range(cols):
+            level_array[row, col, :, :, 0] = padded[row * tile_size:(row + 1) * tile_size,
+                                                    col * tile_size:(col + 1) * tile_size]
+    np.save(os.path.join(cache_dir, 'level_0.npy'), level_array)
+
+    return {'file': 'level_0.npy', 'width': width, 'height': height, 'rows': rows, 'cols': cols}
+
+
+# Each pixel of the next level is the average of the 2x2 pixels within the image, also on the border of an image of
+# odd size.
+def test_downsample_level(tmp_path):
+    image = np.arange(7 * 5, dtype=np.float64).reshape(7, 5)
+    level_0 = write_level_0(str(tmp_path), image, 4)
+
+    level_1 = map_tiles.downsample_level(str(tmp_path), level_0, 1, 4, 1, np.dtype(np.float64))
+
+    assert (level_1['width'], level_1['height'], level_1['rows'], level_1['cols']) == (3, 4, 1, 1)
+    tile = np.load(os.path.join(str(tmp_path), level_1['file']))[0, 0, :, :, 0]
+    for row in range(4):
+        for col in range(3):
+            assert tile[row, col] == image[2 * row:2 * row + 2, 2 * col:2 * col + 2].mean()
+
+
+# Cached tiles of a pyramid are not read again after the pyramid is cleared.
+def test_clear_cache(tmp_path):
+    cache_dir = str(tmp_path)
+    write_level_0(cache_dir, np.zeros((4, 4), dtype=np.uint8), 4)
+    assert map_tiles.read_tile(cache_dir, 0, 0, 0).max() == 0
+
+    map_tiles.clear_cache(cache_dir)
+    write_level_0(cache_dir, np.ones((4, 4), dtype=np.uint8), 4)
+
+    assert map_tiles.read_tile(cache_dir, 0, 0, 0).min() == 1
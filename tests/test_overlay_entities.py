@@ -0,0 +1,31 @@
+import numpy as np
+import geopandas as gpd
+from shapely.geometry import Point
+import overlay_entities
+
+
+# Control points are transformed exactly onto their targets, and a point inside a triangle is transformed with the
+# affine transformation of its triangle.
+def test_piecewise_affine_control_points():
+    source_points = np.array([[0.0, 0.0], [10.0, 0.0], [0.0, 10.0], [10.0, 10.0]])
+    target_points = np.array([[1.0, 1.0], [12.0, 0.0], [0.0, 11.0], [13.0, 12.0]])
+    affine_parameters = (1.0, 0.0, 0.0, 1.0, 0.0, 0.0)
+
+    transformed = overlay_entities.piecewise_affine(source_points, source_points, target_points, affine_parameters)
+    np.testing.assert_allclose(transformed, target_points, atol=1e-9)
+
+    outside = overlay_entities.piecewise_affine(np.array([[20.0, 20.0]]), source_points, target_points,
+                                                affine_parameters)
+    np.testing.assert_allclose(outside, [[20.0, 20.0]])
+
+
+# Layers already in the target CRS are returned as they are, and other layers are reprojected.
+def test_transformation_crs_skips_equal_crs():
+    layer_wgs84 = gpd.GeoDataFrame({'FeaID': ['a']}, geometry=[Point(10.0, 50.0)], crs='EPSG:4326')
+    layer_mercator = gpd.GeoDataFrame({'FeaID': ['b']}, geometry=[Point(0.0, 0.0)], crs='EPSG:3857')
+
+    transformed = overlay_entities.transformation_crs([layer_wgs84, layer_mercator], layer_wgs84.crs)
+
+    assert transformed[0] is layer_wgs84
+    assert overlay_entities.crs_key(transformed[1].crs) == overlay_entities.crs_key(layer_wgs84.crs)
+    np.testing.assert_allclose(transformed[1].geometry[0].coords[0], (0.0, 0.0), atol=1e-9)
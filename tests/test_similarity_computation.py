@@ -0,0 +1,174 @@
+import random
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+from scipy.spatial.distance import cdist
+from shapely.geometry import LineString, MultiPoint, Point, Polygon, box
+import classsification
+import entity_ids
+import execute_align
+import geometry_normalization
+import similarity_computation
+
+
+# A random point, polyline or polygon with coordinates between 0 and 10.
+def random_geometry(rng):
+    kind = rng.randint(0, 2)
+    if kind == 0:
+        return Point(rng.uniform(0, 10), rng.uniform(0, 10))
+    if kind == 1:
+        return LineString([(rng.uniform(0, 10), rng.uniform(0, 10)) for i in range(rng.randint(2, 5))])
+    x, y = rng.uniform(0, 8), rng.uniform(0, 8)
+
+    return box(x, y, x + rng.uniform(0.1, 2), y + rng.uniform(0.1, 2))
+
+
+# An entity set of one map with random geometries of one type.
+def random_entity_set(rng, num_entities, kind=None):
+    geometries = []
+    while len(geometries) < num_entities:
+        geometry = random_geometry(rng)
+        if kind is None or geometry.geom_type == kind:
+            geometries.append(geometry)
+
+    return gpd.GeoDataFrame({'FeaID': ['e%d' % i for i in range(num_entities)]}, geometry=geometries)
+
+
+# All entity pairs of two entity sets, and the normalized entity sets whose columns are looked up with the codes of
+# entity pairs.
+def entity_pairs(entity_set1, entity_set2):
+    entity_set1 = geometry_normalization.normalize_entities(entity_set1)
+    entity_set2 = geometry_normalization.normalize_entities(entity_set2)
+    df_similarity = execute_align.generate_entity_pairs(entity_set1, entity_set2,
+                                                        pd.DataFrame({'sou_id': [], 'tar_id': []}))
+
+    return df_similarity, entity_set1, entity_set2
+
+
+# The INNs stored as compressed sparse rows are the lists of INNs of each entity.
+def test_inns_csr():
+    entity_set = random_entity_set(random.Random(2), 30)
+    id_dictionary = entity_ids.build_id_dictionary(entity_set)
+    fea_ids = set(entity_set['FeaID'][:20])
+    inns = similarity_computation.entity_inns(entity_set, fea_ids)
+
+    csr_inns = similarity_computation.inns_csr(inns, id_dictionary)
+
+    for code, fea_id in enumerate(entity_set['FeaID']):
+        inn_codes = classsification.entity_inns(csr_inns, code)
+        assert list(entity_ids.decode_ids(id_dictionary, inn_codes)) == inns.get(fea_id, [])
+
+
+# The INNs found with inn_candidates 'all' and the spatial index are those of the test of each pair of entities.
+def test_entity_inns_all():
+    entity_set = random_entity_set(random.Random(3), 25)
+
+    inns = similarity_computation.entity_inns(entity_set, inn_candidates='all')
+
+    for fea_id, geometry in zip(entity_set['FeaID'], entity_set.geometry):
+        assert inns[fea_id] == similarity_computation.immediate_neighbours(geometry, fea_id, entity_set)
+
+
+# The lower bound from bounding boxes never exceeds the Hausdorff distance.
+def test_hausdorff_lower_bound():
+    rng = random.Random(0)
+    pairs = [(random_geometry(rng), random_geometry(rng)) for i in range(500)]
+    bounds_sou = np.array([geometry_sou.bounds for geometry_sou, geometry_tar in pairs])
+    bounds_tar = np.array([geometry_tar.bounds for geometry_sou, geometry_tar in pairs])
+    exact = np.array([geometry_sou.hausdorff_distance(geometry_tar) for geometry_sou, geometry_tar in pairs])
+
+    lower_bounds = similarity_computation.hausdorff_lower_bound(bounds_sou, bounds_tar)
+
+    assert np.all(lower_bounds <= exact + 1e-9)
+
+
+# The lazy Hausdorff distance gives the same shortest distance of each source entity, and the same tied entity pairs, as
+# the Hausdorff distance of all entity pairs.
+def test_lazy_hdv():
+    rng = random.Random(4)
+    entity_set2 = random_entity_set(rng, 30)
+    # Duplicated target geometries give tied entity pairs.
+    entity_set2 = gpd.GeoDataFrame(pd.concat([entity_set2, entity_set2], ignore_index=True))
+    df_similarity, entity_set1, entity_set2 = entity_pairs(random_entity_set(rng, 30), entity_set2)
+
+    df_similarity['eager'] = similarity_computation.hdv_distances(df_similarity, entity_set1, entity_set2)
+    df_similarity['lazy'] = similarity_computation.lazy_hdv(df_similarity, entity_set1, entity_set2)
+
+    assert df_similarity['lazy'].isna().any()
+    for sou_id, df_sou in df_similarity.groupby('sou_id'):
+        shortest = df_sou['eager'].min()
+        assert df_sou['lazy'].min() == shortest
+        assert set(df_sou['tar_id'][df_sou['eager'] == shortest]) == set(df_sou['tar_id'][df_sou['lazy'] == shortest])
+
+
+# The shortest distance between vertices is the minimum over all pairs of vertices, computed with or without KD-trees,
+# and entity pairs including an empty geometry get NaN.
+def test_edv_distances():
+    rng = random.Random(5)
+    geometries = [Point(rng.uniform(0, 10), rng.uniform(0, 10)).buffer(rng.uniform(0.1, 2), rng.choice([2, 16]))
+                  for i in range(20)] + [Polygon()]
+    entity_set1 = gpd.GeoDataFrame({'FeaID': ['s%d' % i for i in range(21)]}, geometry=geometries)
+    entity_set2 = gpd.GeoDataFrame({'FeaID': ['t%d' % i for i in range(21)]}, geometry=geometries[::-1])
+    df_similarity, entity_set1, entity_set2 = entity_pairs(entity_set1, entity_set2)
+
+    distances = similarity_computation.edv_distances(df_similarity, entity_set1, entity_set2)
+
+    for position, (sou_id, tar_id) in enumerate(zip(df_similarity['sou_id'], df_similarity['tar_id'])):
+        geometry_sou = entity_set1.geometry[sou_id]
+        geometry_tar = entity_set2.geometry[tar_id]
+        if geometry_sou.is_empty or geometry_tar.is_empty:
+            assert np.isnan(distances[position])
+        else:
+            vertices_sou = np.array(geometry_sou.exterior.coords)
+            vertices_tar = np.array(geometry_tar.exterior.coords)
+            assert np.isclose(distances[position], cdist(vertices_sou, vertices_tar).min())
+
+
+# The relations read from one DE-9IM matrix are those of the shapely predicates.
+def test_relation_flags():
+    rng = random.Random(1)
+    for i in range(500):
+        geometry_sou = random_geometry(rng)
+        geometry_tar = random_geometry(rng)
+        flags = similarity_computation.relation_flags(geometry_sou.relate(geometry_tar))
+        for predicate in similarity_computation.RELATION_PREDICATES:
+            assert flags[predicate] == getattr(geometry_sou, predicate)(geometry_tar)
+
+
+# The overlap fraction of multipoints is the fraction of shared points of the smaller entity.
+def test_overlap_fraction_multipoints():
+    geometry_sou = MultiPoint([(0, 0), (1, 1), (2, 2)])
+    geometry_tar = MultiPoint([(0, 0), (5, 5)])
+
+    fraction = similarity_computation.overlap_fraction(geometry_sou, geometry_tar, np.zeros(2), np.zeros(2),
+                                                       np.array([(0, 0), (1, 1), (2, 2)]), np.array([(0, 0), (5, 5)]))
+
+    assert fraction == 0.5
+
+
+# The overlap fraction of polygons is the ratio of the intersection to the smaller area.
+def test_overlap_fraction_polygons():
+    geometry_sou = box(0, 0, 2, 2)
+    geometry_tar = Polygon([(1, 0), (3, 0), (3, 1), (1, 1)])
+
+    fraction = similarity_computation.overlap_fraction(geometry_sou, geometry_tar, np.array([4.0, 2.0]),
+                                                       np.array([8.0, 6.0]), None, None)
+
+    assert fraction == 0.5
+
+
+# The relations and overlap fractions of all entity pairs, looked up with the codes of entities, are those of shapely.
+def test_topological_relations():
+    rng = random.Random(6)
+    df_similarity, entity_set1, entity_set2 = entity_pairs(random_entity_set(rng, 20, 'Polygon'),
+                                                           random_entity_set(rng, 20, 'Polygon'))
+
+    columns = similarity_computation.topological_relations(df_similarity, entity_set1, entity_set2)
+
+    for position, (sou_id, tar_id) in enumerate(zip(df_similarity['sou_id'], df_similarity['tar_id'])):
+        geometry_sou = entity_set1.geometry[sou_id]
+        geometry_tar = entity_set2.geometry[tar_id]
+        for column, predicate in zip(similarity_computation.RELATION_COLUMNS, similarity_computation.RELATION_PREDICATES):
+            assert columns[column][position] == getattr(geometry_sou, predicate)(geometry_tar)
+        area = min(geometry_sou.area, geometry_tar.area)
+        assert np.isclose(columns['overlap_fraction'][position], geometry_sou.intersection(geometry_tar).area / area)
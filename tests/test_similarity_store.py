@@ -0,0 +1,49 @@
+import numpy as np
+import pandas as pd
+import similarity_store
+
+
+# Build a small dataframe of similarity with columns of every type written in the store.
+def similarity_frame():
+    return pd.DataFrame({'sou_id': np.array([0, 0, 1], dtype=np.int32),
+                         'tar_id': np.array([1, 2, 0], dtype=np.int32),
+                         'sou_type': pd.Categorical(['Point', 'Point', 'Polygon'],
+                                                    categories=['Point', 'LineString', 'Polygon']),
+                         'dist_hdv': [1.5, np.nan, 0.25],
+                         'relation_within': [True, False, True],
+                         'sou_feature': [None, None, None]})
+
+
+# Columns, dtypes, values, ID dictionaries and INNs are read back as they were written, and geometries are not written.
+def test_round_trip(tmp_path):
+    store_path = str(tmp_path / 'store')
+    sou_inns = (np.array([0, 1, 1]), np.array([1]))
+    tar_inns = (np.array([0, 0, 1, 1]), np.array([0]))
+    similarity_store.write_store(store_path, similarity_frame(), pd.Index(['a', 'b']), pd.Index(['x', 'y', 'z']),
+                                 sou_inns, tar_inns)
+    similarity = similarity_store.read_store(store_path)
+    df_similarity = similarity['similarity']
+
+    assert list(df_similarity.columns) == ['sou_id', 'tar_id', 'sou_type', 'dist_hdv', 'relation_within']
+    assert df_similarity['sou_id'].dtype == np.int32
+    assert df_similarity['relation_within'].dtype == np.bool_
+    assert list(df_similarity['relation_within']) == [True, False, True]
+    assert isinstance(df_similarity['sou_type'].dtype, pd.CategoricalDtype)
+    assert list(df_similarity['sou_type'].cat.categories) == ['Point', 'LineString', 'Polygon']
+    assert list(df_similarity['sou_type'].astype(str)) == ['Point', 'Point', 'Polygon']
+    np.testing.assert_array_equal(df_similarity['dist_hdv'].values, [1.5, np.nan, 0.25])
+    assert list(similarity['tar_ids']) == ['x', 'y', 'z']
+    np.testing.assert_array_equal(similarity['sou_inns'][0], sou_inns[0])
+    np.testing.assert_array_equal(similarity['tar_inns'][1], tar_inns[1])
+
+
+# Only the given columns are read.
+def test_read_columns(tmp_path):
+    store_path = str(tmp_path / 'store')
+    inns = (np.zeros(3, dtype=np.int64), np.zeros(0, dtype=np.int32))
+    similarity_store.write_store(store_path, similarity_frame(), pd.Index(['a', 'b']), pd.Index(['x', 'y']), inns, inns)
+
+    df_similarity = similarity_store.read_store(store_path, ['sou_id', 'dist_hdv'])['similarity']
+
+    assert list(df_similarity.columns) == ['sou_id', 'dist_hdv']
+    assert len(df_similarity) == 3
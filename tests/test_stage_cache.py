@@ -0,0 +1,54 @@
+import os
+import pytest
+import stage_cache
+
+
+# Enable the stage cache in a temporary directory, and disable it after the test.
+@pytest.fixture
+def cache_dir(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    stage_cache.enable_cache(str(tmp_path / 'cache'))
+    yield str(tmp_path / 'cache')
+    stage_cache.disable_cache()
+
+
+# Keys are equal for equal inputs, and change with the stage, any part, or the content of an input file.
+def test_stage_key(tmp_path):
+    input_file = tmp_path / 'input.txt'
+    input_file.write_text('a')
+    first_hash = stage_cache.file_hash(str(input_file))
+    input_file.write_text('b')
+    second_hash = stage_cache.file_hash(str(input_file))
+
+    key = stage_cache.stage_key('stage', first_hash, 'method')
+    assert key == stage_cache.stage_key('stage', first_hash, 'method')
+    assert key != stage_cache.stage_key('other_stage', first_hash, 'method')
+    assert key != stage_cache.stage_key('stage', second_hash, 'method')
+    assert key != stage_cache.stage_key('stage', first_hash, 'other_method')
+
+
+# The version of the code is computed once.
+def test_code_version():
+    assert stage_cache.code_version() == stage_cache.code_version()
+    assert stage_cache.code_hash['version'] is not None
+
+
+# The output is computed once for a key, and side files are written again on a hit.
+def test_cached_output_and_side_files(cache_dir):
+    calls = []
+
+    def compute():
+        calls.append(1)
+        with open('intersection.shp', 'w') as side_file:
+            side_file.write('shape')
+        return {'value': 1}
+
+    assert stage_cache.cached('stage', 'key', compute, ['intersection.*']) == {'value': 1}
+    os.remove('intersection.shp')
+    assert stage_cache.cached('stage', 'key', compute, ['intersection.*']) == {'value': 1}
+    assert len(calls) == 1
+    with open('intersection.shp') as side_file:
+        assert side_file.read() == 'shape'
+
+    stage_cache.cached('stage', 'other_key', compute)
+    assert len(calls) == 2
@@ -0,0 +1,38 @@
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+from shapely.geometry import Point, box
+import tiling
+
+
+# Write the alignments of one tile as 'align_tile' does.
+def write_tile(tile_file, rows):
+    pd.DataFrame(rows, columns=['sou_id', 'tar_id', 'tar_owned']).to_csv(str(tile_file), index=0, sep='\t')
+
+    return str(tile_file)
+
+
+# Each entity is owned by exactly one tile of the overlapping area, also on the borders of tiles and of the area.
+def test_owned_entities():
+    overlapping_area = box(0, 0, 20, 10)
+    entity_set = gpd.GeoDataFrame({'FeaID': ['a', 'b', 'c', 'd']},
+                                   geometry=[Point(1, 1), Point(10, 5), Point(20, 10), Point(25, -5)])
+    tiles = tiling.overlap_tiles(overlapping_area, 10)
+
+    owned = np.array([tiling.owned_entities(entity_set, tile, overlapping_area) for tile in tiles])
+
+    assert list(owned.sum(axis=0)) == [1, 1, 1, 1]
+
+
+# Alignments found by two overlapping tiles are merged once, and with 'assign' the alignment of the tile owning the
+# target entity is kept.
+def test_merge_tile_results(tmp_path):
+    tile_files = [write_tile(tmp_path / 'tile_0.txt', [('s0', 't0', True), ('s1', 't1', False), ('s2', 't2', True)]),
+                  write_tile(tmp_path / 'tile_1.txt', [('s1', 't1', True), ('s2', 't2', False), ('s3', 't2', False)])]
+
+    df_result = tiling.merge_tile_results(tile_files, 'dist')
+    assert sorted(zip(df_result['sou_id'], df_result['tar_id'])) == [('s0', 't0'), ('s1', 't1'), ('s2', 't2'),
+                                                                     ('s3', 't2')]
+
+    df_result = tiling.merge_tile_results(tile_files, 'assign')
+    assert sorted(zip(df_result['sou_id'], df_result['tar_id'])) == [('s0', 't0'), ('s1', 't1'), ('s2', 't2')]